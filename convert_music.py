@@ -3,29 +3,218 @@
 License: MIT; Website: https://github.com/Robpol86/general
 
 Usage:
-    convert_music.py <flac_dir> <mp3_dir> [-ay] [-f FILE] [-l FILE] [-t NUM]
+    convert_music.py query <flac_dir> [--where=FILTER...] [options]
+    convert_music.py <flac_dir> <mp3_dir> [--target=DIR:PROFILE...] [options]
+    convert_music.py --worker=ADDRESS [options]
     convert_music.py (-h | --help)
     convert_music.py --version
 
 Options:
     -a --ignore-art                 Ignore checks for missing album art.
+    --art-cache=DIR                 Keep converted album art in DIR between
+                                    runs.
+    --art-cache-size=MB             Memory and disk budget of the album art
+                                    cache, each.
+                                    [default: 64]
+    --art-quality=NUM               JPEG quality of converted album art.
+                                    [default: 90]
+    --art-size=PX                   Scale album art down to fit within PX x PX
+                                    pixels and recompress it as JPEG, once per
+                                    distinct picture (0 keeps the original).
+                                    [default: 0]
+    --check-albums                  Also check albums (FLAC files of a
+                                    directory with the same album tag) for
+                                    conflicting dates or artist spellings,
+                                    and duplicate or missing track numbers.
+    --chunk-seconds=SECONDS         Segment length of chunked encoding.
+                                    [default: 300]
+    --chunk-threshold=SECONDS       Encode mp3 files of FLACs longer than this
+                                    in segments on all CPUs, joined frame
+                                    accurately (0 disables). Needs profiles
+                                    without resampling; segments are encoded
+                                    without the bit reservoir.
+                                    [default: 0]
+    --control-socket=FILE           Unix socket of --watch: send a "status" or
+                                    "enqueue PATH" line, get a JSON line back.
+    --coordinator=ADDRESS           Have --worker processes (on other machines
+                                    mounting the same directories under the
+                                    same paths) encode, listening on HOST:PORT
+                                    or a Unix socket path. Tags are written
+                                    here. Use enough --threads to keep every
+                                    worker thread busy.
+    --durability=MODE               When finished files are flushed to disk:
+                                    none, batched (in groups every fsync
+                                    interval), or strict (every file before
+                                    it's renamed into place). Files count as
+                                    converted for resuming only once flushed.
+                                    [default: none]
+    --encode-cache=DIR              Keep encoded audio in DIR, keyed by the
+                                    FLAC's audio MD5 and encoder settings, and
+                                    copy it instead of encoding identical
+                                    audio again (DIR may be shared).
+    --encode-cache-size=MB          Disk budget of the encode cache.
+                                    [default: 10240]
     -f FILE --flac-bin-path=FILE    Specify path to flac binary file.
                                     [default: /usr/local/bin/flac]
+    --folder-art                    Write album art to one folder.jpg per mp3
+                                    directory instead of embedding it (non-JPEG
+                                    pictures are recompressed as JPEG).
+    --fsync-interval=SECONDS        Seconds between fsync groups of batched
+                                    durability.
+                                    [default: 5]
+    --group-by=KEY                  Group query results by album, artist, or
+                                    track.
+                                    [default: album]
+    --keep-empty-dirs               Don't remove mp3 directories a run emptied
+                                    (or created and didn't fill).
     -l FILE --lame-bin-path=FILE    Specify path to lame (mp3) binary file.
                                     [default: /usr/local/bin/lame]
+    --link-duplicates               Encode FLACs with identical audio (same
+                                    STREAMINFO MD5) once per run. Outputs of
+                                    duplicates with identical tags become
+                                    hardlinks, others tagged copies.
+    --oggenc-bin-path=FILE          Specify path to oggenc (Ogg Vorbis) binary
+                                    file.
+                                    [default: /usr/local/bin/oggenc]
+    --on-delete=POLICY              mp3s to delete (orphaned, outdated or
+                                    corrupt): ask, delete, or keep them (and
+                                    skip converting their FLAC files). Other
+                                    files are converted while asking.
+                                    [default: ask]
+    --on-tag-warnings=POLICY        FLAC files with inconsistent tags or file
+                                    names: ask, convert, or skip them. Other
+                                    files are converted while asking.
+                                    [default: ask]
+    --opusenc-bin-path=FILE         Specify path to opusenc (Opus) binary file.
+                                    [default: /usr/local/bin/opusenc]
+    -p NUM --tag-processes=NUM      Read/write tags in a pool of NUM processes
+                                    instead of in the worker threads (0
+                                    disables the pool, "automatic" uses one
+                                    per CPU).
+                                    [default: 0]
+    --plan=FILE                     Only scan: write everything the run would
+                                    do to FILE as JSON (with encoding time and
+                                    output size estimates), show a summary,
+                                    and exit without changing any file.
+    --prefetch=NUM                  Read up to NUM queued FLAC files ahead of
+                                    the worker threads (for FLACs on network
+                                    storage, 0 disables).
+                                    [default: 0]
+    --prefetch-dir=DIR              Copy prefetched FLAC files into local DIR
+                                    instead of reading them into the page
+                                    cache.
+    --prefetch-size=MB              Budget of prefetched FLAC files.
+                                    [default: 512]
+    --profile=NAME                  Encoder profile of <mp3_dir>: v0, v2,
+                                    cbr128, cbr320, phone (mp3), opus64,
+                                    opus96, opus128 (Opus), vorbis-q3, or
+                                    vorbis-q6 (Ogg Vorbis).
+                                    [default: v0]
+    --reindex                       Read the tags of every FLAC file into the
+                                    index of the query command, not just of
+                                    the ones converted (once, for files
+                                    converted before the index existed).
+    --replaygain                    Measure loudness of the decoded audio while
+                                    encoding it and write ReplayGain 2.0 track
+                                    and album gain tags (needs NumPy). Album
+                                    gain is only written for FLAC directories
+                                    converted completely in one run.
+    --retries=NUM                   Queue a file which failed to convert again
+                                    up to NUM times, with growing delays.
+                                    Files failing every time are quarantined,
+                                    later runs skip them until they change.
+                                    [default: 2]
+    --run-plan=FILE                 Carry out a --plan FILE instead of scanning
+                                    again.
+    --scratch-dir=DIR               Write temporary wav and encoded files to
+                                    DIR (e.g. /dev/shm or a local SSD)
+                                    instead of next to the final files, which
+                                    are moved into place once complete.
+    --scratch-size=MB               Budget of temporary files in --scratch-dir,
+                                    conversions wait while it's used up.
+                                    [default: 2048]
+    --shard=I/N                     Only scan and convert the FLAC files of
+                                    shard I of N (1 to N), by a stable hash.
+                                    Run one host per shard, all sharing
+                                    <mp3_dir>.
+    --shard-by=KEY                  What the --shard hash is of: "album" (the
+                                    FLAC's directory, keeping albums
+                                    together) or "path" (each FLAC file).
+                                    [default: album]
+    --state-dir=DIR                 Directory of the job journal, an
+                                    interrupted run resumes from it.
+                                    [default: ~/.cache/convert_music]
     -t NUM --threads=NUM            Thread count.
                                     [default: automatic]
+    --target=DIR:PROFILE            Additional mp3 directory with its own
+                                    encoder profile, may be given several
+                                    times. Each FLAC is decoded once for all
+                                    directories needing it.
+    --timeout-factor=NUM            Kill a file's flac/encoder processes after
+                                    60 seconds plus NUM times the track's
+                                    duration (0 disables).
+                                    [default: 10]
+    --verify                        Test the FLAC files of <flac_dir> (MD5
+                                    signature) with flac -t in --threads
+                                    processes before converting. Corrupt files
+                                    are quarantined and not converted.
+    --verify-age=DAYS               Test files again once they were verified
+                                    this many days ago, unchanged files
+                                    verified since are skipped.
+                                    [default: 30]
+    --watch                         After converting, keep running and convert
+                                    FLAC files as they're written, moved or
+                                    deleted (inotify, Linux only).
+    --watch-delay=SECONDS           Convert a changed FLAC file once it wasn't
+                                    written to for this long.
+                                    [default: 5]
+    --where=FILTER                  Only query tracks matching FIELD=VALUE,
+                                    FIELD!=VALUE or FIELD~TEXT (contains),
+                                    ignoring case. Fields: artist, date,
+                                    album, discnumber, tracknumber, title,
+                                    has_picture, has_lyrics (true/false),
+                                    warnings, seconds, size. May be given
+                                    several times.
+    --worker=ADDRESS                Encode for the --coordinator at HOST:PORT
+                                    or Unix socket path, with --threads
+                                    threads, until it's done.
+    --write-buffer=MB               Budget of finished files in --scratch-dir
+                                    waiting for the --writers threads.
+                                    [default: 256]
+    --writers=NUM                   Move finished files from --scratch-dir to
+                                    their destination in NUM writer threads
+                                    (for slow destination media, 0 lets the
+                                    converting threads do it).
+                                    [default: 0]
     -y --ignore-lyrics              Ignore checks for missing lyric data.
 """
 
 from __future__ import division, print_function
 import Queue
+import base64
+import binascii
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import fcntl
 import fnmatch
+import hashlib
+import io
 import json
 import logging
 import logging.config
+import multiprocessing
+import operator
 import os
+import re
+import select
+import shutil
 import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
 import threading
@@ -34,12 +223,62 @@ import time
 from colorclass import Color
 from docopt import docopt
 from mutagen.easyid3 import EasyID3
-from mutagen.flac import FLAC, error as flac_error
-from mutagen.id3 import ID3, APIC, USLT, COMM, error as id3_error
+from mutagen.flac import FLAC, Picture, error as flac_error
+from mutagen.id3 import ID3, APIC, USLT, COMM, TXXX, error as id3_error
+from mutagen.ogg import error as ogg_error
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = '0.1.0'
 OPTIONS = docopt(__doc__) if __name__ == '__main__' else dict()
 PAD_COMMENT = 200  # Pad ID3 comment tag by this many spaces.
+PAD_COMMENT_LINK = 32  # Extra padding per hardlinked duplicate listed in the sync metadata.
+TAG_POOL_CHUNK_SIZE = 16  # Number of FLAC files sent to a tag pool process per round trip.
+FOLDER_ART_NAME = 'folder.jpg'  # Album art file written to each mp3 directory when not embedding art.
+FICLONE = 0x40049409  # Linux ioctl cloning a file's extents (reflink) on btrfs/XFS.
+PCM_CHUNK_SIZE = 256 * 1024  # Bytes of decoded audio read from flac and written to every encoder at a time.
+WRITE_CHUNK_SIZE = 8 * 1024 ** 2  # Bytes per write when the publisher copies files to slow destination media.
+TIMEOUT_BASE = 60  # Seconds a queue item may take on top of --timeout-factor times its duration.
+HEARTBEAT_SECONDS = 5  # Seconds between heartbeats of --worker processes, three missed ones lose the worker's jobs.
+RETRY_BACKOFF = 2  # Seconds before the first retry of a failed queue item, doubled for every further retry.
+CHUNK_WARMUP_FRAMES = 4  # Extra mp3 frames encoded (and dropped) around every segment of chunked encoding.
+REPLAYGAIN_REFERENCE = -18.0  # LUFS, tracks this loud get 0 dB of ReplayGain (ReplayGain 2.0).
+DEFAULT_SPEED = 20.0  # Seconds of audio encoded per thread and second assumed by --plan until a run measured it.
+THROUGHPUT_MIN_SECONDS = 600  # Runs converting less audio than this don't update the measured speed, too noisy.
+MUTATION_THREADS = 16  # Threads of Mutations(), each applying the operations of one directory at a time.
+K_WEIGHTING_SECONDS = 0.5  # Length of the K-weighting impulse response used by LoudnessMeter, 0.5 s decays to noise.
+MP3_BITRATES = (  # kbps of each bitrate index: MPEG-1 Layer III, MPEG-2/2.5 Layer III.
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+)
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}  # By version.
+SYNC_TAG = 'convert_music'  # Vorbis comment holding the sync metadata JSON in Ogg files (mp3s use the COMM tag).
+PROFILE_KBPS = {  # Typical average bitrate of each profile, for the output size estimates of --plan.
+    'v0': 245, 'v2': 190, 'cbr128': 128, 'cbr320': 320, 'phone': 64, 'opus64': 64, 'opus96': 96, 'opus128': 128,
+    'vorbis-q3': 112, 'vorbis-q6': 192,
+}
+ENCODER_PROFILES = {  # Encoder backend name and its arguments of each --profile/--target profile name.
+    'v0': ('mp3', ['-h', '-V0']),
+    'v2': ('mp3', ['-h', '-V2']),
+    'cbr128': ('mp3', ['-h', '--cbr', '-b', '128']),
+    'cbr320': ('mp3', ['-h', '--cbr', '-b', '320']),
+    'phone': ('mp3', ['--abr', '64', '--resample', '32']),
+    'opus64': ('opus', ['--bitrate', '64']),
+    'opus96': ('opus', ['--bitrate', '96']),
+    'opus128': ('opus', ['--bitrate', '128']),
+    'vorbis-q3': ('vorbis', ['-q', '3']),
+    'vorbis-q6': ('vorbis', ['-q', '6']),
+}
 
 
 class Song(object):
@@ -184,401 +423,4284 @@ def error(message, code=1):
 
 
 
-class ConvertFiles(threading.Thread):
-    """Threaded class that does the actual file conversion. This also copies over the id3 tags.
+def evict_lru(directory, budget, keep=None):
+    """Deletes the least recently used files (oldest mtime) in a cache directory until their total size is within
+    budget. Temporary .part files are left alone. The directory may be shared with other processes or machines.
 
-    Class variables are to be set before threads are started.
+    Positional arguments:
+    directory -- cache directory to clean up.
+    budget -- maximum total bytes of files in the directory.
 
-    Class variables:
-    flac_bin -- file path to the FLAC binary. It handles decompressing FLAC files to wav files.
-    lame_bin -- file path to the lame binary. It handles compressing wav files into mp3 files.
+    Keyword arguments:
+    keep -- path to never delete (the entry just added).
     """
-    flac_bin = ''
-    lame_bin = ''
+    entries = list()
+    for name in (n for n in os.listdir(directory) if not n.endswith('.part')):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue  # Evicted by another process.
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Evicted by another process.
+        total -= size
 
-    def __init__(self, queue):
+
+def clone_file(source_path, destination_path, chunk_size=1024 ** 2):
+    """Copies a file, as a reflink (sharing disk blocks) if the filesystem supports it."""
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(source, destination, chunk_size)
+
+
+def fsync_path(path):
+    """Flushes a file's or directory's data and metadata to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def move_file(source_path, destination_path, chunk_size=1024 ** 2, fsync=False):
+    """Renames a file. When it's on another filesystem (e.g. in the scratch directory) it's copied to a temporary file
+    next to the destination first, so only complete files ever appear under their final name.
+
+    The copy keeps the source's mtime like a rename does, the sync metadata written into the file recorded it. With
+    fsync the file's data is flushed to disk before it gets its final name.
+    """
+    if fsync and os.stat(source_path).st_dev == os.stat(os.path.dirname(destination_path)).st_dev:
+        fsync_path(source_path)
+    try:
+        os.rename(source_path, destination_path)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        temp_path = destination_path + '.part'
+        clone_file(source_path, temp_path, chunk_size)
+        shutil.copystat(source_path, temp_path)  # The sync metadata recorded the source's mtime.
+        if fsync:
+            fsync_path(temp_path)
+        os.rename(temp_path, destination_path)
+        os.remove(source_path)
+
+
+def write_json(path, document, **kwargs):
+    """Atomically writes a JSON document (keyword arguments are passed to json.dump()), readers never see a partial
+    file."""
+    temp_path = '{}.{}.part'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(document, f, **kwargs)
+    os.rename(temp_path, path)
+
+
+def decode_paths(value):
+    """Converts JSON strings (or lists of them) back into native strings (bytes on Python 2) so paths work as before."""
+    if isinstance(value, list):
+        return [decode_paths(v) for v in value]
+    if str is bytes and isinstance(value, type(u'')):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    return value
+
+
+def file_stat(path):
+    """Returns [mtime, size] of a file, None if it's gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [int(stat.st_mtime), int(stat.st_size)]
+
+
+class AlbumArtCache(object):
+    """Converts album art once per distinct picture and hands out the cached copy to every track that uses it.
+
+    Pictures are identified by a hash of their content and the conversion settings. Converted pictures are kept in
+    memory and optionally on disk, each store evicting its least recently used entries when over its byte budget. The
+    disk store may be shared by several processes (e.g. the tag pool), entries are written atomically.
+    """
+
+    def __init__(self, max_size=0, quality=90, memory_budget=32 * 1024 ** 2, cache_dir=None,
+                 disk_budget=256 * 1024 ** 2, folder_art=False):
         """
-        Positional arguments:
-        queue -- Queue.Queue() instance, items are 4-value tuples: ('flac_path', 'temp_wav', 'temp_mp3', 'final_mp3').
+        Keyword arguments:
+        max_size -- scale pictures down to fit within max_size x max_size pixels and recompress them as JPEG. Zero
+            embeds pictures as they are (still deduplicated).
+        quality -- JPEG quality used when recompressing.
+        memory_budget -- maximum bytes of converted pictures kept in memory.
+        cache_dir -- directory to keep converted pictures in between runs, None to disable.
+        disk_budget -- maximum bytes of converted pictures kept in cache_dir.
+        folder_art -- write one folder.jpg per mp3 directory instead of embedding pictures into each mp3.
         """
-        super(ConvertFiles, self).__init__()
-        self.queue = queue
+        self.max_size = max_size
+        self.quality = quality
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.disk_budget = disk_budget
+        self.folder_art = folder_art
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()  # {key: (mime, data)}, oldest first.
+        self.memory_bytes = 0
+        self.converting = dict()  # {key: threading.Lock()}, makes other threads wait instead of converting too.
+        self.folders_written = set()
+        self.stats = dict(hits=0, conversions=0)
 
-    def run(self):
-        """The main body of the thread. Loops until queue is empty."""
-        logger = logging.getLogger('ConvertFiles.run.{}'.format(self.name))
-        logging.debug('Worker thread started.')
-        while True:
+    def key(self, data):
+        """Returns the cache key of a picture's raw data."""
+        digest = hashlib.sha1(data)
+        digest.update('{}:{}'.format(self.max_size, self.quality).encode('ascii'))
+        return digest.hexdigest()
+
+    def convert(self, data, mime):
+        """Scales and recompresses a picture. Returns a 2-value tuple: (mime, data)."""
+        if not self.max_size:
+            return mime, data
+        image = Image.open(io.BytesIO(data))
+        if max(image.size) <= self.max_size and mime == 'image/jpeg':
+            return mime, data  # Already small enough, recompressing would only lose quality.
+        image.thumbnail((self.max_size, self.max_size), Image.ANTIALIAS)
+        output = io.BytesIO()
+        image.convert('RGB').save(output, 'JPEG', quality=self.quality, optimize=True)
+        if mime == 'image/jpeg' and output.tell() >= len(data):
+            return mime, data
+        return 'image/jpeg', output.getvalue()
+
+    def _remember(self, key, mime, data):
+        """Stores a converted picture in memory, evicting the least recently used ones. Lock must be held."""
+        self.memory[key] = (mime, data)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_budget and len(self.memory) > 1:
+            self.memory_bytes -= len(self.memory.popitem(last=False)[1][1])
+
+    def _disk_path(self, key, mime):
+        return os.path.join(self.cache_dir, key + ('.jpg' if mime == 'image/jpeg' else '.png'))
+
+    def _disk_get(self, key):
+        """Returns (mime, data) from the disk cache or None."""
+        for mime in ('image/jpeg', 'image/png'):
+            path = self._disk_path(key, mime)
             try:
-                source_flac_path, temp_wav_path, temp_mp3_path, destination_mp3_path = self.queue.get_nowait()
-            except Queue.Empty:
-                break
-            logging.debug('Source FLAC path: {}'.format(source_flac_path))
-            logging.debug('Temporary wav path: {}'.format(temp_wav_path))
-            logging.debug('Temporary mp3 path: {}'.format(temp_mp3_path))
-            logging.debug('Final mp3 path: {}'.format(destination_mp3_path))
-            self.convert(source_flac_path, temp_wav_path, temp_mp3_path)
-            self.write_tags(source_flac_path, temp_mp3_path)
-            os.rename(temp_mp3_path, destination_mp3_path)
-            logging.debug('Done converting this file.')
-        logging.debug('Worker thread exiting.')
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            os.utime(path, None)  # Mark as recently used.
+            return mime, data
+        return None
 
-    def convert(self, source_flac_path, temp_wav_path, temp_mp3_path):
-        """Converts the FLAC file into an mp3 file with a temporary filename."""
-        logger = logging.getLogger('ConvertFiles.convert.{}'.format(self.name))
-        # First decompress.
-        command = [self.flac_bin, '--silent', '--decode', '-o', temp_wav_path, source_flac_path]
-        logging.debug('Command: {}'.format(' '.join(command)))
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while process.poll() is None:
-            time.sleep(0.2)  # Wait for process to finish.
-        code = process.returncode
-        stdout, stderr = process.communicate()
-        logging.debug('code: {}; stdout: {}; stderr: {};'.format(code, stdout, stderr))
-        if code:
-            raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(self.flac_bin, code, stdout,
-                                                                                        stderr))
-        # Then compress.
-        command = [self.lame_bin, '--quiet', '-h', '-V0', temp_wav_path, temp_mp3_path]
-        logging.debug('Command: {}'.format(' '.join(command)))
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while process.poll() is None:
-            time.sleep(0.2)  # Wait for process to finish.
-        code = process.returncode
-        stdout, stderr = process.communicate()
-        logging.debug('code: {}; stdout: {}; stderr: {};'.format(code, stdout, stderr))
-        if code:
-            raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(self.lame_bin, code, stdout,
-                                                                                        stderr))
-        # Delete wav file by-product.
-        logging.debug('Removing: {}'.format(temp_wav_path))
-        os.remove(temp_wav_path)
+    def _disk_put(self, key, mime, data):
+        """Atomically writes a converted picture to the disk cache, evicting the least recently used ones."""
+        path = self._disk_path(key, mime)
+        temp_path = '{}.{}.part'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        evict_lru(self.cache_dir, self.disk_budget, path)
 
-    @staticmethod
-    def write_tags(source_flac_path, temp_mp3_path):
-        """Write mp3 id3 tags from tags available in the FLAC file. Also save metadata as JSON to mp3 comment tag."""
-        # Copy non-picture/non-lyric tags from FLAC to mp3.
-        tags, id3 = FLAC(source_flac_path), EasyID3(temp_mp3_path)
-        for tag in (t for t in tags if t in EasyID3.valid_keys.keys()):
-            id3[tag] = tags[tag]
-        id3.save(v1=2)
-        # Copy pictures/lyrics from FLAC to mp3.
-        id3 = ID3(temp_mp3_path)
-        id3.add(COMM(encoding=3, lang='eng', desc='', text=(' ' * 200)))  # Pad ID3 tag to keep final size the same.
-        if tags.pictures:
-            pic = tags.pictures[0]
-            id3.add(APIC(encoding=0, mime=pic.mime, type=int(pic.type), desc=pic.desc, data=pic.data))
-        if 'unsyncedlyrics' in tags:
-            id3.add(USLT(encoding=0, lang='eng', desc='Lyrics', text=unicode(tags['unsyncedlyrics'][0])))
-        id3.save(v1=2)
-        # Save metadata to id3 comments tag.
-        flac_stat, mp3_stat = os.stat(source_flac_path), os.stat(temp_mp3_path)
-        comment = json.dumps(dict(
-            flac_mtime=int(flac_stat.st_mtime), flac_size=int(flac_stat.st_size),
-            mp3_mtime=int(mp3_stat.st_mtime), mp3_size=int(mp3_stat.st_size)
-        ))
-        id3.add(COMM(encoding=3, lang='eng', desc='', text=comment))
-        id3.save(v1=2)
+    def get(self, data, mime):
+        """Returns the converted version of a picture as a 2-value tuple: (mime, data). Converts at most once.
 
+        Positional arguments:
+        data -- raw picture bytes from the FLAC file.
+        mime -- mime type of the raw picture.
+        """
+        key = self.key(data)
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = self.memory.pop(key)  # Mark as recently used.
+                self.stats['hits'] += 1
+                return self.memory[key]
+            key_lock = self.converting.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.memory:  # Another thread converted it while this one waited.
+                    self.stats['hits'] += 1
+                    return self.memory[key]
+            cached = self._disk_get(key) if self.cache_dir else None
+            if cached:
+                converted = cached
+            else:
+                converted = self.convert(data, mime)
+                if self.cache_dir:
+                    self._disk_put(key, converted[0], converted[1])
+            with self.lock:
+                self.stats['hits' if cached else 'conversions'] += 1
+                self._remember(key, converted[0], converted[1])
+                self.converting.pop(key, None)
+        return converted
 
-def find_files(flac_dir, mp3_dir):
-    """Finds FLAC and mp3 files. Returns a tuple of different data (refer to Returns section in this docstring).
-    FLAC files that don't need converting (and mp3 files that don't need deleting) are omitted. Metadata is stored in
-    mp3 file id3 tags under "comments". This function uses that metadata to determine which files do what.
+    def write_folder_art(self, directory, data, mime):
+        """Writes a picture to folder.jpg in a directory (recompressed as JPEG if it's not one), unless an identical one
+        is already there."""
+        path = os.path.join(directory, FOLDER_ART_NAME)
+        with self.lock:
+            if directory in self.folders_written:
+                return
+            self.folders_written.add(directory)
+        if mime != 'image/jpeg':
+            output = io.BytesIO()
+            Image.open(io.BytesIO(data)).convert('RGB').save(output, 'JPEG', quality=self.quality, optimize=True)
+            data = output.getvalue()
+        if os.path.isfile(path) and os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return
+        temp_path = '{}.{}.part'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
 
-    Positional arguments:
-    flac_dir -- parent directory string which holds source FLAC files.
-    mp3_dir -- parent directory string which holds destination mp3 files.
 
-    Returns (tuple):
-    flac_files -- dictionary of FLAC file paths (keys) and 2-value lists (values), [file mtime, file byte size].
-    delete_mp3s -- list of mp3 files to be deleted.
-    create_dirs -- list of directories that need to be created in the destination parent directory for future mp3s.
-    foreign_files -- list of non-mp3 files in the mp3 directory which interfere with find_empty_dirs().
+class EncodeCache(object):
+    """Content-addressed cache of encoded audio, shared between runs, libraries, and (on a network share) machines.
+
+    Entries are keyed by the FLAC's STREAMINFO audio MD5 plus a fingerprint of the encoder (backend, arguments, and
+    the binary's version output), so a restored or copied FLAC is never encoded twice with the same settings. Entries
+    hold untagged audio, tags are always written fresh from the FLAC. The least recently used entries are evicted when
+    the directory is over its byte budget.
     """
-    flac_files = dict()  # {/file/path.flac: [mtime, bytesize]}
-    delete_mp3s = list()  # List of mp3 file paths to be deleted.
-    create_dirs = list()  # Directories to be created in mp3_dir.
 
-    # First find every single FLAC file and store it in the flac_files dictionary.
-    for root, _, files in os.walk(flac_dir):
-        for path in (os.path.join(root, filename) for filename in fnmatch.filter(files, '*.flac')):
-            stat = os.stat(path)
-            flac_files[path] = [int(stat.st_mtime), int(stat.st_size)]
-    if not flac_files:
-        # No FLAC files found at all, wrong directory maybe.
-        raise IOError
+    def __init__(self, cache_dir, budget):
+        """
+        Positional arguments:
+        cache_dir -- directory holding cache entries.
+        budget -- maximum total bytes of entries in cache_dir.
+        """
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.fingerprints = dict()  # {profile: hex digest}
+        self.stats = dict(hits=0, misses=0, stored=0)
 
-    # Find every single mp3, and decide its fate with its own metadata.
-    for path in (os.path.join(r, f) for r, _, fl in os.walk(mp3_dir) for f in fnmatch.filter(fl, '*.mp3')):
-        flac_equivalent = path.replace(mp3_dir, flac_dir).replace('.mp3', '.flac')
-        if flac_equivalent not in flac_files:
-            # The FLAC file this mp3 file was previously converted from has been moved or deleted. Delete this mp3.
-            delete_mp3s.append(path)
-            continue
+    def fingerprint(self, profile):
+        """Returns the fingerprint of a profile's encoder, asking the binary for its version once per run."""
+        with self.lock:
+            if profile in self.fingerprints:
+                return self.fingerprints[profile]
+        encoder_name, arguments = ENCODER_PROFILES[profile]
+        binary = getattr(ConvertFiles, ENCODERS[encoder_name].binary_attribute)
         try:
-            metadata = json.loads(getattr(ID3(path).get("COMM::'eng'"), 'text', [None])[0])
-        except (TypeError, ValueError):
-            # The mp3 file is corrupt. Something happened to it after this script created it in the past.
-            delete_mp3s.append(path)
-            continue
-        stat = os.stat(path)
-        metadata_expected = dict(
-            flac_mtime=flac_files[flac_equivalent][0], flac_size=flac_files[flac_equivalent][1],
-            mp3_mtime=int(stat.st_mtime), mp3_size=int(stat.st_size)
-        )
-        if metadata != metadata_expected:
-            # Something has changed with either files.
-            delete_mp3s.append(path)
-            continue
-        # Made it this far. That means nothing has changed with the mp3 or FLAC. Removing FLAC from "convert me" list.
-        flac_files.pop(flac_equivalent)
-
-    # Find non-mp3 files in the mp3 directory.
-    foreign_files = sorted([os.path.join(r, f) for r, _, fl in os.walk(mp3_dir) for f in fl if not f.endswith('.mp3')])
+            version = subprocess.Popen([binary, '--version'], stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT).communicate()[0]
+        except OSError:
+            version = b''
+        digest = hashlib.sha1(json.dumps([encoder_name, arguments]).encode('utf-8'))
+        digest.update(version)
+        with self.lock:
+            self.fingerprints[profile] = digest.hexdigest()
+        return self.fingerprints[profile]
 
-    # Figure out which directories should be created.
-    for directory in {os.path.dirname(f.replace(flac_dir, mp3_dir)) for f in flac_files}:
-        if not os.path.exists(directory):
-            create_dirs.append(directory)
-    create_dirs.sort()
-    return flac_files, delete_mp3s, create_dirs, foreign_files
+    def path(self, source_flac_path, profile):
+        """Returns the cache entry path of a FLAC file encoded with a profile, or None if the FLAC has no audio MD5."""
+        md5 = read_streaminfo_md5(source_flac_path)
+        if not md5:
+            return None
+        name = '{}-{}{}'.format(md5, self.fingerprint(profile), ENCODERS[ENCODER_PROFILES[profile][0]].extension)
+        return os.path.join(self.cache_dir, name)
 
+    def fetch(self, source_flac_path, profile, temp_path):
+        """Copies (reflinks if possible) a cached entry to temp_path. Returns True on a hit."""
+        path = self.path(source_flac_path, profile)
+        try:
+            os.utime(path, None)  # Mark as recently used.
+            clone_file(path, temp_path)
+        except (IOError, OSError, TypeError):
+            with self.lock:
+                self.stats['misses'] += 1
+            return False
+        with self.lock:
+            self.stats['hits'] += 1
+        return True
 
-def find_inconsistent_tags(flac_filepaths, ignore_art=False, ignore_lyrics=False):
-    """Look for missing data in FLAC 'id3' tags or tags that don't match the filename.
+    def store(self, source_flac_path, profile, temp_path):
+        """Adds freshly encoded (still untagged) audio to the cache."""
+        path = self.path(source_flac_path, profile)
+        if not path:
+            return
+        part_path = '{}.{}.{}.part'.format(path, os.getpid(), threading.current_thread().ident)
+        clone_file(temp_path, part_path)
+        os.rename(part_path, path)
+        with self.lock:
+            self.stats['stored'] += 1
+        evict_lru(self.cache_dir, self.budget, path)
 
-    Positional arguments:
-    flac_filepaths -- list of FLAC file paths to read metadata from.
 
-    Keyword arguments:
-    ignore_art -- ignore checking if FLAC file has album art embedded in it, boolean.
-    ignore_lyrics -- ignore checking if FLAC file has lyrics embedded in it, boolean.
+class ScratchSpace(object):
+    """Byte budget of the directory holding temporary wav/encoded files, e.g. a tmpfs like /dev/shm.
 
-    Returns:
-    Dictionary with keys being FLAC file paths and values being a list of warnings to be printed about id3 tags.
+    Every worker thread reserves its queue item's estimated scratch usage before converting it and waits while the
+    budget is used up by other threads. A thread may always proceed when nothing else is reserved, so a single file
+    larger than the budget doesn't block the run.
     """
-    tag_names = ['artist', 'date', 'album', 'tracknumber', 'title']
-    messages = {p: [] for p in flac_filepaths}
-    for path in flac_filepaths:
-        # Verify filename.
-        split = os.path.splitext(os.path.basename(path))[0].split(' - ')
-        if len(split) != 5:
-            messages[path].append("Filename doesn't have five items.")
-            continue
-        f_artist, f_date, f_album, f_track, f_title = split
-        # Verify basic tags.
-        try:
-            tags = FLAC(path)
-        except flac_error:
-            messages[path].append('Invalid file.')
-            continue
-        t_artist, t_date, t_album, t_track, t_title = [tags.get(i, [''])[0] for i in tag_names]
-        if f_artist != t_artist:
-            messages[path].append('Artist mismatch: {} != {}'.format(f_artist, t_artist))
-        if f_album != t_album:
-            messages[path].append('Album mismatch: {} != {}'.format(f_album, t_album))
-        if f_title != t_title:
-            messages[path].append('Title mismatch: {} != {}'.format(f_title, t_title))
-        # Verify numeric tags.
-        if not f_date.isdigit():
-            messages[path].append('Filename date not a number.')
-        elif len(f_date) != 4:
-            messages[path].append('Filename date not four digits.')
-        elif f_date != t_date:
-            messages[path].append('Date mismatch: {} != {}'.format(f_date, t_date))
-        if not f_track.isdigit():
-            messages[path].append('Filename track number not a number.')
-        elif len(f_track) != 2:
-            messages[path].append('Filename track number not two digits.')
-        elif f_track != t_track:
-            messages[path].append('Track number mismatch: {} != {}'.format(f_track, t_track))
-        # Check for lyrics and album art.
-        if not ignore_art and not tags.pictures:
-            messages[path].append('No album art.')
-        if not ignore_lyrics and not tags.get('unsyncedlyrics', [False])[0]:
-            messages[path].append('No lyrics.')
-    # Return dict of messages without empty lists.
-    return {k: v for k, v in messages.items() if v}
 
+    def __init__(self, budget):
+        """
+        Positional arguments:
+        budget -- maximum bytes reserved at once.
+        """
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.reserved = dict()  # Thread name (key), bytes reserved by it (value).
+        self.stats = dict(peak=0, waits=0)
 
-def find_empty_dirs(parent_dir):
-    """Returns a list of directories that are empty or contain empty directories.
+    @staticmethod
+    def estimate(source_flac_path, outputs, duplicates):
+        """Returns the estimated scratch bytes of a queue item: the decoded wav (only written for single output
+        items, several outputs are streamed) plus at most the FLAC's size for every encoded output."""
+        outputs_count = len(outputs) + sum(len(d[1]) for d in duplicates)
+        size = os.path.getsize(source_flac_path) * outputs_count
+        if len(outputs) == 1:
+            try:
+                info = FLAC(source_flac_path).info
+            except (flac_error, IOError):
+                return size
+            size += info.total_samples * info.channels * info.bits_per_sample // 8 + 44  # Plus the wav header.
+        return size
 
-    Positional arguments:
-    parent_dir -- parent directory string to search.
+    def reserve(self, size, stopping=None):
+        """Reserves bytes for the calling thread, waiting until they fit in the budget.
 
-    Returns:
-    List of empty directories or directories that contain empty directories. Remove in order for successful execution.
-    """
-    dirs_to_remove = {r: bool(f) for r, d, f in os.walk(parent_dir)}  # First get all dirs available.
-    dirs_to_remove.pop(parent_dir, None)  # If parent_dir is empty don't include it, just focus on subdirectories.
-    for directory in sorted(dirs_to_remove.keys(), reverse=True):
-        does_dir_have_files = dirs_to_remove.get(directory, False)  # Skip if dir has already been removed from dict.
-        if not does_dir_have_files:
-            continue
-        # Directory has files. Remove entire directory tree from dirs_to_remove.
-        dirs_to_remove.pop(directory)
-        while directory != parent_dir:
-            directory = os.path.split(directory)[0]
-            dirs_to_remove.pop(directory, None)
-    return sorted(dirs_to_remove, reverse=True)
+        Positional arguments:
+        size -- bytes to reserve.
 
+        Keyword arguments:
+        stopping -- optional threading.Event(), gives up waiting when it's set.
 
-def main():
+        Returns:
+        True when reserved, False when stopping.
+        """
+        name = threading.current_thread().name
+        with self.condition:
+            if self.reserved and sum(self.reserved.values()) + size > self.budget:
+                self.stats['waits'] += 1
+            while self.reserved and sum(self.reserved.values()) + size > self.budget:
+                if stopping is not None and stopping.is_set():
+                    return False
+                self.condition.wait(1)
+            self.reserved[name] = self.reserved.get(name, 0) + size
+            self.stats['peak'] = max(self.stats['peak'], sum(self.reserved.values()))
+        return True
 
-    logging.info('Finding files and verifying tags...')
-    try:
-        flac_files, delete_mp3s, create_dirs, foreign_files = find_files(OPTIONS['flac_dir'], OPTIONS['mp3_dir'])
-    except IOError:
-        logging.error('No FLAC files found in directory {}'.format(OPTIONS['flac_dir']))
-        sys.exit(1)
-    tag_warnings = find_inconsistent_tags(flac_files.keys(), OPTIONS['ignore_art'], OPTIONS['ignore_lyrics'])
-    logging.info('; '.join([
-        '{} new FLAC {}'.format(len(flac_files), 'file' if len(flac_files) == 1 else 'files'),
-        '{} new {}'.format(len(create_dirs), 'directory' if len(create_dirs) == 1 else 'directories'),
-        '{} FLAC {}'.format(len(tag_warnings), 'warning' if len(tag_warnings) == 1 else 'warnings'),
-        '{} {} to delete'.format(len(delete_mp3s), 'mp3' if len(delete_mp3s) == 1 else 'mp3s'),
-    ]))
+    def release(self):
+        """Releases everything the calling thread reserved and wakes up waiting threads."""
+        with self.condition:
+            self.reserved.pop(threading.current_thread().name, None)
+            self.condition.notify_all()
 
-    # Delete mp3s with user's permission.
-    if delete_mp3s:
-        logging.info(Color('{yellow}The following files need to be deleted:{/yellow}'))
-        for path in delete_mp3s:
-            logging.info(path)
-        raw_input(Color('{b}Press Enter to delete these files.{/b}'))
-        for path in delete_mp3s:
-            os.remove(path)
 
-    # Notify user of foreign files in mp3 directory.
-    if foreign_files:
-        logging.info('{yellow}The following non-mp3 files were found:{/yellow}')
-        for path in foreign_files:
-            logging.info(path)
-        raw_input(Color('{b}Press Enter to continue anyway.{/b}'))
+class Durability(object):
+    """Decides when finished files are flushed to disk and when their queue items count as completed.
 
-    # Notify user of inconsistencies in FLAC id3 tags and file names.
-    if tag_warnings:
-        logging.info(Color('{yellow}The following inconsistencies have been found in id3 tags/file names:{/yellow}'))
-        printed_before = False
-        for path, warnings in tag_warnings.items():
-            if len(warnings) == 1:
-                printed_before = True
-                logging.info('{}: {}'.format(os.path.basename(path), warnings[0]))
-            else:
-                if printed_before:
-                    print()
-                    printed_before = False
-                logging.info('{}:'.format(os.path.basename(path)))
-                for warning in warnings:
-                    logging.info(warning)
-                print()
-        raw_input(Color('{b}Press Enter to continue anyway.{/b}'))
+    Modes:
+    none -- no fsync, queue items complete as soon as their files are renamed into place.
+    batched -- files and their directories are fsync()ed in groups, at most `interval` seconds apart; queue items
+        complete (journal "done" records) only after the fsync of their group.
+    strict -- every file is fsync()ed before getting its final name and its directory right after.
+    """
 
-    # Create directories.
-    for directory in create_dirs:
-        os.makedirs(directory)
+    MODES = ('none', 'batched', 'strict')
 
-    # Prepare for conversion.
-    ConvertFiles.flac_bin = OPTIONS['flac_bin']
-    ConvertFiles.lame_bin = OPTIONS['lame_bin']
-    queue = Queue.Queue()
-    for flac_file in flac_files:
-        mp3_file = flac_file.replace(OPTIONS['flac_dir'], OPTIONS['mp3_dir'])  # Change directories from flac to mp3 dir.
-        temp_wav_file = os.path.splitext(mp3_file)[0] + '.wav.part'  # Temporary file while converting (FLAC -> wav).
-        temp_mp3_file = os.path.splitext(mp3_file)[0] + '.mp3.part'  # Temporary file while converting (wav -> mp3).
-        final_mp3_file = os.path.splitext(mp3_file)[0] + '.mp3'  # Final mp3 filename.
-        queue.put((flac_file, temp_wav_file, temp_mp3_file, final_mp3_file))
+    def __init__(self, mode='none', interval=5.0, journal=None):
+        """
+        Keyword arguments:
+        mode -- one of MODES.
+        interval -- seconds between fsync batches in batched mode.
+        journal -- optional Journal() instance, fsync()ed after the completion callbacks of a group.
+        """
+        self.mode = mode
+        self.interval = interval
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.paths = list()
+        self.callbacks = list()
+        self.last_checkpoint = time.time()
+        self.stats = dict(fsyncs=0, checkpoints=0)
 
-    # Start the conversion.
-    total = len(flac_files)
-    count = total
-    logging.info('Converting {} file{}:'.format(total, '' if total == 1 else 's'))
-    threads = []
-    for i in range(OPTIONS['threads']):
-        thread = ConvertFiles(queue)
-        thread.daemon = True  # Fixes script hang on ctrl+c.
-        thread.start()
-        threads.append(thread)
+    def commit(self, paths, callback=None):
+        """Called once a queue item's files have their final names.
 
-    # Wait for everything to finish.
-    while count:
-        if not OPTIONS['quiet']:
-            sys.stdout.write('{}/{} ({:02d}%) files remaining...\r'.format(count, total, count / total))
-            sys.stdout.flush()
-        time.sleep(1)
-        count = queue.qsize() + len([True for t in threads if t.is_alive()])
-        # Look for threads that crashed.
-        if len([t for t in threads if t.is_alive()]) < OPTIONS['threads']:
-            # One or more thread isn't running.
-            if queue.qsize():
-                # But the queue isn't empty, something bad happened.
-                raise RuntimeError('Worker thread(s) prematurely terminated.')
+        Positional arguments:
+        paths -- list of final file paths.
 
-    # Done, now clean up empty directories.
-    empty_dirs = find_empty_dirs(OPTIONS['mp3_dir'])
-    if empty_dirs:
-        logging.info(Color('{yellow}The following empty directories were found:{/yellow}'))
-        for path in empty_dirs:
-            logging.info(path)
-        raw_input(Color('{b}Press Enter to delete these directories.{/b}'))
-        for path in delete_mp3s:
-            os.rmdir(path)
+        Keyword arguments:
+        callback -- optional function marking the queue item as completed, called once the files are durable.
+        """
+        if self.mode == 'none':
+            if callback:
+                callback()
+            return
+        if self.mode == 'strict':
+            self.sync(sorted({os.path.dirname(p) for p in paths}), [callback] if callback else [])  # Files synced.
+            return
+        with self.lock:
+            self.paths.extend(paths)
+            if callback:
+                self.callbacks.append(callback)
+            due = time.time() - self.last_checkpoint >= self.interval
+        if due:
+            self.checkpoint()
 
+    def checkpoint(self):
+        """Flushes the pending group of files and completes their queue items."""
+        with self.lock:
+            paths, callbacks = self.paths, self.callbacks
+            self.paths, self.callbacks = list(), list()
+            self.last_checkpoint = time.time()
+        if paths or callbacks:
+            self.sync(paths + sorted({os.path.dirname(p) for p in paths}), callbacks)
 
-def validate_options():
-    """Re-formats dict from docopt and does some sanity checks on it.
+    def sync(self, paths, callbacks):
+        """fsync()s paths, then calls the callbacks and flushes the journal."""
+        for path in paths:
+            fsync_path(path)
+        for callback in callbacks:
+            callback()
+        if self.journal and callbacks:
+            self.journal.sync()
+        with self.lock:
+            self.stats['fsyncs'] += len(paths)
+            self.stats['checkpoints'] += 1
 
-    Positional arguments:
-    OPTIONS -- dictionary from docopt.docopt().
 
-    Returns:
-    Dictionary similar to OPTIONS but only relevant data without CLI notation.
+class Publisher(object):
+    """Write-behind stage moving finished files from the scratch directory to slow destination media (SD cards, USB
+    sticks) in a few writer threads, with large sequential writes and atomic renames.
+
+    Worker threads submit a queue item's finished files and go on encoding; they only block while the files waiting
+    to be written exceed the buffer budget. These files stay in the scratch directory until written, on top of its
+    own budget.
     """
-    logger = logging.getLogger('%s.parse_n_check' % __name__)
-    config = dict(
-        flac_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--flac-bin-path'))),
-        lame_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--lame-bin-path'))),
-        ignore_art=bool(OPTIONS.get('--ignore-art')),
-        ignore_lyrics=bool(OPTIONS.get('--ignore-lyrics')),
-        threads=OPTIONS.get('--threads'),
-        flac_dir=os.path.abspath(os.path.expanduser(OPTIONS.get('<flac_dir>'))),
-        mp3_dir=os.path.abspath(os.path.expanduser(OPTIONS.get('<mp3_dir>'))),
-        quiet=False,
-    )
-    # Sanity checks.
-    if OPTIONS['threads'] == 'automatic':
-        OPTIONS['threads'] = os.sysconf('SC_NPROCESSORS_ONLN') or 1
-    elif not isinstance(OPTIONS['threads'], int) or not OPTIONS['threads']:
-        logging.error('--threads is not an integer or is zero: {}'.format(OPTIONS['threads']))
-        raise ValueError
-    if not os.path.isfile(OPTIONS['flac_bin']):
-        logging.error('--flac-bin-path is not a file or does not exist: {}'.format(OPTIONS['flac_bin']))
-        raise ValueError
-    if not os.access(OPTIONS['flac_bin'], os.R_OK | os.X_OK):
-        logging.error('--flac-bin-path is not readable or no execute permissions: {}'.format(OPTIONS['flac_bin']))
-        raise ValueError
-    if not os.path.isfile(OPTIONS['lame_bin']):
-        logging.error('--lame-bin-path is not a file or does not exist: {}'.format(OPTIONS['lame_bin']))
-        raise ValueError
-    if not os.access(OPTIONS['lame_bin'], os.R_OK | os.X_OK):
-        logging.error('--lame-bin-path is not readable or no execute permissions: {}'.format(OPTIONS['lame_bin']))
-        raise ValueError
-    if not os.path.isdir(OPTIONS['flac_dir']):
-        logging.error('<flac_dir> is not a directory or does not exist: {}'.format(OPTIONS['flac_dir']))
+
+    def __init__(self, writers, budget, stopping=None, fsync=False):
+        """
+        Positional arguments:
+        writers -- number of writer threads.
+        budget -- maximum bytes of submitted files not yet written.
+
+        Keyword arguments:
+        stopping -- optional threading.Event(), submitted files aren't written anymore once it's set.
+        fsync -- flush every file to disk before renaming it into place.
+        """
+        self.budget = budget
+        self.fsync = fsync
+        self.stopping = stopping or threading.Event()
+        self.queue = Queue.Queue()
+        self.condition = threading.Condition()
+        self.buffered = 0
+        self.error = None
+        self.stats = dict(published=0, bytes=0, waits=0)
+        self.threads = [threading.Thread(target=self.run) for _ in range(writers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, moves, callback=None):
+        """Hands files over to the writer threads, waiting while the buffer budget is used up.
+
+        Positional arguments:
+        moves -- list of 2-value tuples: ('temp path', 'final path'). Written in this order.
+
+        Keyword arguments:
+        callback -- optional function called by the writer thread once all files are in place.
+        """
+        size = sum(os.path.getsize(t) for t, _ in moves)
+        with self.condition:
+            if self.buffered and self.buffered + size > self.budget:
+                self.stats['waits'] += 1
+            while self.buffered and self.buffered + size > self.budget and not self.error:
+                self.condition.wait(1)
+            if self.error:
+                raise self.error
+            self.buffered += size
+        self.queue.put((moves, callback, size))
+
+    def run(self):
+        """The main body of writer threads."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            moves, callback, size = item
+            try:
+                if not self.stopping.is_set():
+                    for temp_path, final_path in moves:
+                        move_file(temp_path, final_path, WRITE_CHUNK_SIZE, self.fsync)
+                    if callback:
+                        callback()
+            except Exception as exc:
+                logging.exception('Writing {} failed.'.format(moves[0][1]))
+                with self.condition:
+                    self.error = self.error or exc
+            finally:
+                with self.condition:
+                    self.buffered -= size
+                    self.stats['published'] += len(moves)
+                    self.stats['bytes'] += size
+                    self.condition.notify_all()
+
+    def close(self):
+        """Waits for all submitted files to be written. Raises the first error of a writer thread."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise self.error
+
+
+class Prefetcher(threading.Thread):
+    """Reads FLAC files ahead of the worker threads, so decoding never waits on slow (network) storage.
+
+    Walks the queue in order, staying at most `depth` files ahead of the workers and within a byte budget. Files are
+    either copied into a local directory, or read once so they're in the page cache (with posix_fadvise() where
+    available: WILLNEED ahead, DONTNEED once converted).
+    """
+
+    def __init__(self, flac_paths, depth, budget, cache_dir=None, stopping=None):
+        """
+        Positional arguments:
+        flac_paths -- FLAC files in queue order.
+        depth -- maximum number of files prefetched but not yet taken by a worker.
+        budget -- maximum bytes of prefetched files held at once.
+
+        Keyword arguments:
+        cache_dir -- copy files into this local directory instead of reading them into the page cache.
+        stopping -- optional threading.Event(), stops prefetching when set.
+        """
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self.flac_paths = list(flac_paths)
+        self.depth = depth
+        self.budget = budget
+        self.cache_dir = cache_dir
+        self.stopping = stopping or threading.Event()
+        self.condition = threading.Condition()
+        self.ready = dict()  # FLAC path (key), 2-value tuple (value): ('path to decode' or None if failed, size).
+        self.taken = set()
+        self.loading = None
+        self.started = 0
+        self.used = 0
+        self.stats = dict(prefetched=0, waits=0, misses=0)
+
+    def run(self):
+        """Prefetches files until all are done or stopping."""
+        for flac_path in self.flac_paths:
+            try:
+                size = os.path.getsize(flac_path)
+            except OSError:
+                size = 0
+            with self.condition:
+                while not self.stopping.is_set() and (self.started - len(self.taken) >= self.depth or
+                                                      (self.used and self.used + size > self.budget)):
+                    self.condition.wait(1)
+                if self.stopping.is_set():
+                    return
+                self.started += 1
+                if flac_path in self.taken:
+                    continue  # A worker got there first.
+                self.loading = flac_path
+                self.used += size
+            try:
+                local_path = self.fetch(flac_path)
+            except (IOError, OSError):
+                local_path = None  # Let the decoder report it.
+            with self.condition:
+                self.ready[flac_path] = (local_path, size)
+                self.loading = None
+                self.stats['prefetched'] += 1
+                self.condition.notify_all()
+
+    def fetch(self, flac_path):
+        """Copies or reads one file. Returns the path to decode."""
+        if self.cache_dir:
+            key = flac_path if isinstance(flac_path, bytes) else flac_path.encode('utf-8')
+            local_path = os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest()[:20] + '.flac')
+            clone_file(flac_path, local_path + '.part')
+            os.rename(local_path + '.part', local_path)
+            return local_path
+        with open(flac_path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.read(PCM_CHUNK_SIZE):
+                pass
+        return flac_path
+
+    def acquire(self, flac_path):
+        """Called by a worker before converting a file. Waits if it's being prefetched. Returns the path to decode."""
+        with self.condition:
+            self.taken.add(flac_path)
+            self.condition.notify_all()
+            if self.loading == flac_path:
+                self.stats['waits'] += 1
+            while self.loading == flac_path:
+                self.condition.wait(1)
+            if flac_path not in self.ready:
+                self.stats['misses'] += 1
+                return flac_path
+            return self.ready[flac_path][0] or flac_path
+
+    def release(self, flac_path):
+        """Called by a worker after converting a file. Frees its share of the budget."""
+        with self.condition:
+            local_path, size = self.ready.pop(flac_path, (None, 0))
+            self.used -= size
+            self.condition.notify_all()
+        if local_path is None:
+            return
+        if self.cache_dir:
+            if os.path.dirname(local_path) == self.cache_dir:  # Never the source FLAC.
+                os.remove(local_path)
+        elif hasattr(os, 'posix_fadvise'):
+            with open(local_path, 'rb') as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class Journal(object):
+    """Append-only JSON lines file recording a run's plan and every completed FLAC file, so a run interrupted by
+    Control+C, the OOM killer, or a power cut resumes its remaining queue right away instead of scanning again.
+
+    Records are {"event": "plan", ...} (written once, starts a new journal), {"event": "add", "jobs": [...]} for queue
+    items accepted in review later, {"event": "done", "flac": path} per completed queue item. A torn last line from a
+    crash is ignored. The file is deleted when the run finishes.
+    """
+
+    def __init__(self, path):
+        """
+        Positional arguments:
+        path -- journal file path.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.handle = None
+
+    @staticmethod
+    def name(flac_dir, targets, shard=None):
+        """Returns the journal file name of a set of directories, runs over other directories (or shards) don't share
+        it."""
+        key = [flac_dir, targets] + ([list(shard)] if shard else [])
+        return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:16] + '.journal'
+
+    def resume(self, flac_dir, targets):
+        """Reads an interrupted run's journal. Returns its queue items which didn't complete, or None if there is no
+        journal for these directories."""
+        plan, done = None, set()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write.
+                    if record.get('event') == 'plan':
+                        plan, done = record, set()
+                    elif record.get('event') == 'add' and plan:
+                        plan['jobs'].extend(record['jobs'])
+                    elif record.get('event') == 'done':
+                        done.add(decode_paths(record['flac']))
+        except IOError:
+            return None
+        if not plan or decode_paths([plan['flac_dir']] + plan['targets']) != [flac_dir] + [list(t) for t in targets]:
+            return None
+        self.handle = open(self.path, 'a')
+        return [tuple(j) for j in decode_paths(plan['jobs']) if j[0] not in done]
+
+    def write(self, record):
+        """Appends one record and flushes it to the OS."""
+        with self.lock:
+            self.handle.write(json.dumps(record) + '\n')
+            self.handle.flush()
+
+    def write_plan(self, flac_dir, targets, jobs):
+        """Starts a new journal with the run's plan."""
+        self.handle = open(self.path, 'w')
+        self.write(dict(event='plan', flac_dir=flac_dir, targets=targets, jobs=jobs))
+
+    def add(self, jobs):
+        """Adds queue items to the plan."""
+        self.write(dict(event='add', jobs=jobs))
+
+    def done(self, flac_path):
+        """Records a completed queue item (all its outputs renamed into place)."""
+        self.write(dict(event='done', flac=flac_path))
+
+    def sync(self):
+        """Flushes the journal to disk."""
+        with self.lock:
+            os.fsync(self.handle.fileno())
+
+    def finish(self):
+        """Deletes the journal, the run completed."""
+        with self.lock:
+            self.handle.close()
+            os.remove(self.path)
+
+
+class Quarantine(object):
+    """FLAC files which failed to convert repeatedly. Later runs skip them until they change (mtime or size).
+
+    Stored as a JSON object in the state directory: {"flac path": [mtime, size, "last error"]}.
+    """
+
+    def __init__(self, path):
+        """
+        Positional arguments:
+        path -- JSON file path, doesn't have to exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = dict((decode_paths(k), v) for k, v in json.load(f).items())
+        except (IOError, ValueError):
+            self.entries = dict()
+
+    def contains(self, flac_path):
+        """Returns True if the file is quarantined and hasn't changed since."""
+        entry = self.entries.get(flac_path)
+        return bool(entry) and entry[:2] == file_stat(flac_path)
+
+    def add(self, flac_path, message):
+        """Quarantines a file and saves the list."""
+        with self.lock:
+            self.entries[flac_path] = (file_stat(flac_path) or [0, 0]) + [message]
+            self.save()
+
+    def save(self):
+        """Atomically writes the list, dropping entries of files which changed or are gone."""
+        write_json(self.path, dict((k, v) for k, v in self.entries.items() if v[:2] == file_stat(k)))
+
+
+class Verified(object):
+    """FLAC files which passed flac -t, for --verify. Files are tested again when they change (mtime or size) or their
+    last test is older than --verify-age.
+
+    Stored as a JSON object in the state directory: {"flac path": [mtime, size, verified at (Unix time)]}.
+    """
+
+    def __init__(self, path):
+        """
+        Positional arguments:
+        path -- JSON file path, doesn't have to exist.
+        """
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = dict((decode_paths(k), v) for k, v in json.load(f).items())
+        except (IOError, ValueError):
+            self.entries = dict()
+
+    def due(self, flac_path, max_age):
+        """Returns True if the file changed since its last test, was never tested, or max_age seconds passed."""
+        entry = self.entries.get(flac_path)
+        return not entry or entry[2] < time.time() - max_age or entry[:2] != file_stat(flac_path)
+
+    def add(self, flac_path):
+        """Records a passed test."""
+        self.entries[flac_path] = (file_stat(flac_path) or [0, 0]) + [int(time.time())]
+
+    def save(self):
+        """Atomically writes the list, dropping entries of files which changed or are gone."""
+        write_json(self.path, dict((k, v) for k, v in self.entries.items() if v[:2] == file_stat(k)))
+
+
+class Throughput(object):
+    """Encoding speed measured by the last run, the basis of --plan's time estimate. Stored as a JSON object in the
+    state directory: {"audio_seconds": seconds of audio converted, "thread_seconds": run time times threads}.
+    """
+
+    def __init__(self, path):
+        """
+        Positional arguments:
+        path -- JSON file path, doesn't have to exist.
+        """
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entry = json.load(f)
+        except (IOError, ValueError):
+            self.entry = None
+
+    @property
+    def speed(self):
+        """Seconds of audio encoded per thread and second, None if no run measured it yet."""
+        if not self.entry or not self.entry['thread_seconds']:
+            return None
+        return self.entry['audio_seconds'] / self.entry['thread_seconds']
+
+    def record(self, audio_seconds, thread_seconds):
+        """Saves a run's measurement, unless it converted too little audio to tell."""
+        if audio_seconds < THROUGHPUT_MIN_SECONDS or not thread_seconds:
+            return
+        self.entry = dict(audio_seconds=audio_seconds, thread_seconds=thread_seconds)
+        write_json(self.path, self.entry)
+
+
+class Index(object):
+    """Tags, flags and sizes of the FLAC files of a FLAC directory, read while validating them, so the query command
+    answers without opening any audio file. Files are added when a run validates them (all of them with --reindex).
+
+    Stored as a JSON object in the state directory: {"flac path": {"mtime", "size", "seconds", tag fields,
+    "has_picture", "has_lyrics", "warnings": [...]}}.
+    """
+    FIELDS = ('artist', 'date', 'album', 'discnumber', 'tracknumber', 'title', 'has_picture', 'has_lyrics', 'warnings',
+              'seconds', 'size')
+    GROUPS = ('album', 'artist', 'track')
+
+    def __init__(self, path):
+        """
+        Positional arguments:
+        path -- JSON file path, doesn't have to exist.
+        """
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = dict((decode_paths(k), v) for k, v in json.load(f).items())
+        except (IOError, ValueError):
+            self.entries = dict()
+
+    @staticmethod
+    def name(flac_dir):
+        """Returns the index file name of a FLAC directory."""
+        return hashlib.sha1(json.dumps(flac_dir).encode('utf-8')).hexdigest()[:16] + '.index.json'
+
+    def add(self, flac_path, tags, warnings):
+        """Adds or replaces a file, tags being read_flac_tags()'s result (None for invalid files)."""
+        stat = file_stat(flac_path) or [0, 0]
+        entry = dict((k, '') for k in self.FIELDS[:6])
+        entry.update(tags or dict(has_picture=False, has_lyrics=False, seconds=0.0))
+        entry.update(mtime=stat[0], size=stat[1], warnings=list(warnings))
+        self.entries[flac_path] = entry
+
+    def drop(self, flac_path):
+        """Removes a deleted file."""
+        self.entries.pop(flac_path, None)
+
+    def save(self):
+        """Atomically writes the index."""
+        write_json(self.path, self.entries)
+
+    @classmethod
+    def parse_filter(cls, text):
+        """Returns a --where filter as a 3-value tuple: (field, operator, lower case value). Raises ValueError."""
+        match = re.match(r'^(\w+)(!=|=|~)(.*)$', text)
+        if not match or match.group(1) not in cls.FIELDS:
+            raise ValueError(text)
+        return match.group(1), match.group(2), match.group(3).lower()
+
+    @staticmethod
+    def value(entry, field):
+        """Returns an entry's field as the lower case text filters compare to."""
+        value = entry.get(field, '')
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, list):
+            return '; '.join(value).lower()
+        if isinstance(value, float):
+            return '{:.0f}'.format(value)
+        return '{}'.format(value).lower()
+
+    def query(self, filters=(), group_by='album'):
+        """Returns the groups of matching files and their aggregates.
+
+        Keyword arguments:
+        filters -- list of parse_filter() tuples, all must match.
+        group_by -- "album" (artist - date - album tags), "artist", or "track" (FLAC path).
+
+        Returns:
+        List of 4-value tuples sorted by group: ('group', file count, seconds, bytes).
+        """
+        groups = dict()
+        for path, entry in self.entries.items():
+            matches = True
+            for field, comparison, expected in filters:
+                value = self.value(entry, field)
+                if comparison == '~':
+                    matches = expected in value
+                else:
+                    matches = (value == expected) == (comparison == '=')
+                if not matches:
+                    break
+            if not matches:
+                continue
+            if group_by == 'album':
+                key = ' - '.join(entry[k] for k in ('artist', 'date', 'album'))
+            else:
+                key = entry['artist'] if group_by == 'artist' else path
+            aggregate = groups.setdefault(key, [0, 0.0, 0])
+            aggregate[0] += 1
+            aggregate[1] += entry['seconds'] or 0.0
+            aggregate[2] += entry['size']
+        return sorted((k, c, t, b) for k, (c, t, b) in groups.items())
+
+
+def init_tag_process():
+    """Initializer for tag pool child processes. Control+C is handled by the parent process only."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def read_flac_tags(flac_path):
+    """Reads the FLAC tags needed to validate a file. Runs in the main process or in a tag pool child process.
+
+    Only short strings and booleans are returned, so results are cheap to pickle back to the parent process. Picture
+    and lyric data never leave the process that parsed the file.
+
+    Positional arguments:
+    flac_path -- FLAC file path to read metadata from.
+
+    Returns:
+    None if the file isn't a valid FLAC file, otherwise a dictionary with artist, date, album, discnumber,
+    tracknumber, and title strings, has_picture and has_lyrics booleans, and the duration in seconds.
+    """
+    try:
+        tags = FLAC(flac_path)
+    except flac_error:
+        return None
+    result = {k: tags.get(k, [''])[0] for k in ('artist', 'date', 'album', 'discnumber', 'tracknumber', 'title')}
+    result['has_picture'] = bool(tags.pictures)
+    result['has_lyrics'] = bool(tags.get('unsyncedlyrics', [False])[0])
+    result['seconds'] = tags.info.length
+    return result
+
+
+def write_tags_in_process(source_flac_path, temp_mp3_path, encoder_name='mp3', flac_links=None, replaygain=None,
+                          final_path=None):
+    """Picklable wrapper around the encoder backend's write_tags() for the tag pool. Only the paths cross the process
+    boundary, the child process reads the FLAC (including its pictures) itself."""
+    ENCODERS[encoder_name].write_tags(source_flac_path, temp_mp3_path, flac_links, replaygain, final_path)
+
+
+def sync_metadata(source_flac_path, encoded_path, flac_links=None):
+    """Returns the sync metadata JSON string stored in every encoded file and compared by find_files(). Key names date
+    back to when mp3 was the only output format.
+
+    Positional arguments:
+    source_flac_path -- FLAC file the encoded file was converted from.
+    encoded_path -- the encoded file.
+
+    Keyword arguments:
+    flac_links -- list of [mtime, size] lists of duplicate FLAC files whose outputs are hardlinks to encoded_path.
+    """
+    flac_stat, mp3_stat = os.stat(source_flac_path), os.stat(encoded_path)
+    metadata = dict(
+        flac_mtime=int(flac_stat.st_mtime), flac_size=int(flac_stat.st_size),
+        mp3_mtime=int(mp3_stat.st_mtime), mp3_size=int(mp3_stat.st_size)
+    )
+    if flac_links:
+        metadata['flac_links'] = flac_links
+    return json.dumps(metadata)
+
+
+def sync_metadata_current(metadata, flac_stat, encoded_path):
+    """Returns True if sync metadata read from an encoded file still describes that file and its FLAC file.
+
+    Positional arguments:
+    metadata -- sync metadata dictionary read from the encoded file.
+    flac_stat -- [mtime, size] list of the FLAC file.
+    encoded_path -- the encoded file.
+    """
+    stat = os.stat(encoded_path)
+    expected = dict(flac_mtime=flac_stat[0], flac_size=flac_stat[1], mp3_mtime=int(stat.st_mtime),
+                    mp3_size=int(stat.st_size))
+    metadata = dict(metadata)
+    if flac_stat in metadata.pop('flac_links', []):
+        # The file is a hardlink to the output of a duplicate FLAC file, which listed this FLAC file.
+        metadata.update(flac_mtime=flac_stat[0], flac_size=flac_stat[1])
+    return metadata == expected
+
+
+def read_streaminfo_md5(flac_path):
+    """Returns the audio MD5 from a FLAC file's STREAMINFO block as a hex string, without parsing other metadata. None
+    if the file isn't a FLAC file or its encoder didn't compute the MD5."""
+    try:
+        with open(flac_path, 'rb') as f:
+            header = f.read(42)
+    except IOError:
+        return None
+    if len(header) < 42 or header[:4] != b'fLaC' or bytearray(header[4:5])[0] & 0x7f:
+        try:
+            md5 = FLAC(flac_path).info.md5_signature  # Something precedes STREAMINFO (e.g. ID3), let mutagen find it.
+        except flac_error:
+            return None
+        return '{:032x}'.format(md5) if md5 else None
+    md5 = header[26:42]  # Last 16 bytes of the 34 byte STREAMINFO block.
+    return binascii.hexlify(md5).decode('ascii') if md5.strip(b'\x00') else None
+
+
+def read_streaminfo_length(flac_path):
+    """Returns the duration in seconds from a FLAC file's STREAMINFO block (total samples / sample rate), reading only
+    the file's first bytes like read_streaminfo_md5(). None if the file isn't a FLAC file or the length is unknown."""
+    try:
+        with open(flac_path, 'rb') as f:
+            header = f.read(42)
+    except IOError:
+        return None
+    if len(header) < 42 or header[:4] != b'fLaC' or bytearray(header[4:5])[0] & 0x7f:
+        try:
+            return FLAC(flac_path).info.length or None
+        except flac_error:
+            return None
+    packed = struct.unpack('>Q', header[18:26])[0]  # Sample rate (20 bits), channels, bits per sample, samples (36).
+    sample_rate, samples = packed >> 44, packed & 0xfffffffff
+    return samples / sample_rate if sample_rate and samples else None
+
+
+def flac_tags_digest(flac_path):
+    """Returns a digest of everything copied from a FLAC file to its outputs' tags (Vorbis comments and pictures). FLAC
+    files with equal digests produce identical outputs apart from sync metadata."""
+    tags = FLAC(flac_path)
+    digest = hashlib.sha1(json.dumps(sorted((k.lower(), v) for k, v in tags.items())).encode('utf-8'))
+    for picture in tags.pictures:
+        digest.update(picture.write())
+    return digest.hexdigest()
+
+
+def crc16_table():
+    """Returns the lookup table of crc16()."""
+    table = list()
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = crc16_table()
+
+
+def crc16(data, crc=0):
+    """CRC-16 (polynomial 0x8005, reflected) as used by the LAME tag. Returns an integer."""
+    table = CRC16_TABLE
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def mp3_frames(data):
+    """Finds the MPEG audio frames of an mp3 file, skipping a leading ID3v2 tag and stopping at anything else (e.g. an
+    ID3v1 tag).
+
+    Positional arguments:
+    data -- bytearray of the file.
+
+    Returns (tuple):
+    frames -- list of 2-value tuples: (offset, length). Includes a Xing/Info tag frame.
+    sample_rate -- sample rate of the first frame (0 without frames).
+    samples_per_frame -- samples per frame of the first frame (0 without frames).
+    """
+    offset = 0
+    if data[:3] == b'ID3':
+        offset = 10 + (data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]) + (10 if data[5] & 0x10 else 0)
+    frames, sample_rate, samples_per_frame = list(), 0, 0
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+            break
+        version, layer = (data[offset + 1] >> 3) & 3, (data[offset + 1] >> 1) & 3
+        bitrate_index, rate_index = data[offset + 2] >> 4, (data[offset + 2] >> 2) & 3
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            break
+        bitrate = MP3_BITRATES[version != 3][bitrate_index] * 1000
+        rate = MP3_SAMPLE_RATES[version][rate_index]
+        length = (144 if version == 3 else 72) * bitrate // rate + ((data[offset + 2] >> 1) & 1)
+        if not frames:
+            sample_rate, samples_per_frame = rate, 1152 if version == 3 else 576
+        frames.append((offset, length))
+        offset += length
+    return frames, sample_rate, samples_per_frame
+
+
+def xing_offset(data, frame_offset):
+    """Returns the offset of the Xing/Info tag in an mp3 frame, None if it's an audio frame."""
+    mono = data[frame_offset + 3] >> 6 == 3
+    if (data[frame_offset + 1] >> 3) & 3 == 3:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    offset = frame_offset + 4 + (0 if data[frame_offset + 1] & 1 else 2) + side_info
+    return offset if data[offset:offset + 4] in (b'Xing', b'Info') else None
+
+
+def join_mp3_segments(segments):
+    """Joins mp3 files encoded from consecutive parts of the same audio into one, frame accurately.
+
+    Every segment must be encoded without the bit reservoir (lame --nores) so its frames don't depend on each other,
+    and start on a frame boundary of the whole audio (a multiple of the samples per frame). Frames encoded from warm
+    up audio before and after a segment's own part are dropped. The first segment's Xing/LAME tag frame is kept with
+    its frame/byte counts, seek table, encoder padding (from the last segment), music length and CRCs updated, so
+    seeking and gapless playback keep working.
+
+    Positional arguments:
+    segments -- list of 3-value tuples: (data, 'first audio frame to keep', 'number of audio frames to keep' or None
+        for all remaining frames).
+
+    Returns:
+    The joined file's data (bytes).
+    """
+    tag_frame = tag = padding = None
+    first_frames = first_bytes = 0
+    audio = list()
+    for index, (data, first, count) in enumerate(segments):
+        data = bytearray(data)
+        frames = mp3_frames(data)[0]
+        if not frames:
+            raise ValueError('Segment {} has no mp3 frames.'.format(index))
+        segment_tag = xing_offset(data, frames[0][0])
+        if segment_tag is not None:
+            if index == 0:
+                tag_frame = data[frames[0][0]:frames[0][0] + frames[0][1]]
+                tag = segment_tag - frames[0][0]
+                first_bytes = frames[0][1]
+            padding = (data, segment_tag)
+            frames = frames[1:]
+        if index == 0:
+            first_frames = len(frames)
+            first_bytes += sum(f[1] for f in frames)
+        kept = frames[first:] if count is None else frames[first:first + count]
+        if count is not None and len(kept) != count:
+            raise ValueError('Segment {} has {} audio frames to keep, expected {}.'.format(index, len(kept), count))
+        audio.extend(data[o:o + l] for o, l in kept)
+    music = b''.join(bytes(f) for f in audio)
+    if tag_frame is None:
+        return music
+
+    # Update the Xing tag.
+    flags = struct.unpack('>I', bytes(tag_frame[tag + 4:tag + 8]))[0]
+    total_bytes = len(tag_frame) + len(music)
+    position = tag + 8
+    if flags & 1:
+        old = struct.unpack('>I', bytes(tag_frame[position:position + 4]))[0]
+        tag_frame[position:position + 4] = struct.pack('>I', old - first_frames + len(audio))
+        position += 4
+    if flags & 2:
+        old = struct.unpack('>I', bytes(tag_frame[position:position + 4]))[0]
+        tag_frame[position:position + 4] = struct.pack('>I', old - first_bytes + total_bytes)
+        position += 4
+    if flags & 4:
+        offsets, offset = list(), len(tag_frame)
+        for frame in audio:
+            offsets.append(offset)
+            offset += len(frame)
+        for i in range(100):
+            tag_frame[position + i] = min(255, 256 * offsets[i * len(audio) // 100] // total_bytes)
+        position += 100
+    if flags & 8:
+        position += 4
+    if tag_frame[position:position + 4] != b'LAME' or len(tag_frame) < position + 36:
+        return bytes(tag_frame) + music
+
+    # Update the LAME tag: padding of the last segment, music length and CRC, tag CRC.
+    last_data, last_tag = padding
+    last_position = last_tag + (position - tag)
+    tag_frame[position + 22] = (tag_frame[position + 22] & 0xF0) | (last_data[last_position + 22] & 0x0F)
+    tag_frame[position + 23] = last_data[last_position + 23]
+    old = struct.unpack('>I', bytes(tag_frame[position + 28:position + 32]))[0]
+    tag_frame[position + 28:position + 32] = struct.pack('>I', old - first_bytes + total_bytes)
+    tag_frame[position + 32:position + 34] = struct.pack('>H', crc16(music))
+    tag_frame[position + 34:position + 36] = struct.pack('>H', crc16(tag_frame[:position + 34]))
+    return bytes(tag_frame) + music
+
+
+def k_weighting(sample_rate):
+    """Returns the two ITU-R BS.1770 K-weighting biquads for any sample rate as a list of (b, a) coefficient tuples: a
+    +4 dB high shelf (head effects) and a high pass (RLB weighting). At 48 kHz these are the standard's coefficients.
+    """
+    k = numpy.tan(numpy.pi * 1681.974450955533 / sample_rate)
+    q, gain = 0.7071752369554196, 10 ** (3.999843853973347 / 20)
+    band = gain ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (((gain + band * k / q + k * k) / a0, 2 * (k * k - gain) / a0, (gain - band * k / q + k * k) / a0),
+             (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0))
+    k, q = numpy.tan(numpy.pi * 38.13547087602444 / sample_rate), 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    return [shelf, high_pass]
+
+
+def replaygain_tags(gains, r128=False):
+    """Returns ReplayGain tags of a track as a dictionary of tag names and text values.
+
+    Positional arguments:
+    gains -- dictionary with track_gain/track_peak and optionally album_gain/album_peak keys (dB and linear peaks).
+
+    Keyword arguments:
+    r128 -- return Opus R128_TRACK_GAIN/R128_ALBUM_GAIN tags instead (RFC 7845: Q7.8 fixed point dB relative to -23
+        LUFS, no peaks).
+    """
+    tags = dict()
+    for kind in ('track', 'album'):
+        if kind + '_gain' not in gains:
+            continue
+        if r128:
+            gain = gains[kind + '_gain'] - 5.0  # -23 LUFS reference instead of -18.
+            tags['R128_{}_GAIN'.format(kind.upper())] = str(max(-32768, min(32767, int(round(gain * 256)))))
+        else:
+            tags['REPLAYGAIN_{}_GAIN'.format(kind.upper())] = '{:.2f} dB'.format(gains[kind + '_gain'])
+            tags['REPLAYGAIN_{}_PEAK'.format(kind.upper())] = '{:.6f}'.format(gains[kind + '_peak'])
+    return tags
+
+
+class LoudnessMeter(object):
+    """Measures loudness (ITU-R BS.1770 as used by EBU R128 and ReplayGain 2.0) and sample peak of the wav stream flac
+    decodes to stdout. Fed the same chunks convert_multi() passes on to the encoders, so no extra decode is needed.
+
+    K-weighting is applied by FFT convolution (overlap-add) with the impulse response of the two filters, keeping all
+    per-sample work in vectorised NumPy instead of a Python IIR loop. Energies of 100 ms hops are kept, 400 ms gating
+    blocks are made of four consecutive hops.
+    """
+    responses = dict()  # {(sample rate, FFT size): rfft of the K-weighting impulse response}, shared by all meters.
+
+    def __init__(self):
+        self.header = b''
+        self.sample_rate = self.channels = self.width = None
+        self.error = None  # Why the stream couldn't be analysed, further chunks are ignored.
+        self.pending = b''  # Bytes of an incomplete sample frame.
+        self.tail = None  # Filter output overlapping the next chunk.
+        self.energy = None  # Weighted squares of samples not yet summed into a hop.
+        self.hops = list()
+        self.peak = 0.0
+
+    def feed(self, chunk):
+        """Analyses the next chunk of the wav stream."""
+        if self.error:
+            return
+        if self.sample_rate is None:
+            self.header += chunk
+            chunk = self.parse_header()
+            if not chunk:
+                return
+        data = self.pending + chunk
+        frame = self.channels * self.width
+        usable = len(data) - len(data) % frame
+        self.pending = data[usable:]
+        if usable:
+            self.analyse(self.samples(data[:usable]))
+
+    def parse_header(self):
+        """Parses the RIFF header buffered so far. Returns the audio data after it, or None until it's complete."""
+        if len(self.header) < 12:
+            return None
+        if self.header[:4] != b'RIFF' or self.header[8:12] != b'WAVE':
+            self.error = 'Not a wav stream.'
+            return None
+        position = 12
+        while len(self.header) >= position + 8:
+            name = self.header[position:position + 4]
+            size = struct.unpack('<I', self.header[position + 4:position + 8])[0]
+            if name == b'data':
+                data = self.header[position + 8:]
+                self.header = b''
+                if self.sample_rate is None:
+                    self.error = 'No fmt chunk before the data chunk.'
+                    return None
+                return data
+            if len(self.header) < position + 8 + size:
+                return None
+            if name == b'fmt ':
+                audio_format, channels, sample_rate, _, _, bits = struct.unpack(
+                    '<HHIIHH', self.header[position + 8:position + 24])
+                if audio_format not in (1, 0xFFFE) or bits not in (8, 16, 24, 32) or not channels:
+                    self.error = 'Unsupported wav format {} with {} bits.'.format(audio_format, bits)
+                    return None
+                self.channels, self.sample_rate, self.width = channels, sample_rate, bits // 8
+            position += 8 + size + size % 2
+        return None
+
+    def samples(self, data):
+        """Returns the interleaved integer PCM data as a (frames, channels) array of floats from -1.0 to 1.0."""
+        if self.width == 3:
+            raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+            values = (raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24) >> 8  # Sign extends.
+        elif self.width == 1:
+            values = numpy.frombuffer(data, numpy.uint8).astype(numpy.int32) - 128
+        else:
+            values = numpy.frombuffer(data, '<i{}'.format(self.width))
+        return (values / float(2 ** (8 * self.width - 1))).reshape(-1, self.channels)
+
+    def response(self, size):
+        """Returns the rfft of the K-weighting impulse response for an FFT size."""
+        key = (self.sample_rate, size)
+        if key not in self.responses:
+            impulse = numpy.zeros(int(self.sample_rate * K_WEIGHTING_SECONDS))
+            impulse[0] = 1.0
+            for b, a in k_weighting(self.sample_rate):
+                x1 = x2 = y1 = y2 = 0.0
+                for i, x in enumerate(impulse.tolist()):  # One time per sample rate and FFT size.
+                    y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+                    x1, x2, y1, y2 = x, x1, y, y1
+                    impulse[i] = y
+            self.responses[key] = numpy.fft.rfft(impulse, size)
+        return self.responses[key]
+
+    def analyse(self, samples):
+        """K-weights samples and adds their energy to the hops."""
+        self.peak = max(self.peak, float(numpy.abs(samples).max()))
+        frames, taps = len(samples), int(self.sample_rate * K_WEIGHTING_SECONDS)
+        size = 1 << (frames + taps - 2).bit_length()  # Power of two >= frames + taps - 1.
+        filtered = numpy.fft.irfft(numpy.fft.rfft(samples, size, axis=0) * self.response(size)[:, None], size, axis=0)
+        filtered = filtered[:frames + taps - 1]
+        if self.tail is not None:
+            filtered[:taps - 1] += self.tail
+        self.tail = filtered[frames:]
+        # BS.1770 channel weights: 1.0 for front channels, 1.41 for surround channels, LFE excluded (5.1 layout).
+        weights = numpy.ones(self.channels)
+        if self.channels == 6:
+            weights[3], weights[4:] = 0.0, 1.41
+        energy = (filtered[:frames] ** 2).dot(weights)
+        if self.energy is not None:
+            energy = numpy.concatenate((self.energy, energy))
+        hop = self.sample_rate // 10
+        count = len(energy) // hop
+        self.hops.extend(energy[:count * hop].reshape(count, hop).sum(axis=1).tolist())
+        self.energy = energy[count * hop:]
+
+    def blocks(self):
+        """Returns the mean square of every (overlapping) 400 ms gating block as an array."""
+        hops = numpy.array(self.hops)
+        if len(hops) < 4:
+            return numpy.zeros(0)
+        return (hops[:-3] + hops[1:-2] + hops[2:-1] + hops[3:]) / (4 * (self.sample_rate // 10))
+
+    def measurement(self):
+        """Returns a 2-value tuple: (gating block array, sample peak), or None if the stream couldn't be analysed."""
+        if self.error or self.sample_rate is None:
+            return None
+        return self.blocks(), self.peak
+
+    @staticmethod
+    def integrated(blocks):
+        """Returns the gated integrated loudness (LUFS) of gating blocks, or None if everything is below -70 LUFS."""
+        blocks = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]  # Absolute gate.
+        if not len(blocks):
+            return None
+        relative = -0.691 + 10 * numpy.log10(blocks.mean()) - 10
+        blocks = blocks[blocks > 10 ** ((relative + 0.691) / 10)]  # Relative gate.
+        return -0.691 + 10 * numpy.log10(blocks.mean())
+
+
+class ReplayGain(object):
+    """Collects loudness measurements of tracks converted in this run and decides when their ReplayGain tags are
+    known. Album gain needs every track of the album, so tracks are held back (encoded but not yet tagged and moved
+    into place) until the album's last track is measured.
+
+    Albums are directories of FLAC files. Album gain is only written when every FLAC file of the directory is
+    converted in this run, otherwise the album's tracks get track gain only and aren't held back.
+    """
+
+    def __init__(self, flac_paths):
+        """
+        Positional arguments:
+        flac_paths -- list of FLAC files (queue items) converted in this run.
+        """
+        self.lock = threading.Lock()
+        self.remaining = collections.Counter(os.path.dirname(p) for p in flac_paths)
+        self.complete = {d for d, c in self.remaining.items() if len(fnmatch.filter(os.listdir(d), '*.flac')) == c}
+        self.tracks = dict()  # {album directory: [(measurement, queue item, callback)]}
+        self.albums = dict()  # {album directory: (album loudness or None, album peak)}
+
+    def add(self, item, measurement, callback):
+        """Records a track's measurement and the callback publishing it.
+
+        Positional arguments:
+        item -- queue item of the FLAC file measured, its first value is the FLAC file path.
+        measurement -- LoudnessMeter().measurement() return value.
+        callback -- called with the gains dictionary (see replaygain_tags()) once known.
+
+        Returns:
+        List of 3-value tuples ready to be published: (item, callback, gains). Empty while the album's other tracks are
+        pending.
+        """
+        album = os.path.dirname(item[0])
+        with self.lock:
+            self.remaining[album] -= 1
+            if measurement is None:
+                self.complete.discard(album)
+            self.tracks.setdefault(album, list()).append((measurement, item, callback))
+            if album in self.complete and album not in self.albums:
+                if self.remaining[album] > 0:
+                    return list()
+                entries = self.tracks[album]
+                blocks = numpy.concatenate([m[0][0] for m in entries])
+                self.albums[album] = (LoudnessMeter.integrated(blocks), max(m[0][1] for m in entries))
+            return self.ready(album)
+
+    def drop(self, flac_path):
+        """Records a track failing for good, its album gets track gain only. Returns tracks ready like add() does."""
+        album = os.path.dirname(flac_path)
+        with self.lock:
+            self.remaining[album] -= 1
+            if album in self.albums:
+                return list()
+            self.complete.discard(album)
+            return self.ready(album)
+
+    def ready(self, album):
+        """Returns the held back tracks of an album with their gains, removing them. Call with the lock held."""
+        ready = list()
+        album_loudness, album_peak = self.albums.get(album, (None, None))
+        for measurement, item, callback in self.tracks.pop(album, list()):
+            gains = dict()
+            loudness = LoudnessMeter.integrated(measurement[0]) if measurement else None
+            if loudness is not None:
+                gains.update(track_gain=REPLAYGAIN_REFERENCE - loudness, track_peak=measurement[1])
+            if album_loudness is not None:
+                gains.update(album_gain=REPLAYGAIN_REFERENCE - album_loudness, album_peak=album_peak)
+            ready.append((item, callback, gains))
+        return ready
+
+
+class Mp3Encoder(object):
+    """Encoder backend for mp3 files, using lame and ID3 tags.
+
+    Every backend has the same interface: a name, an output file extension, the ConvertFiles class variable holding
+    its binary's path, and static/class methods to build the encoder command line, write tags, and read back the sync
+    metadata.
+    """
+    name = 'mp3'
+    extension = '.mp3'
+    binary_attribute = 'lame_bin'
+
+    @staticmethod
+    def command(binary, arguments, input_path, output_path):
+        """Returns the encoder command line. input_path may be '-' for stdin."""
+        return [binary, '--quiet'] + arguments + [input_path, output_path]
+
+    @staticmethod
+    def write_tags(source_flac_path, temp_path, flac_links=None, replaygain=None, final_path=None):
+        """Copies tags from the FLAC file and stores sync metadata."""
+        ConvertFiles.write_tags(source_flac_path, temp_path, flac_links, replaygain, final_path)
+
+    @staticmethod
+    def read_sync_metadata(path):
+        """Returns the sync metadata dictionary stored in an encoded file, or None if missing or corrupt."""
+        try:
+            return json.loads(getattr(ID3(path).get("COMM::'eng'"), 'text', [None])[0])
+        except (TypeError, ValueError):
+            return None
+
+
+class VorbisEncoder(object):
+    """Encoder backend for Ogg Vorbis files, using oggenc and Vorbis comments. Same interface as Mp3Encoder."""
+    name = 'vorbis'
+    extension = '.ogg'
+    binary_attribute = 'oggenc_bin'
+    tags_class = OggVorbis
+    r128_gain = False  # Opus players read R128_*_GAIN tags instead of REPLAYGAIN_* tags.
+
+    @staticmethod
+    def command(binary, arguments, input_path, output_path):
+        """Returns the encoder command line. input_path may be '-' for stdin."""
+        return [binary, '--quiet'] + arguments + ['-o', output_path, input_path]
+
+    @classmethod
+    def write_tags(cls, source_flac_path, temp_path, flac_links=None, replaygain=None, final_path=None):
+        """Copies tags (FLAC files use Vorbis comments too) and pictures from the FLAC file and stores sync metadata
+        the same way mp3s do: padding first so the final file size is known. replaygain is a gains dictionary (see
+        replaygain_tags()) measured during encoding, final_path where temp_path is moved to (for folder.jpg)."""
+        tags, comments = FLAC(source_flac_path), cls.tags_class(temp_path)
+        for key, value in tags.items():
+            if key.lower() != SYNC_TAG:
+                comments[key] = value
+        for key, value in replaygain_tags(replaygain or dict(), cls.r128_gain).items():
+            comments[key] = [value]
+        if tags.pictures:
+            pic = tags.pictures[0]
+            mime, data = pic.mime, pic.data
+            if ConvertFiles.art_cache:
+                mime, data = ConvertFiles.art_cache.get(data, mime)
+            if ConvertFiles.art_cache and ConvertFiles.art_cache.folder_art:
+                ConvertFiles.art_cache.write_folder_art(os.path.dirname(final_path or temp_path), data, mime)
+            else:
+                picture = Picture()
+                picture.type, picture.mime, picture.desc, picture.data = pic.type, mime, pic.desc, data
+                comments['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+        comments[SYNC_TAG] = [u' ' * PAD_COMMENT]
+        comments.save()
+        # Ogg files may not be padded, saving the metadata changes the file. Repeat until the metadata describes the
+        # file it's stored in (usually one extra save, when the size's digit count doesn't change).
+        for _ in range(5):
+            metadata = sync_metadata(source_flac_path, temp_path, flac_links)
+            if comments[SYNC_TAG] == [metadata]:
+                break
+            comments[SYNC_TAG] = [metadata]
+            comments.save()
+        else:
+            raise RuntimeError('Sync metadata of {} still stale after 5 saves.'.format(temp_path))
+
+    @classmethod
+    def read_sync_metadata(cls, path):
+        """Returns the sync metadata dictionary stored in an encoded file, or None if missing or corrupt."""
+        try:
+            return json.loads(cls.tags_class(path).get(SYNC_TAG, [None])[0])
+        except (ogg_error, TypeError, ValueError):
+            return None
+
+
+class OpusEncoder(VorbisEncoder):
+    """Encoder backend for Opus files, using opusenc and Vorbis comments. Same interface as Mp3Encoder."""
+    name = 'opus'
+    extension = '.opus'
+    binary_attribute = 'opusenc_bin'
+    tags_class = OggOpus
+    r128_gain = True
+
+    @staticmethod
+    def command(binary, arguments, input_path, output_path):
+        """Returns the encoder command line. input_path may be '-' for stdin."""
+        return [binary, '--quiet'] + arguments + [input_path, output_path]
+
+
+ENCODERS = {e.name: e for e in (Mp3Encoder, OpusEncoder, VorbisEncoder)}
+
+
+class ConvertFiles(threading.Thread):
+    """Threaded class that does the actual file conversion. This also copies over the id3 tags.
+
+    Class variables are to be set before threads are started.
+
+    Class variables:
+    flac_bin -- file path to the FLAC binary. It handles decompressing FLAC files to wav files.
+    lame_bin -- file path to the lame binary. It handles compressing wav files into mp3 files.
+    opusenc_bin -- file path to the opusenc binary, for Opus profiles.
+    oggenc_bin -- file path to the oggenc binary, for Ogg Vorbis profiles.
+    tag_pool -- optional multiprocessing.Pool() instance. Tags are written by its processes instead of this thread,
+        keeping mutagen's pure-Python parsing off the GIL shared by the worker threads and the progress loop.
+    art_cache -- optional AlbumArtCache() instance. Album art is embedded (or written to folder.jpg) from it instead
+        of copying the FLAC's picture as-is. Must be set before the tag pool is started.
+    encode_cache -- optional EncodeCache() instance. Encoded audio is copied from it instead of encoding when possible.
+    duplicate_stats -- counters of outputs derived from duplicate FLAC files instead of being encoded, and what that
+        saved. Updated by threads under stats_lock.
+    throughput -- seconds of audio converted successfully and the seconds threads spent on it. Updated under
+        stats_lock.
+    journal -- optional Journal() instance, completed queue items are recorded in it.
+    scratch -- optional ScratchSpace() instance, limits the bytes of temporary files of all threads.
+    prefetcher -- optional Prefetcher() instance, FLAC files are decoded from its copies.
+    publisher -- optional Publisher() instance, finished files are moved into place by its writer threads.
+    durability -- optional Durability() instance, decides when files are flushed to disk and queue items completed.
+    stopping -- threading.Event() set on Control+C. Threads stop taking queue items and no new child processes start.
+    children -- set of running flac/encoder subprocess.Popen() instances, killed on Control+C.
+    retries -- number of times a failed queue item is queued again, RETRY_BACKOFF seconds later (doubling).
+    timeout_factor -- kill a queue item's child processes after TIMEOUT_BASE plus this many times the track's
+        duration seconds (0 disables).
+    quarantine -- optional Quarantine() instance, queue items failing all retries are added to it.
+    failures -- dictionary of FLAC paths (keys) and lists of error messages (values). Updated under stats_lock.
+    retrying -- number of failed queue items waiting to be queued again. Threads don't exit while it's not zero.
+    reviewing -- True while Review() decisions may still queue items. Threads don't exit while it's set.
+    chunk_threshold -- encode mp3 files of FLACs longer than this many seconds in segments, in parallel (0 disables).
+    chunk_seconds -- length of the segments.
+    chunk_jobs -- number of segments encoded at once.
+    replaygain -- optional ReplayGain() instance. Loudness is measured while encoding and written to the tags, tracks
+        are held back until their album is measured.
+    coordinator -- optional Coordinator() instance. Outputs are encoded by its workers, this thread waits for them.
+    """
+    flac_bin = ''
+    lame_bin = ''
+    opusenc_bin = ''
+    oggenc_bin = ''
+    tag_pool = None
+    art_cache = None
+    encode_cache = None
+    duplicate_stats = dict(linked=0, copied=0, bytes_saved=0, seconds_saved=0.0)
+    throughput = dict(audio_seconds=0.0, thread_seconds=0.0)
+    stats_lock = threading.Lock()
+    journal = None
+    scratch = None
+    prefetcher = None
+    publisher = None
+    durability = None
+    stopping = threading.Event()
+    children = set()
+    retries = 0
+    timeout_factor = 0
+    quarantine = None
+    failures = dict()
+    retrying = 0
+    reviewing = False
+    chunk_threshold = 0
+    chunk_seconds = 300
+    chunk_jobs = 1
+    replaygain = None
+    coordinator = None
+
+    def __init__(self, queue):
+        """
+        Positional arguments:
+        queue -- Queue.Queue() instance, items are 3-value tuples: ('flac_path', outputs, duplicates). outputs is a list
+            of 4-value tuples, one per target directory: ('temp_wav', 'temp_mp3', 'final_mp3', 'profile'). duplicates
+            is a list of 2-value tuples, other FLAC files with the same audio and their outputs: ('flac_path', outputs).
+            Every profile in a duplicate's outputs must also be in outputs. Retried items have a 4th value, the number
+            of failed attempts.
+        """
+        super(ConvertFiles, self).__init__()
+        self.queue = queue
+        self.timed_out = 0
+
+    def run(self):
+        """The main body of the thread. Loops until queue is empty."""
+        logger = logging.getLogger('ConvertFiles.run.{}'.format(self.name))
+        logging.debug('Worker thread started.')
+        while not self.stopping.is_set():
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                if self.retrying or self.reviewing:
+                    time.sleep(0.2)  # Failed items will be queued again, or the user may accept more.
+                    continue
+                break
+            source_flac_path, outputs, duplicates = item[:3]
+            if self.scratch and not self.scratch.reserve(self.scratch.estimate(source_flac_path, outputs, duplicates),
+                                                         self.stopping):
+                break
+            decode_path = self.prefetcher.acquire(source_flac_path) if self.prefetcher else source_flac_path
+            timer = self.start_timer(source_flac_path)
+            started = time.time()
+            try:
+                self.process(source_flac_path, outputs, duplicates, decode_path)
+                with self.stats_lock:
+                    self.throughput['audio_seconds'] += read_streaminfo_length(source_flac_path) or 0.0
+                    self.throughput['thread_seconds'] += time.time() - started
+            except Exception as exc:
+                if self.stopping.is_set():
+                    break  # Killed child processes fail the item, the journal resumes it next run.
+                if self.timed_out:
+                    message = 'Timed out after {:.0f} seconds.'.format(self.timed_out)
+                else:
+                    message = '{}: {}'.format(exc.__class__.__name__, exc)
+                self.fail(item, message)
+            finally:
+                if timer:
+                    timer.cancel()
+                if self.scratch:
+                    self.scratch.release()
+                if self.prefetcher:
+                    self.prefetcher.release(source_flac_path)
+        logging.debug('Worker thread exiting.')
+
+    def process(self, source_flac_path, outputs, duplicates, decode_path=None):
+        """Converts one queue item: encodes (or fetches from the encode cache), tags and renames every output.
+
+        decode_path is a local copy of the FLAC file to decode (from the prefetcher), tags are still read from
+        source_flac_path.
+        """
+        decode_path = decode_path or source_flac_path
+        logging.debug('Source FLAC path: {}'.format(source_flac_path))
+        for temp_wav_path, temp_mp3_path, destination_mp3_path, profile in outputs:
+            logging.debug('Temporary wav path: {}'.format(temp_wav_path))
+            logging.debug('Temporary mp3 path: {}'.format(temp_mp3_path))
+            logging.debug('Final mp3 path: {} ({})'.format(destination_mp3_path, profile))
+        start = time.time()
+        if self.encode_cache:
+            pending = [o for o in outputs if not self.encode_cache.fetch(source_flac_path, o[3], o[1])]
+        else:
+            pending = outputs
+        meter = LoudnessMeter() if self.replaygain else None
+        if self.coordinator and pending:
+            self.coordinator.encode(source_flac_path, pending, self.stopping)
+        else:
+            self.encode(decode_path, pending, meter)
+        for _, temp_mp3_path, _, profile in (pending if self.encode_cache else []):
+            self.encode_cache.store(source_flac_path, profile, temp_mp3_path)  # Before tags are written.
+        seconds_per_output = (time.time() - start) / len(pending) if pending else 0.0
+        if not meter:
+            self.publish(source_flac_path, outputs, duplicates, seconds_per_output)
+            return
+        measurement = meter.measurement()
+        if measurement is None:
+            logging.warning('Loudness of {} not measured: {}'.format(source_flac_path, meter.error or 'No audio.'))
+        ready = self.replaygain.add((source_flac_path, outputs, duplicates), measurement, lambda gains: self.publish(
+            source_flac_path, outputs, duplicates, seconds_per_output, gains))
+        self.publish_ready(ready, source_flac_path)
+
+    def encode(self, source_flac_path, outputs, meter=None):
+        """Encodes outputs (4-value tuples) of a FLAC file: all of them from one decode, in segments on all CPUs if
+        it's a long track, or the classic way through a temporary wav file.
+
+        Keyword arguments:
+        meter -- optional LoudnessMeter() instance, fed the decoded audio. outputs may be empty then.
+        """
+        if meter:
+            self.convert_multi(source_flac_path, [(o[1], o[3]) for o in outputs], meter)  # Decodes cache hits too.
+        elif len(outputs) == 1 and self.chunkable(source_flac_path, outputs[0][3]):
+            try:
+                self.convert_chunked(source_flac_path, outputs[0][1], outputs[0][3])
+            except ValueError as exc:
+                logging.warning('Chunked encoding of {} failed, encoding it whole: {}'.format(source_flac_path, exc))
+                self.convert(source_flac_path, outputs[0][0], outputs[0][1], outputs[0][3])
+        elif len(outputs) == 1:
+            self.convert(source_flac_path, outputs[0][0], outputs[0][1], outputs[0][3])
+        elif outputs:
+            self.convert_multi(source_flac_path, [(o[1], o[3]) for o in outputs])
+
+    def publish(self, source_flac_path, outputs, duplicates, seconds_per_output, replaygain=None):
+        """Tags the encoded outputs of a queue item, derives its duplicates' outputs and moves them into place.
+
+        replaygain is the gains dictionary of the track (see replaygain_tags()), outputs of duplicates in other
+        directories (albums) get its track gain only.
+        """
+        flac_links, hardlinks, copies = self.plan_duplicates(source_flac_path, outputs, duplicates,
+                                                             bool(self.replaygain))
+        for _, temp_mp3_path, destination_mp3_path, profile in outputs:
+            self.tag(source_flac_path, temp_mp3_path, profile, flac_links.get(temp_mp3_path), replaygain,
+                     destination_mp3_path)
+        for duplicate_flac_path, temp_mp3_path, destination_mp3_path, profile in copies:
+            gains = replaygain
+            if replaygain and os.path.dirname(duplicate_flac_path) != os.path.dirname(source_flac_path):
+                gains = dict((k, v) for k, v in replaygain.items() if k.startswith('track_'))
+            self.tag(duplicate_flac_path, temp_mp3_path, profile, replaygain=gains, final_path=destination_mp3_path)
+        temp_paths = dict((o[2], o[1]) for o in outputs)
+        with self.stats_lock:
+            self.duplicate_stats['linked'] += len(hardlinks)
+            self.duplicate_stats['copied'] += len(copies)
+            self.duplicate_stats['bytes_saved'] += sum(os.path.getsize(temp_paths[h[0]]) for h in hardlinks)
+            self.duplicate_stats['seconds_saved'] += seconds_per_output * (len(hardlinks) + len(copies))
+        moves = [(o[1], o[2]) for o in outputs] + [(c[1], c[2]) for c in copies]
+        final_paths = [m[1] for m in moves] + [h[2] for h in hardlinks]
+        if self.publisher:
+            self.publisher.submit(moves, lambda: self.finish(source_flac_path, final_paths, hardlinks))
+            return
+        strict = bool(self.durability and self.durability.mode == 'strict')
+        for temp_mp3_path, destination_mp3_path in moves:
+            move_file(temp_mp3_path, destination_mp3_path, fsync=strict)
+        self.finish(source_flac_path, final_paths, hardlinks)
+
+    def publish_ready(self, ready, source_flac_path=None):
+        """Publishes tracks whose ReplayGain is known (ReplayGain().add() return value). Errors publishing
+        source_flac_path are raised, other tracks were held back by their album and fail on their own."""
+        error = None
+        for item, callback, gains in ready:
+            try:
+                callback(gains)
+            except Exception as exc:
+                if item[0] == source_flac_path:
+                    error = exc
+                else:
+                    self.fail(item, '{}: {}'.format(exc.__class__.__name__, exc))
+        if error:
+            raise error
+
+    def finish(self, source_flac_path, final_paths, hardlinks):
+        """Completes a queue item once its files are in place: hardlinks duplicates to them and updates the journal
+        (once the files are durable)."""
+        for primary_mp3_path, _, destination_mp3_path in hardlinks:
+            os.link(primary_mp3_path, destination_mp3_path + '.part')  # Next to the destination, not in scratch.
+            os.rename(destination_mp3_path + '.part', destination_mp3_path)
+        done = (lambda: self.journal.done(source_flac_path)) if self.journal else None
+        if self.durability:
+            self.durability.commit(final_paths, done)
+        elif done:
+            done()
+        logging.debug('Done converting this file.')
+
+    def start_timer(self, source_flac_path):
+        """Starts the timer killing this thread's child processes when a queue item takes too long. Returns it."""
+        self.timed_out = 0
+        if not self.timeout_factor:
+            return None
+        try:
+            length = FLAC(source_flac_path).info.length
+        except (flac_error, IOError):
+            length = 0
+        timeout = TIMEOUT_BASE + length * self.timeout_factor
+        timer = threading.Timer(timeout, self.expire, (timeout,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def expire(self, timeout):
+        """Kills the child processes of this thread, its queue item timed out."""
+        with self.stats_lock:
+            self.timed_out = timeout
+            for process in self.children:
+                if process.owner == self.name and process.poll() is None:
+                    process.kill()
+
+    def fail(self, item, message):
+        """Records a failed queue item, deletes its temporary files and queues it again later or quarantines it."""
+        attempt = item[3] if len(item) > 3 else 0
+        logging.warning('Converting {} failed (attempt {}): {}'.format(item[0], attempt + 1, message))
+        remove_stale_parts([item[:3]])
+        with self.stats_lock:
+            self.failures.setdefault(item[0], list()).append(message)
+            if attempt < self.retries:
+                ConvertFiles.retrying += 1
+            elif self.quarantine:
+                self.quarantine.add(item[0], message)
+        if attempt >= self.retries:
+            if self.replaygain:
+                self.publish_ready(self.replaygain.drop(item[0]))  # Tracks held back for the album gain.
+            return
+        timer = threading.Timer(RETRY_BACKOFF * 2 ** attempt, self.retry, (self.queue, item[:3] + (attempt + 1,)))
+        timer.daemon = True
+        timer.start()
+
+    @classmethod
+    def retry(cls, queue, item):
+        """Queues a failed item again."""
+        queue.put(item)
+        with cls.stats_lock:
+            cls.retrying -= 1
+
+    @classmethod
+    def popen(cls, command, **kwargs):
+        """Starts a child process and keeps track of it until it exits, so Control+C leaves no orphans behind."""
+        with cls.stats_lock:
+            if cls.stopping.is_set():
+                raise RuntimeError('Stopping, not starting {}'.format(command[0]))
+            process = subprocess.Popen(command, **kwargs)
+            process.owner = threading.current_thread().name
+            cls.children.add(process)
+        return process
+
+    @classmethod
+    def reap(cls, process):
+        """Stops tracking a child process that exited."""
+        with cls.stats_lock:
+            cls.children.discard(process)
+
+    @classmethod
+    def kill_children(cls):
+        """Sets the stopping flag and kills every running child process."""
+        with cls.stats_lock:
+            cls.stopping.set()
+            for process in cls.children:
+                if process.poll() is None:
+                    process.kill()
+
+    def tag(self, source_flac_path, temp_mp3_path, profile, flac_links=None, replaygain=None, final_path=None):
+        """Writes tags with the profile's encoder backend, in the tag pool if there is one."""
+        encoder_name = ENCODER_PROFILES[profile][0]
+        if self.tag_pool:
+            self.tag_pool.apply(write_tags_in_process, (source_flac_path, temp_mp3_path, encoder_name, flac_links,
+                                                        replaygain, final_path))
+        else:
+            ENCODERS[encoder_name].write_tags(source_flac_path, temp_mp3_path, flac_links, replaygain, final_path)
+
+    @staticmethod
+    def plan_duplicates(source_flac_path, outputs, duplicates, replaygain=False):
+        """Decides how outputs of duplicate FLAC files are derived from the just encoded (still untagged) outputs.
+
+        Duplicates with identical tags get hardlinks to the primary output when on the same filesystem, the primary
+        output's sync metadata lists their FLAC's [mtime, size] so find_files() accepts the hardlink too. Otherwise the
+        untagged audio is copied (reflinked if possible) right away, to be tagged separately.
+
+        Positional arguments:
+        source_flac_path -- primary FLAC file.
+        outputs -- list of the primary FLAC's 4-value output tuples.
+        duplicates -- list of 2-value tuples: ('flac_path', outputs).
+
+        Keyword arguments:
+        replaygain -- outputs get ReplayGain tags. Only duplicates in the primary's FLAC directory (album) are
+            hardlinked then, others get different (track gain only) tags.
+
+        Returns (tuple):
+        flac_links -- dictionary of primary temporary output paths (keys) and write_tags() flac_links lists (values).
+        hardlinks -- list of 3-value tuples: ('final primary output', 'temp duplicate output', 'final output').
+        copies -- list of 4-value tuples: ('duplicate flac path', 'temp output', 'final output', 'profile').
+        """
+        flac_links, hardlinks, copies = dict(), list(), list()
+        digest = flac_tags_digest(source_flac_path) if duplicates else None
+        for duplicate_flac_path, duplicate_outputs in duplicates:
+            identical = flac_tags_digest(duplicate_flac_path) == digest
+            if replaygain and os.path.dirname(duplicate_flac_path) != os.path.dirname(source_flac_path):
+                identical = False
+            stat = os.stat(duplicate_flac_path)
+            for _, temp_mp3_path, destination_mp3_path, profile in duplicate_outputs:
+                _, primary_temp_path, primary_mp3_path, _ = [o for o in outputs if o[3] == profile][0]
+                devices = {os.stat(os.path.dirname(p)).st_dev for p in (primary_mp3_path, destination_mp3_path)}
+                if identical and len(devices) == 1:
+                    flac_links.setdefault(primary_temp_path, list()).append([int(stat.st_mtime), int(stat.st_size)])
+                    hardlinks.append((primary_mp3_path, temp_mp3_path, destination_mp3_path))
+                else:
+                    clone_file(primary_temp_path, temp_mp3_path)
+                    copies.append((duplicate_flac_path, temp_mp3_path, destination_mp3_path, profile))
+        return flac_links, hardlinks, copies
+
+    def convert(self, source_flac_path, temp_wav_path, temp_mp3_path, profile='v0'):
+        """Converts the FLAC file into an mp3 (or other profile's format) file with a temporary filename."""
+        logger = logging.getLogger('ConvertFiles.convert.{}'.format(self.name))
+        # First decompress.
+        command = [self.flac_bin, '--silent', '--decode', '-o', temp_wav_path, source_flac_path]
+        logging.debug('Command: {}'.format(' '.join(command)))
+        process = self.popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while process.poll() is None:
+            time.sleep(0.2)  # Wait for process to finish.
+        code = process.returncode
+        stdout, stderr = process.communicate()
+        self.reap(process)
+        logging.debug('code: {}; stdout: {}; stderr: {};'.format(code, stdout, stderr))
+        if code:
+            raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(self.flac_bin, code, stdout,
+                                                                                        stderr))
+        # Then compress.
+        encoder_name, arguments = ENCODER_PROFILES[profile]
+        binary = getattr(self, ENCODERS[encoder_name].binary_attribute)
+        command = ENCODERS[encoder_name].command(binary, arguments, temp_wav_path, temp_mp3_path)
+        logging.debug('Command: {}'.format(' '.join(command)))
+        process = self.popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while process.poll() is None:
+            time.sleep(0.2)  # Wait for process to finish.
+        code = process.returncode
+        stdout, stderr = process.communicate()
+        self.reap(process)
+        logging.debug('code: {}; stdout: {}; stderr: {};'.format(code, stdout, stderr))
+        if code:
+            raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(binary, code, stdout, stderr))
+        # Delete wav file by-product.
+        logging.debug('Removing: {}'.format(temp_wav_path))
+        os.remove(temp_wav_path)
+
+    def chunkable(self, source_flac_path, profile):
+        """Returns True if the FLAC file is long enough for chunked encoding and the profile supports it (lame
+        without resampling, so segment boundaries stay on frame boundaries)."""
+        encoder_name, arguments = ENCODER_PROFILES[profile]
+        if not self.chunk_threshold or self.replaygain or encoder_name != 'mp3' or '--resample' in arguments:
+            return False
+        try:
+            info = FLAC(source_flac_path).info
+        except (flac_error, IOError):
+            return False
+        return info.length > self.chunk_threshold and info.sample_rate in MP3_SAMPLE_RATES[3]
+
+    @staticmethod
+    def plan_segments(total_samples, sample_rate, seconds):
+        """Splits audio into segments for chunked encoding, each starting on an mp3 frame boundary (1152 samples).
+
+        Positional arguments:
+        total_samples -- number of samples of the FLAC file.
+        sample_rate -- sample rate of the FLAC file.
+        seconds -- approximate length of a segment.
+
+        Returns:
+        List of 4-value tuples: (flac --skip sample, flac --until sample or None for the end, 'first frame to keep',
+        'number of frames to keep' or None for all remaining frames). Segments include CHUNK_WARMUP_FRAMES frames of
+        audio before and after their part, which are encoded but not kept.
+        """
+        frame = 1152
+        chunk = max(1, int(seconds * sample_rate) // frame) * frame
+        warmup = CHUNK_WARMUP_FRAMES * frame
+        segments, start = list(), 0
+        while True:
+            skip = max(0, start - warmup)
+            if start + chunk + warmup >= total_samples:
+                segments.append((skip, None, (start - skip) // frame, None))
+                return segments
+            segments.append((skip, start + chunk + warmup, (start - skip) // frame, chunk // frame))
+            start += chunk
+
+    def convert_chunked(self, source_flac_path, temp_mp3_path, profile):
+        """Encodes segments of a long FLAC file in parallel (chunk_jobs at a time) and joins them into one mp3 file.
+        Raises ValueError if the segments can't be joined frame accurately."""
+        info = FLAC(source_flac_path).info
+        segments = self.plan_segments(info.total_samples, info.sample_rate, self.chunk_seconds)
+        paths = ['{}.{}.part'.format(temp_mp3_path, i) for i in range(len(segments))]
+        arguments = ENCODER_PROFILES[profile][1] + ['--nores']  # Frames must not share the bit reservoir.
+        waiting, running = list(zip(segments, paths)), list()
+        try:
+            while waiting or running:
+                while waiting and len(running) < self.chunk_jobs:
+                    (skip, until, _, _), path = waiting.pop(0)
+                    command = [self.flac_bin, '--silent', '--decode', '--stdout', '--skip={}'.format(skip)]
+                    command += ['--until={}'.format(until)] if until else []
+                    logging.debug('Command: {}'.format(' '.join(command + [source_flac_path])))
+                    decoder = self.popen(command + [source_flac_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    command = Mp3Encoder.command(self.lame_bin, arguments, '-', path)
+                    logging.debug('Command: {}'.format(' '.join(command)))
+                    encoder = self.popen(command, stdin=decoder.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    decoder.stdout.close()  # Only the encoder reads it.
+                    running.append((decoder, encoder))
+                time.sleep(0.2)  # Wait for processes to finish.
+                for decoder, encoder in [r for r in running if r[0].poll() is not None and r[1].poll() is not None]:
+                    running.remove((decoder, encoder))
+                    for binary, process in ((self.flac_bin, decoder), (self.lame_bin, encoder)):
+                        stdout = '' if process is decoder else process.stdout.read()
+                        stderr = process.stderr.read()
+                        self.reap(process)
+                        logging.debug('code: {}; stdout: {}; stderr: {};'.format(process.returncode, stdout, stderr))
+                        if process.returncode:
+                            raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(
+                                binary, process.returncode, stdout, stderr))
+            datas = list()
+            for path in paths:
+                with open(path, 'rb') as f:
+                    datas.append(f.read())
+            joined = join_mp3_segments([(d, s[2], s[3]) for d, s in zip(datas, segments)])
+        finally:
+            for decoder, encoder in running:
+                for process in (decoder, encoder):
+                    if process.poll() is None:
+                        process.kill()
+                    process.wait()
+                    self.reap(process)
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        with open(temp_mp3_path, 'wb') as f:
+            f.write(joined)
+
+    def convert_multi(self, source_flac_path, outputs, meter=None):
+        """Decodes the FLAC file once and streams the audio to one lame process per output, in parallel. No temporary
+        wav file is written.
+
+        Positional arguments:
+        source_flac_path -- FLAC file to decode.
+        outputs -- list of 2-value tuples: ('temp_mp3', 'profile'). Profiles may use different encoder backends.
+
+        Keyword arguments:
+        meter -- optional LoudnessMeter() instance, fed the decoded audio too. outputs may be empty then.
+        """
+        command = [self.flac_bin, '--silent', '--decode', '--stdout', source_flac_path]
+        logging.debug('Command: {}'.format(' '.join(command)))
+        decoder = self.popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        encoders, binaries = list(), list()
+        for temp_mp3_path, profile in outputs:
+            encoder_name, arguments = ENCODER_PROFILES[profile]
+            binaries.append(getattr(self, ENCODERS[encoder_name].binary_attribute))
+            command = ENCODERS[encoder_name].command(binaries[-1], arguments, '-', temp_mp3_path)
+            logging.debug('Command: {}'.format(' '.join(command)))
+            encoders.append(self.popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        # Fan out decoded audio. An encoder that exits early is dropped, its return code is reported below.
+        listening = list(encoders)
+        while listening or meter:
+            chunk = decoder.stdout.read(PCM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if meter:
+                meter.feed(chunk)
+            for encoder in list(listening):
+                try:
+                    encoder.stdin.write(chunk)
+                except IOError:
+                    listening.remove(encoder)
+        for encoder in encoders:
+            try:
+                encoder.stdin.close()
+            except IOError:
+                pass
+        # Collect results, decoder first. communicate() can't be used, stdin is already closed.
+        for binary, process in [(self.flac_bin, decoder)] + list(zip(binaries, encoders)):
+            stdout, stderr = process.stdout.read(), process.stderr.read()
+            code = process.wait()
+            self.reap(process)
+            logging.debug('code: {}; stdout: {}; stderr: {};'.format(code, stdout, stderr))
+            if code:
+                for encoder in encoders:
+                    if encoder.poll() is None:
+                        encoder.kill()
+                raise RuntimeError('Process {} returned {}; stdout: {}; stderr: {};'.format(binary, code, stdout,
+                                                                                            stderr))
+
+    @staticmethod
+    def write_tags(source_flac_path, temp_mp3_path, flac_links=None, replaygain=None, final_path=None):
+        """Write mp3 id3 tags from tags available in the FLAC file. Also save metadata as JSON to mp3 comment tag.
+
+        Keyword arguments:
+        flac_links -- list of [mtime, size] lists of duplicate FLAC files whose mp3s will be hardlinks to this one.
+        replaygain -- gains dictionary (see replaygain_tags()) measured during encoding, written as TXXX tags.
+        final_path -- where temp_mp3_path is moved to once tagged, folder.jpg is written next to it. temp_mp3_path may
+            be in the scratch directory.
+        """
+        # Copy non-picture/non-lyric tags from FLAC to mp3.
+        tags, id3 = FLAC(source_flac_path), EasyID3(temp_mp3_path)
+        for tag in (t for t in tags if t in EasyID3.valid_keys.keys()):
+            id3[tag] = tags[tag]
+        id3.save(v1=2)
+        # Copy pictures/lyrics from FLAC to mp3.
+        id3 = ID3(temp_mp3_path)
+        padding = PAD_COMMENT + PAD_COMMENT_LINK * len(flac_links or [])
+        id3.add(COMM(encoding=3, lang='eng', desc='', text=(' ' * padding)))  # Pad ID3 tag to keep final size the same.
+        if tags.pictures:
+            pic = tags.pictures[0]
+            mime, data = pic.mime, pic.data
+            if ConvertFiles.art_cache:
+                mime, data = ConvertFiles.art_cache.get(data, mime)
+            if ConvertFiles.art_cache and ConvertFiles.art_cache.folder_art:
+                ConvertFiles.art_cache.write_folder_art(os.path.dirname(final_path or temp_mp3_path), data, mime)
+            else:
+                id3.add(APIC(encoding=0, mime=mime, type=int(pic.type), desc=pic.desc, data=data))
+        if 'unsyncedlyrics' in tags:
+            id3.add(USLT(encoding=0, lang='eng', desc='Lyrics', text=unicode(tags['unsyncedlyrics'][0])))
+        for desc, text in replaygain_tags(replaygain or dict()).items():
+            id3.add(TXXX(encoding=3, desc=desc, text=text))
+        id3.save(v1=2)
+        # Save metadata to id3 comments tag.
+        id3.add(COMM(encoding=3, lang='eng', desc='', text=sync_metadata(source_flac_path, temp_mp3_path, flac_links)))
+        id3.save(v1=2)
+
+
+def shard_of(key, count):
+    """Returns the shard (0 to count - 1) of a string, the same on every machine and Python version unlike hash()."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8', 'surrogateescape')
+    return int(hashlib.sha1(key).hexdigest(), 16) % count
+
+
+def shard_filter(parent_dir, directory, filenames, shard=None):
+    """Returns the file names of a directory which belong to a shard. Outputs belong to the shard of their FLAC file:
+    album sharding hashes the directory relative to its parent directory (all files of a directory belong to one
+    shard, other directories are skipped without hashing their files), path sharding the relative path without the
+    file extension.
+
+    Positional arguments:
+    parent_dir -- the FLAC or an mp3 parent directory.
+    directory -- directory in parent_dir which holds the files.
+    filenames -- list of file names in the directory.
+
+    Keyword arguments:
+    shard -- 3-value tuple (index, count, 'album' or 'path'), index is 0 based. None keeps every file.
+
+    Returns:
+    List of file names.
+    """
+    if shard is None or not filenames:
+        return filenames
+    index, count, by = shard
+    relative = directory[len(parent_dir):].lstrip(os.sep)
+    if by == 'album':
+        return filenames if shard_of(relative, count) == index else list()
+    return [f for f in filenames if shard_of(os.path.splitext(os.path.join(relative, f))[0], count) == index]
+
+
+def find_files(flac_dir, mp3_dir, encoder=Mp3Encoder, shard=None):
+    """Finds FLAC and mp3 files. Returns a tuple of different data (refer to Returns section in this docstring).
+    FLAC files that don't need converting (and mp3 files that don't need deleting) are omitted. Metadata is stored in
+    mp3 file id3 tags under "comments". This function uses that metadata to determine which files do what.
+
+    Positional arguments:
+    flac_dir -- parent directory string which holds source FLAC files.
+    mp3_dir -- parent directory string which holds destination mp3 files.
+
+    Keyword arguments:
+    encoder -- encoder backend class of mp3_dir. Decides the file extension looked for and how metadata is read.
+    shard -- optional 3-value tuple passed to shard_filter(), files of other shards are neither stat()ed nor read.
+
+    Returns (tuple):
+    flac_files -- dictionary of FLAC file paths (keys) and 2-value lists (values), [file mtime, file byte size].
+    delete_mp3s -- list of mp3 files to be deleted.
+    create_dirs -- list of directories that need to be created in the destination parent directory for future mp3s.
+    foreign_files -- list of non-mp3 files in the mp3 directory which interfere with prune_empty_dirs(). folder.jpg
+        files aren't foreign, they're deleted along with mp3s if their FLAC directory no longer has FLAC files.
+    """
+    flac_files = dict()  # {/file/path.flac: [mtime, bytesize]}
+    delete_mp3s = list()  # List of mp3 file paths to be deleted.
+    create_dirs = list()  # Directories to be created in mp3_dir.
+
+    flac_dirs = set()  # Directories with FLAC files, of every shard.
+
+    # First find every single FLAC file and store it in the flac_files dictionary.
+    for root, _, files in os.walk(flac_dir):
+        files = fnmatch.filter(files, '*.flac')
+        if files:
+            flac_dirs.add(root)
+        for path in (os.path.join(root, filename) for filename in shard_filter(flac_dir, root, files, shard)):
+            stat = os.stat(path)
+            flac_files[path] = [int(stat.st_mtime), int(stat.st_size)]
+    if not flac_dirs:
+        # No FLAC files found at all, wrong directory maybe.
+        raise IOError
+    mp3_walk = [(r, shard_filter(mp3_dir, r, fl, shard)) for r, _, fl in os.walk(mp3_dir)]
+
+    # Find every single mp3, and decide its fate with its own metadata.
+    pattern = '*' + encoder.extension
+    for path in (os.path.join(r, f) for r, fl in mp3_walk for f in fnmatch.filter(fl, pattern)):
+        flac_equivalent = os.path.splitext(path.replace(mp3_dir, flac_dir))[0] + '.flac'
+        if flac_equivalent not in flac_files:
+            # The FLAC file this mp3 file was previously converted from has been moved or deleted. Delete this mp3.
+            delete_mp3s.append(path)
+            continue
+        metadata = encoder.read_sync_metadata(path)
+        if not isinstance(metadata, dict):
+            # The mp3 file is corrupt. Something happened to it after this script created it in the past.
+            delete_mp3s.append(path)
+            continue
+        if not sync_metadata_current(metadata, flac_files[flac_equivalent], path):
+            # Something has changed with either files.
+            delete_mp3s.append(path)
+            continue
+        # Made it this far. That means nothing has changed with the mp3 or FLAC. Removing FLAC from "convert me" list.
+        flac_files.pop(flac_equivalent)
+
+    # Find non-mp3 files in the mp3 directory. Delete album art of directories without FLAC files.
+    foreign_files = sorted([os.path.join(r, f) for r, fl in mp3_walk for f in fl
+                            if not f.endswith(encoder.extension) and f != FOLDER_ART_NAME])
+    for path in (os.path.join(r, FOLDER_ART_NAME) for r, fl in mp3_walk if FOLDER_ART_NAME in fl):
+        if os.path.dirname(path.replace(mp3_dir, flac_dir)) not in flac_dirs:
+            delete_mp3s.append(path)
+
+    # Figure out which directories should be created.
+    for directory in {os.path.dirname(f.replace(flac_dir, mp3_dir)) for f in flac_files}:
+        if not os.path.exists(directory):
+            create_dirs.append(directory)
+    create_dirs.sort()
+    return flac_files, delete_mp3s, create_dirs, foreign_files
+
+
+def find_target_files(flac_dir, targets, shard=None):
+    """Runs find_files() for every target directory and merges the results. Each target keeps its own sync state (the
+    metadata in its own mp3s), so a FLAC file is only converted for the targets whose mp3 is missing or outdated.
+
+    Positional arguments:
+    flac_dir -- parent directory string which holds source FLAC files.
+    targets -- list of 2-value tuples, one per destination: ('mp3_dir', 'profile').
+
+    Keyword arguments:
+    shard -- passed to find_files().
+
+    Returns (tuple):
+    flac_files -- dictionary of FLAC file paths (keys) and 2-value lists (values), [file mtime, file byte size].
+    flac_targets -- dictionary of FLAC file paths (keys) and lists of targets (values) the FLAC is converted for.
+    delete_mp3s -- list of mp3 files to be deleted, from all targets.
+    create_dirs -- list of directories that need to be created, in all targets.
+    foreign_files -- list of non-mp3 files in all targets.
+    """
+    flac_files, flac_targets = dict(), dict()
+    delete_mp3s, create_dirs, foreign_files = list(), list(), list()
+    for mp3_dir, profile in targets:
+        encoder = ENCODERS[ENCODER_PROFILES[profile][0]]
+        t_flac_files, t_delete_mp3s, t_create_dirs, t_foreign_files = find_files(flac_dir, mp3_dir, encoder, shard)
+        flac_files.update(t_flac_files)
+        for path in t_flac_files:
+            flac_targets.setdefault(path, list()).append((mp3_dir, profile))
+        delete_mp3s.extend(t_delete_mp3s)
+        create_dirs.extend(t_create_dirs)
+        foreign_files.extend(t_foreign_files)
+    return flac_files, flac_targets, delete_mp3s, create_dirs, foreign_files
+
+
+def build_outputs(flac_path, flac_dir, targets, scratch_dir=None):
+    """Returns the list of 4-value output tuples ConvertFiles expects for a FLAC file, one per target:
+    ('temp_wav', 'temp_mp3', 'final_mp3', 'profile').
+
+    Positional arguments:
+    flac_path -- FLAC file to be converted.
+    flac_dir -- parent directory string which holds source FLAC files.
+    targets -- list of 2-value tuples: ('mp3_dir', 'profile').
+
+    Keyword arguments:
+    scratch_dir -- put temporary files in this directory instead of next to the final mp3 file.
+    """
+    outputs = list()
+    for mp3_dir, profile in targets:
+        extension = ENCODERS[ENCODER_PROFILES[profile][0]].extension
+        mp3_file = flac_path.replace(flac_dir, mp3_dir)  # Change directories from flac to mp3 dir.
+        final_mp3_file = os.path.splitext(mp3_file)[0] + extension  # Final mp3 filename.
+        if scratch_dir:
+            key = final_mp3_file if isinstance(final_mp3_file, bytes) else final_mp3_file.encode('utf-8')
+            temp_base = os.path.join(scratch_dir, hashlib.sha1(key).hexdigest()[:20])
+        else:
+            temp_base = os.path.splitext(mp3_file)[0]
+        temp_wav_file = temp_base + '.wav.part'  # Temporary file while converting (FLAC -> wav).
+        temp_mp3_file = temp_base + extension + '.part'  # Temporary file (wav -> mp3).
+        outputs.append((temp_wav_file, temp_mp3_file, final_mp3_file, profile))
+    return outputs
+
+
+def remove_stale_parts(jobs):
+    """Deletes temporary files an interrupted run left behind for queue items it didn't complete. Returns the count."""
+    count = 0
+    for _, outputs, duplicates in jobs:
+        for output in outputs + [o for d in duplicates for o in d[1]]:
+            for path in {output[0], output[1], output[2] + '.part'}:
+                if os.path.exists(path):
+                    os.remove(path)
+                    count += 1
+    return count
+
+
+def find_duplicate_audio(flac_targets):
+    """Groups FLAC files to be converted by their STREAMINFO audio MD5 (e.g. the same recording on a studio album and
+    a compilation), so each distinct audio stream is encoded once.
+
+    The primary of a group is the FLAC file converted for the most profiles. Other FLAC files of the group become its
+    duplicates if all their profiles are converted for the primary anyway, otherwise they're converted on their own.
+
+    Positional arguments:
+    flac_targets -- dictionary of FLAC file paths (keys) and lists of ('mp3_dir', 'profile') targets (values).
+
+    Returns:
+    Dictionary of primary FLAC file paths (keys) and lists of duplicate FLAC file paths (values). Only groups with
+    duplicates are included.
+    """
+    groups = dict()
+    for path in sorted(flac_targets):
+        md5 = read_streaminfo_md5(path)
+        if md5:
+            groups.setdefault(md5, list()).append(path)
+    duplicates = dict()
+    for paths in (g for g in groups.values() if len(g) > 1):
+        primary = sorted(paths, key=lambda p: -len({t[1] for t in flac_targets[p]}))[0]
+        profiles = {t[1] for t in flac_targets[primary]}
+        merged = [p for p in paths if p != primary and {t[1] for t in flac_targets[p]} <= profiles]
+        if merged:
+            duplicates[primary] = merged
+    return duplicates
+
+
+class TagMask(list):
+    """List of booleans combining with & | ~ like a NumPy boolean array, TagTable() columns without NumPy."""
+    def __and__(self, other):
+        return TagMask(a and b for a, b in zip(self, other))
+
+    def __or__(self, other):
+        return TagMask(a or b for a, b in zip(self, other))
+
+    def __invert__(self):
+        return TagMask(not a for a in self)
+
+
+class TagTable(object):
+    """Columnar snapshot of the filename fields and tags of FLAC files, one row per file. Validation rules (TAG_RULES)
+    are evaluated once per column instead of once per file: columns are NumPy arrays if NumPy is installed, otherwise
+    lists, and masks (boolean columns) combine with & | ~ either way.
+
+    Filename fields are columns named f_artist, f_date, f_album, f_tracknumber and f_title, tags are named like in
+    read_flac_tags(). All strings are text, file names are decoded on Python 2. NumPy string columns are object arrays,
+    comparing them doesn't copy every string into a fixed width array.
+    """
+    FILENAME_FIELDS = ('artist', 'date', 'album', 'tracknumber', 'title')
+    TAG_FIELDS = ('artist', 'date', 'album', 'discnumber', 'tracknumber', 'title', 'has_picture', 'has_lyrics')
+
+    def __init__(self, rows):
+        """
+        Positional arguments:
+        rows -- list of 2-value tuples: ('flac path', read_flac_tags() dictionary). File names must have five items.
+        """
+        self.paths = list(map(operator.itemgetter(0), rows))
+        self.masks = dict()  # Cache of masks (and string arrays) used by several rules.
+        # Split all file names at once: NUL separates files, it can't be part of a " - " separator or of a name.
+        names = '\0'.join([p.rpartition(os.sep)[2].rpartition('.')[0] for p in self.paths])
+        if str is bytes and not isinstance(names, type(u'')):
+            names = names.decode('utf-8', 'replace')  # Like the tags, Vorbis comments are UTF-8.
+        values = names.replace(' - ', '\0').split('\0') if rows else list()
+        columns = dict(('f_' + f, values[i::5]) for i, f in enumerate(self.FILENAME_FIELDS))
+        tags = list(map(operator.itemgetter(1), rows))
+        columns.update((f, list(map(operator.itemgetter(f), tags))) for f in self.TAG_FIELDS)
+        if numpy is None:
+            self.columns = columns
+        else:
+            self.columns = dict((k, numpy.array(v, dtype=bool if k.startswith('has_') else object))
+                                for k, v in columns.items())
+
+    def equal(self, a, b):
+        """Returns the mask of rows where two columns are equal."""
+        if numpy is None:
+            return TagMask(x == y for x, y in zip(self.columns[a], self.columns[b]))
+        return self.columns[a] == self.columns[b]
+
+    def text(self, name):
+        """Returns a string column as a NumPy string array, numpy.char functions don't take object arrays."""
+        key = ('text', name)
+        if key not in self.masks:
+            self.masks[key] = self.columns[name].astype(numpy.unicode_)
+        return self.masks[key]
+
+    def isdigit(self, name):
+        """Returns the mask of rows where a column is a non-empty string of digits."""
+        key = ('isdigit', name)
+        if key not in self.masks:
+            if numpy is None:
+                self.masks[key] = TagMask(v.isdigit() for v in self.columns[name])
+            else:
+                self.masks[key] = numpy.char.isdigit(self.text(name))
+        return self.masks[key]
+
+    def length(self, name, length):
+        """Returns the mask of rows where a column has a given number of characters."""
+        key = ('length', name, length)
+        if key not in self.masks:
+            if numpy is None:
+                self.masks[key] = TagMask(len(v) == length for v in self.columns[name])
+            else:
+                self.masks[key] = numpy.char.str_len(self.text(name)) == length
+        return self.masks[key]
+
+    def true(self, name):
+        """Returns a boolean column as a mask."""
+        if numpy is None:
+            return TagMask(self.columns[name])
+        return self.columns[name]
+
+    def check(self, rules, skip=()):
+        """Evaluates validation rules.
+
+        Positional arguments:
+        rules -- list of 3-value tuples: ('name', 'message format with column names', callable taking this table and
+            returning the mask of rows failing the rule).
+
+        Keyword arguments:
+        skip -- names of rules not to evaluate.
+
+        Returns:
+        Dictionary of FLAC paths (keys) and lists of messages in rule order (values), failing rows only.
+        """
+        messages = dict()
+        for name, message, rule in rules:
+            if name in skip:
+                continue
+            mask = rule(self)
+            for row in (numpy.flatnonzero(mask) if numpy is not None else [i for i, m in enumerate(mask) if m]):
+                text = message.format(**dict((k, v[row]) for k, v in self.columns.items()))
+                if str is bytes:
+                    text = text.encode('utf-8')  # Native strings like the file names they are printed with.
+                messages.setdefault(self.paths[row], list()).append(text)
+        return messages
+
+    def check_albums(self, rules, known=None):
+        """Evaluates album validation rules. Tracks are grouped by directory and album tag in one pass, files of the
+        same albums validated by earlier runs are taken from the index instead of being read again.
+
+        Positional arguments:
+        rules -- list of 2-value tuples: ('name', callable taking a list of track dictionaries (path, artist, date,
+            album, discnumber, tracknumber, and number: track_number()'s result) and a boolean, True if every FLAC
+            file of the album's directory is among them, and returning a dictionary of paths and messages).
+
+        Keyword arguments:
+        known -- optional dictionary of FLAC paths and dictionaries with the same tags, Index().entries.
+
+        Returns:
+        Dictionary of FLAC paths of this table (keys) and lists of messages in rule order (values), failing rows only.
+        """
+        fields = ('path', 'artist', 'date', 'album', 'discnumber', 'tracknumber')
+        columns = [self.paths] + [list(self.columns[f]) for f in fields[1:]]
+        current = set(self.paths)
+        directories = [p.rpartition(os.sep)[0] for p in self.paths]
+        counts = collections.Counter(directories)
+        for path, entry in (known or dict()).items():
+            directory = path.rpartition(os.sep)[0]
+            if directory in counts and path not in current:
+                directories.append(directory)
+                for column, field in zip(columns, fields):
+                    column.append(path if field == 'path' else entry.get(field, ''))
+        # Group row numbers by directory and album tag, then count files missing from the directory's known ones.
+        albums = dict()
+        for row, key in enumerate(zip(directories, columns[3])):
+            albums.setdefault(key, list()).append(row)
+        counts = collections.Counter(directories)
+        for directory in set(directories):
+            try:
+                counts[directory] -= sum(1 for f in os.listdir(directory) if f.lower().endswith('.flac'))
+            except OSError:
+                counts[directory] = -1
+        for key, rows in list(albums.items()):
+            artists, dates, discs, numbers = [{columns[c][r] for r in rows} for c in (1, 2, 4, 5)]
+            if len(artists) == len(dates) == len(discs) == 1 and len(numbers) == len(rows) and (
+                    counts[key[0]] < 0 or numbers == set(TRACK_NUMBERS[:len(rows)])):
+                del albums[key]  # Consistent, no rule applies.
+            else:
+                albums[key] = [dict(zip(fields, [c[r] for c in columns])) for r in rows]
+                for track in albums[key]:
+                    track['number'] = track_number(track)
+        messages = dict()
+        for name, rule in rules:
+            for (directory, _), tracks in sorted(albums.items()):
+                for path, message in sorted(rule(tracks, counts[directory] >= 0).items()):
+                    if path in current:
+                        if str is bytes and isinstance(message, type(u'')):
+                            message = message.encode('utf-8')
+                        messages.setdefault(path, list()).append(message)
+        return messages
+
+
+# Tag validation rules: (name, message, mask of failing rows). Conditions of earlier rules are repeated so every file
+# gets at most one message per filename field.
+TAG_RULES = (
+    ('artist', u'Artist mismatch: {f_artist} != {artist}', lambda t: ~t.equal('f_artist', 'artist')),
+    ('album', u'Album mismatch: {f_album} != {album}', lambda t: ~t.equal('f_album', 'album')),
+    ('title', u'Title mismatch: {f_title} != {title}', lambda t: ~t.equal('f_title', 'title')),
+    ('date', u'Filename date not a number.', lambda t: ~t.isdigit('f_date')),
+    ('date', u'Filename date not four digits.', lambda t: t.isdigit('f_date') & ~t.length('f_date', 4)),
+    ('date', u'Date mismatch: {f_date} != {date}',
+     lambda t: t.isdigit('f_date') & t.length('f_date', 4) & ~t.equal('f_date', 'date')),
+    ('tracknumber', u'Filename track number not a number.', lambda t: ~t.isdigit('f_tracknumber')),
+    ('tracknumber', u'Filename track number not two digits.',
+     lambda t: t.isdigit('f_tracknumber') & ~t.length('f_tracknumber', 2)),
+    ('tracknumber', u'Track number mismatch: {f_tracknumber} != {tracknumber}',
+     lambda t: t.isdigit('f_tracknumber') & t.length('f_tracknumber', 2) & ~t.equal('f_tracknumber', 'tracknumber')),
+    ('art', u'No album art.', lambda t: ~t.true('has_picture')),
+    ('lyrics', u'No lyrics.', lambda t: ~t.true('has_lyrics')),
+)
+
+
+def most_common(values):
+    """Returns the most common of a list of values, the lowest one of a tie."""
+    if len(set(values)) == 1:
+        return values[0]
+    counts = collections.Counter(values)
+    return min(counts, key=lambda v: (-counts[v], v))
+
+
+def track_number(track):
+    """Returns a track's (disc number, track number) as integers, None if its track number isn't numeric. Handles
+    "3/12" style values."""
+    number = track['tracknumber'].partition('/')[0].strip()
+    if not number.isdigit():
+        return None
+    disc = track['discnumber'].partition('/')[0].strip()
+    return int(disc) if disc.isdigit() else 1, int(number)
+
+
+def check_album_dates(tracks, complete):
+    """Album rule: tracks whose date differs from the album's most common date."""
+    dates = [t['date'] for t in tracks]
+    if len(set(dates)) == 1:
+        return dict()
+    date = most_common(dates)
+    return dict((t['path'], u'Album date mismatch: {} != {}'.format(t['date'], date)) for t in tracks
+                if t['date'] != date)
+
+
+def check_album_artists(tracks, complete):
+    """Album rule: artists spelled like another artist of the album but for case, spaces, and punctuation."""
+    if len({t['artist'] for t in tracks}) == 1:
+        return dict()
+    spellings = dict()
+    for track in tracks:
+        key = ''.join(c for c in track['artist'].lower() if c.isalnum())
+        spellings.setdefault(key, list()).append(track['artist'])
+    result = dict()
+    for track in tracks:
+        spelling = most_common(spellings[''.join(c for c in track['artist'].lower() if c.isalnum())])
+        if track['artist'] != spelling:
+            result[track['path']] = u'Album artist spelling: {} != {}'.format(track['artist'], spelling)
+    return result
+
+
+def check_album_duplicates(tracks, complete):
+    """Album rule: tracks sharing their disc and track number with another track of the album."""
+    numbers = [t['number'] for t in tracks]
+    if len(set(numbers)) == len(numbers):
+        return dict()
+    counts = collections.Counter(numbers)
+    return dict((t['path'], u'Duplicate track number in album: {}'.format(t['tracknumber'])) for t in tracks
+                if t['number'] and counts[t['number']] > 1)
+
+
+def check_album_gaps(tracks, complete):
+    """Album rule: track numbers missing below a disc's highest one, reported by the track after the gap. Only checked
+    if every FLAC file of the directory is known, a partially converted album isn't incomplete."""
+    if not complete:
+        return dict()
+    discs = dict()
+    for number in filter(None, (t['number'] for t in tracks)):
+        discs.setdefault(number[0], set()).add(number[1])
+    if all(len(n) == max(n) for n in discs.values()):
+        return dict()
+    result = dict()
+    for track in tracks:
+        number = track['number']
+        if not number:
+            continue
+        below = [n for n in discs[number[0]] if n < number[1]]
+        missing = range(max(below) + 1 if below else 1, number[1])
+        if missing:
+            result[track['path']] = u'Album is missing track numbers: {}'.format(
+                ', '.join('{:02d}'.format(n) for n in missing))
+    return result
+
+
+# Album validation rules: (name, callable), see TagTable.check_albums(). Albums with one artist, date, and disc number
+# whose track numbers are unique (and 01 to the number of tracks, if the directory is complete) are consistent, rules
+# aren't evaluated for them.
+ALBUM_RULES = (
+    ('dates', check_album_dates),
+    ('artists', check_album_artists),
+    ('duplicates', check_album_duplicates),
+    ('gaps', check_album_gaps),
+)
+TRACK_NUMBERS = ['{:02d}'.format(n) for n in range(1, 100)]  # Track numbers of complete, consistent albums.
+
+
+def find_inconsistent_tags(flac_filepaths, ignore_art=False, ignore_lyrics=False, pool=None, index=None,
+                           albums=False):
+    """Look for missing data in FLAC 'id3' tags or tags that don't match the filename.
+
+    Positional arguments:
+    flac_filepaths -- list of FLAC file paths to read metadata from.
+
+    Keyword arguments:
+    ignore_art -- ignore checking if FLAC file has album art embedded in it, boolean.
+    ignore_lyrics -- ignore checking if FLAC file has lyrics embedded in it, boolean.
+    pool -- optional multiprocessing.Pool() instance, FLAC files are parsed by its processes if given.
+    index -- optional Index() instance, the tags and warnings of every file are added to it. Tags of files with
+        invalid names are read for it too.
+    albums -- also check albums with ALBUM_RULES, tracks of the index's files count towards their albums.
+
+    Returns:
+    Dictionary with keys being FLAC file paths and values being a list of warnings to be printed about id3 tags.
+    """
+    messages = {p: [] for p in flac_filepaths}
+    # Verify filenames.
+    for path in flac_filepaths:
+        if len(os.path.splitext(os.path.basename(path))[0].split(' - ')) != 5:
+            messages[path].append("Filename doesn't have five items.")
+    # Read tags from FLAC files with valid filenames, in parallel if possible.
+    paths = [p for p in flac_filepaths if index is not None or not messages[p]]
+    if pool:
+        all_tags = pool.imap(read_flac_tags, paths, chunksize=TAG_POOL_CHUNK_SIZE)
+    else:
+        all_tags = (read_flac_tags(p) for p in paths)
+    indexed, rows = dict(), list()
+    for path, tags in zip(paths, all_tags):
+        if index is not None:
+            indexed[path] = tags
+        if messages[path]:
+            continue  # Invalid filename, only read for the index.
+        if tags is None:
+            messages[path].append('Invalid file.')
+        else:
+            rows.append((path, tags))
+    # Verify tags, column by column, then albums.
+    skip = {n for n, ignored in (('art', ignore_art), ('lyrics', ignore_lyrics)) if ignored}
+    table = TagTable(rows)
+    for path, failed in table.check(TAG_RULES, skip).items():
+        messages[path].extend(failed)
+    if albums:
+        for path, failed in table.check_albums(ALBUM_RULES, index.entries if index is not None else None).items():
+            messages[path].extend(failed)
+    for path, tags in indexed.items():
+        index.add(path, tags, messages[path])
+    # Return dict of messages without empty lists.
+    return {k: v for k, v in messages.items() if v}
+
+
+def list_flac_files(flac_dir, shard=None):
+    """Returns the paths of all FLAC files in a directory tree, without stat()ing them.
+
+    Positional arguments:
+    flac_dir -- FLAC parent directory.
+
+    Keyword arguments:
+    shard -- optional 3-value tuple like shard_filter()'s, only files of this shard are returned.
+    """
+    flac_files = list()
+    for directory, _, filenames in os.walk(flac_dir):
+        filenames = shard_filter(flac_dir, directory, filenames, shard)
+        flac_files.extend(os.path.join(directory, f) for f in filenames if f.lower().endswith('.flac'))
+    return flac_files
+
+
+def verify_flacs(flac_bin, flac_paths, threads):
+    """Tests FLAC files with flac -t (decoding them and comparing the MD5 signature) in parallel processes.
+
+    Positional arguments:
+    flac_bin -- path to the flac binary.
+    flac_paths -- list of FLAC file paths.
+    threads -- maximum number of flac processes at once.
+
+    Returns:
+    Dictionary of corrupt FLAC paths (keys) and flac's error messages (values).
+    """
+    queue, failures = Queue.Queue(), dict()
+    for path in flac_paths:
+        queue.put(path)
+
+    def worker():
+        while True:
+            try:
+                path = queue.get_nowait()
+            except Queue.Empty:
+                return
+            process = subprocess.Popen([flac_bin, '--silent', '--test', path], stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stderr = process.communicate()[1].decode('utf-8', 'replace').strip()
+            if process.returncode:
+                failures[path] = stderr.splitlines()[-1] if stderr else 'flac -t returned {}'.format(
+                    process.returncode)
+
+    workers = [threading.Thread(target=worker) for _ in range(min(threads, len(flac_paths)))]
+    for thread in workers:
+        thread.daemon = True  # Control+C exits without waiting for the remaining files.
+        thread.start()
+    for thread in workers:
+        while thread.is_alive():
+            thread.join(0.1)  # A plain join() can't be interrupted by Control+C on Python 2.
+    return failures
+
+
+class Review(object):
+    """Decisions about the scan's findings which conversion doesn't wait for. Queue items affected by a decision are
+    held back until it's answered (yes queues them, no drops them), the other items are converted in the meantime.
+    Decisions are answered by policy flags right away, or asked interactively once the conversion started.
+    """
+
+    def __init__(self, jobs):
+        """
+        Positional arguments:
+        jobs -- list of all planned queue items.
+        """
+        self.jobs = list(jobs)
+        self.decisions = list()  # [dict(title, lines, prompt, held set of FLAC paths, accept callable)]
+        self.held = collections.Counter()  # {FLAC path: number of unanswered decisions holding it back}
+        self.rejected = set()
+
+    def add(self, title, lines, prompt, held=(), accept=None, answer=None):
+        """Adds a decision.
+
+        Positional arguments:
+        title -- headline shown above the lines.
+        lines -- list of lines (paths, warnings) shown to the user.
+        prompt -- what pressing Enter does, e.g. "delete these files".
+
+        Keyword arguments:
+        held -- FLAC paths whose queue items wait for this decision.
+        accept -- optional callable run when the answer is yes.
+        answer -- True or False answers the decision right away (policy flags), None leaves it to ask().
+        """
+        decision = dict(title=title, lines=lines, prompt=prompt, held=set(held), accept=accept)
+        self.held.update(decision['held'])
+        if answer is None:
+            self.decisions.append(decision)
+        else:
+            self.answer(decision, answer)
+
+    def answer(self, decision, yes):
+        """Records the answer to a decision. Returns the queue items no longer held back."""
+        for path in decision['held']:
+            self.held[path] -= 1
+        if not yes:
+            self.rejected.update(decision['held'])
+        elif decision['accept']:
+            decision['accept']()
+        return [j for j in self.jobs if j[0] in decision['held'] and j[0] not in self.rejected and not self.held[j[0]]]
+
+    def ready(self):
+        """Returns the queue items which don't wait for a decision, in plan order."""
+        return [j for j in self.jobs if j[0] not in self.rejected and not self.held[j[0]]]
+
+    def ask(self, release, stopping=None):
+        """Asks the user about every decision in turn, the conversion goes on meanwhile. Answering "n" (or closing
+        stdin) rejects a decision.
+
+        Positional arguments:
+        release -- callable taking a list of queue items, the ones accepted decisions no longer hold back.
+
+        Keyword arguments:
+        stopping -- optional threading.Event(), the remaining decisions are rejected once it's set (Control+C).
+        """
+        for decision in self.decisions:
+            if stopping and stopping.is_set():
+                yes = False
+            else:
+                logging.info(Color('{yellow}' + decision['title'] + '{/yellow}'))
+                for line in decision['lines']:
+                    if line:
+                        logging.info(line)
+                    else:
+                        print()
+                try:
+                    reply = raw_input(Color('{{b}}Press Enter to {}, or type n and Enter to skip.{{/b}}'.format(
+                        decision['prompt'])))
+                except EOFError:
+                    reply = 'n'
+                yes = not reply.strip().lower().startswith('n') and not (stopping and stopping.is_set())
+            release(self.answer(decision, yes))
+        self.decisions = list()
+
+
+class Mutations(object):
+    """Applies a batch of filesystem changes (deleting files, creating directories, renaming files) in parallel. On
+    network filesystems every operation is a round trip, so operations are grouped by parent directory and the groups
+    run in a bounded number of threads, each thread working on one directory at a time.
+
+    Directories are created first, then files are renamed and deleted. Every operation succeeds or fails on its own,
+    run() reports each one.
+    """
+
+    def __init__(self, threads=MUTATION_THREADS):
+        """
+        Keyword arguments:
+        threads -- maximum number of directories worked on at once.
+        """
+        self.threads = threads
+        self.operations = list()  # [('mkdir' or 'rename' or 'unlink', path, destination path or None)]
+
+    def mkdir(self, path):
+        """Queues creating a directory and its missing parents. An existing directory counts as success."""
+        self.operations.append(('mkdir', path, None))
+
+    def rename(self, source, destination):
+        """Queues renaming a file, grouped by the source's directory."""
+        self.operations.append(('rename', source, destination))
+
+    def unlink(self, path):
+        """Queues deleting a file."""
+        self.operations.append(('unlink', path, None))
+
+    def run(self):
+        """Applies and clears the queued operations. Returns a dictionary of operations (keys, 3-value tuples as
+        queued) and None on success or the OSError instance (values)."""
+        operations, self.operations, results = self.operations, list(), dict()
+        for kinds in (('mkdir',), ('rename', 'unlink')):
+            groups = collections.OrderedDict()
+            for operation in (o for o in operations if o[0] in kinds):
+                groups.setdefault(os.path.dirname(operation[1]), list()).append(operation)
+            queue = Queue.Queue()
+            for group in groups.values():
+                queue.put(group)
+            threads = [threading.Thread(target=self.worker, args=(queue, results))
+                       for _ in range(min(self.threads, len(groups)))]
+            for thread in threads:
+                thread.daemon = True  # Control+C exits without waiting for the remaining operations.
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)  # A plain join() can't be interrupted by Control+C on Python 2.
+        return results
+
+    @classmethod
+    def worker(cls, queue, results):
+        """Thread body, applies groups of operations until the queue is empty."""
+        while True:
+            try:
+                operations = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for operation in operations:
+                try:
+                    cls.apply(operation)
+                    results[operation] = None
+                except OSError as exc:
+                    results[operation] = exc
+
+    @staticmethod
+    def apply(operation):
+        """Applies one operation."""
+        kind, path, destination = operation
+        if kind == 'unlink':
+            os.unlink(path)
+        elif kind == 'rename':
+            os.rename(path, destination)
+        else:
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):  # Hosts converting other shards create directories too.
+                    raise
+
+
+def prune_empty_dirs(directories, parent_dir):
+    """Removes directories which are empty, then their parents which became empty. Only the given directories (ones
+    the run deleted files from or created) and their parents are looked at instead of walking the whole tree, rmdir()
+    failing with ENOTEMPTY is the emptiness check.
+
+    Positional arguments:
+    directories -- iterable of directories. Ones not in parent_dir are ignored.
+    parent_dir -- parent directory string, never removed.
+
+    Returns:
+    List of removed directories, in removal order.
+    """
+    removed = list()
+    for directory in sorted(set(directories), key=lambda d: d.count(os.sep), reverse=True):  # Children first.
+        while directory.startswith(parent_dir + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError as exc:
+                if exc.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    raise
+                break  # Not empty, or removed already along with its parents.
+            removed.append(directory)
+            directory = os.path.dirname(directory)
+    return removed
+
+
+def build_plan(targets, tag_pool=None):
+    """Scans the FLAC and target directories and plans the run, without changing any file.
+
+    Positional arguments:
+    targets -- list of 2-value tuples: ('mp3_dir', 'profile').
+
+    Keyword arguments:
+    tag_pool -- optional multiprocessing.Pool() instance for find_inconsistent_tags().
+
+    Returns:
+    Dictionary with flac_dir, targets, jobs (list of queue items), mkdir (directories to create), delete (files to
+    delete), foreign (non-mp3 files in the targets), and tag_warnings (FLAC paths and lists of warnings).
+    """
+    logging.info('Finding files and verifying tags...')
+    try:
+        flac_files, flac_targets, delete_mp3s, create_dirs, foreign_files = find_target_files(OPTIONS['flac_dir'],
+                                                                                              targets,
+                                                                                              OPTIONS['shard'])
+    except IOError:
+        logging.error('No FLAC files found in directory {}'.format(OPTIONS['flac_dir']))
+        sys.exit(1)
+    index = Index(os.path.join(OPTIONS['state_dir'], Index.name(OPTIONS['flac_dir'])))
+    indexed = list(flac_files)
+    if OPTIONS['reindex']:
+        indexed.extend(p for p in list_flac_files(OPTIONS['flac_dir'], OPTIONS['shard']) if p not in flac_files)
+    tag_warnings = find_inconsistent_tags(indexed, OPTIONS['ignore_art'], OPTIONS['ignore_lyrics'], tag_pool, index,
+                                          OPTIONS['check_albums'])
+    tag_warnings = dict((p, w) for p, w in tag_warnings.items() if p in flac_files)
+    for path in delete_mp3s:  # Outdated or corrupt outputs are here too, only drop orphans whose FLAC is gone.
+        target = next(d for d, _ in targets if path.startswith(d + os.sep))
+        flac_path = os.path.join(OPTIONS['flac_dir'], os.path.splitext(path[len(target) + 1:])[0] + '.flac')
+        if flac_path not in flac_files and not os.path.isfile(flac_path):
+            index.drop(flac_path)
+    if not OPTIONS['plan']:
+        index.save()
+    logging.info('; '.join([
+        '{} new FLAC {}'.format(len(flac_files), 'file' if len(flac_files) == 1 else 'files'),
+        '{} new {}'.format(len(create_dirs), 'directory' if len(create_dirs) == 1 else 'directories'),
+        '{} FLAC {}'.format(len(tag_warnings), 'warning' if len(tag_warnings) == 1 else 'warnings'),
+        '{} {} to delete'.format(len(delete_mp3s), 'mp3' if len(delete_mp3s) == 1 else 'mp3s'),
+    ]))
+
+    # Plan the conversion.
+    duplicates = find_duplicate_audio(flac_targets) if OPTIONS['link_duplicates'] else dict()
+    merged = {p for paths in duplicates.values() for p in paths}
+    jobs = list()
+    for flac_file in sorted(f for f in flac_files if f not in merged):
+        outputs = build_outputs(flac_file, OPTIONS['flac_dir'], flac_targets[flac_file], OPTIONS['scratch_dir'])
+        jobs.append((flac_file, outputs, [(d, build_outputs(d, OPTIONS['flac_dir'], flac_targets[d],
+                                                            OPTIONS['scratch_dir']))
+                                          for d in duplicates.get(flac_file, [])]))
+    return dict(flac_dir=OPTIONS['flac_dir'], targets=targets, jobs=jobs, mkdir=create_dirs, delete=delete_mp3s,
+                foreign=foreign_files, tag_warnings=tag_warnings)
+
+
+def estimate_plan(plan, speed, threads):
+    """Lists a plan's actions with their estimated cost, for --plan. Reads FLAC headers and stat()s the files to be
+    deleted, nothing is changed.
+
+    Positional arguments:
+    plan -- build_plan() dictionary.
+    speed -- encoding speed in seconds of audio per thread and second (see Throughput()).
+    threads -- number of converting threads.
+
+    Returns:
+    Dictionary with convert (list of dictionaries: flac, seconds, outputs as [path, profile, estimated bytes]),
+    rmdir (directories left empty by the deletions), space (target directories and dictionaries of their output_bytes,
+    freed_bytes and free_bytes), and the totals audio_seconds and encode_seconds.
+    """
+    targets = dict((d, dict(output_bytes=0, freed_bytes=0, free_bytes=None)) for d, _ in plan['targets'])
+
+    def target_of(path):
+        return next(d for d in targets if path.startswith(d + os.sep))
+
+    convert, audio_seconds, filled = list(), 0.0, set()
+    for flac_path, outputs, duplicates in plan['jobs']:
+        seconds = read_streaminfo_length(flac_path) or 0.0
+        audio_seconds += seconds
+        entry = dict(flac=flac_path, seconds=seconds, outputs=list(), duplicates=[d[0] for d in duplicates])
+        for output in outputs + [o for d in duplicates for o in d[1]]:
+            size = int(seconds * PROFILE_KBPS[output[3]] * 1000 / 8)  # Hardlinked duplicates count too, worst case.
+            targets[target_of(output[2])]['output_bytes'] += size
+            entry['outputs'].append([output[2], output[3], size])
+            filled.add(os.path.dirname(output[2]))
+        convert.append(entry)
+    deleted = set(plan['delete'])
+    for path in plan['delete']:
+        try:
+            targets[target_of(path)]['freed_bytes'] += os.path.getsize(path)
+        except OSError:
+            pass
+    for directory in targets:
+        try:
+            stat_vfs = os.statvfs(directory)
+            targets[directory]['free_bytes'] = stat_vfs.f_bavail * stat_vfs.f_frsize
+        except OSError:
+            pass
+
+    # Directories whose entries are all deleted (or removed themselves) and which get no new files.
+    removing = list()
+    for directory in sorted({os.path.dirname(p) for p in deleted}, key=lambda d: d.count(os.sep), reverse=True):
+        while directory not in targets and directory not in filled and directory not in removing:
+            try:
+                entries = [os.path.join(directory, e) for e in os.listdir(directory)]
+            except OSError:
+                break
+            if any(e not in deleted and e not in removing for e in entries):
+                break
+            removing.append(directory)
+            directory = os.path.dirname(directory)
+    return dict(convert=convert, rmdir=removing, space=targets, audio_seconds=audio_seconds,
+                encode_seconds=audio_seconds / (speed * threads))
+
+
+def save_plan(path, plan, speed, measured):
+    """Writes a plan with its estimates as JSON (--plan) and logs a summary. The file is the input of --run-plan.
+
+    Positional arguments:
+    path -- JSON file path.
+    plan -- build_plan() dictionary.
+    speed -- seconds of audio encoded per thread and second.
+    measured -- True if speed was measured by an earlier run, False if it's DEFAULT_SPEED.
+    """
+    estimate = estimate_plan(plan, speed, OPTIONS['threads'])
+    document = dict(plan, speed=speed, speed_measured=measured, threads=OPTIONS['threads'], **estimate)
+    write_json(path, document, indent=1, sort_keys=True)
+
+    logging.info('Plan: {} file{} to convert ({:.1f} hours of audio), {} director{} to create, {} file{} to delete, '
+                 '{} director{} to remove.'.format(
+                     len(plan['jobs']), '' if len(plan['jobs']) == 1 else 's', estimate['audio_seconds'] / 3600,
+                     len(plan['mkdir']), 'y' if len(plan['mkdir']) == 1 else 'ies',
+                     len(plan['delete']), '' if len(plan['delete']) == 1 else 's',
+                     len(estimate['rmdir']), 'y' if len(estimate['rmdir']) == 1 else 'ies'))
+    logging.info('Estimated encoding time: {} with {} thread{} at {:.1f}x realtime each ({}).'.format(
+        datetime.timedelta(seconds=int(estimate['encode_seconds'])), OPTIONS['threads'],
+        '' if OPTIONS['threads'] == 1 else 's', speed, 'measured by an earlier run' if measured else 'a guess'))
+    for directory, sizes in sorted(estimate['space'].items()):
+        needed = sizes['output_bytes'] - sizes['freed_bytes']
+        free = 'unknown' if sizes['free_bytes'] is None else '{:.1f} MiB'.format(sizes['free_bytes'] / 1024 ** 2)
+        line = '{}: {:.1f} MiB new, {:.1f} MiB deleted, {} free.'.format(
+            directory, sizes['output_bytes'] / 1024 ** 2, sizes['freed_bytes'] / 1024 ** 2, free)
+        if sizes['free_bytes'] is not None and needed > sizes['free_bytes']:
+            line = Color('{yellow}' + line + " Won't fit!{/yellow}")
+        logging.info(line)
+    logging.info('Plan written to {}, run it with --run-plan.'.format(path))
+
+
+def load_plan(path, targets):
+    """Reads a --plan file for --run-plan. Exits if it's unreadable or planned other directories. FLAC files deleted
+    since the plan was made are dropped from it.
+
+    Positional arguments:
+    path -- JSON file path.
+    targets -- list of 2-value tuples: ('mp3_dir', 'profile'), must match the plan's.
+
+    Returns:
+    build_plan() dictionary.
+    """
+    try:
+        with open(path) as f:
+            document = json.load(f)
+    except (IOError, ValueError) as exc:
+        logging.error('Cannot read plan {}: {}'.format(path, exc))
+        sys.exit(1)
+    if decode_paths([document['flac_dir']] + document['targets']) != [OPTIONS['flac_dir']] + [list(t) for t in targets]:
+        logging.error('Plan {} was made for other directories or profiles.'.format(path))
+        sys.exit(1)
+    plan = dict((k, decode_paths(document[k])) for k in ('flac_dir', 'mkdir', 'delete', 'foreign'))
+    plan['targets'] = targets
+    plan['jobs'] = [tuple(j) for j in decode_paths(document['jobs']) if os.path.isfile(j[0])]
+    plan['tag_warnings'] = dict((decode_paths(k), v) for k, v in document['tag_warnings'].items())
+    logging.info('Running plan {}: {} file{} to convert.'.format(
+        path, len(plan['jobs']), '' if len(plan['jobs']) == 1 else 's'))
+    return plan
+
+
+def prepare_jobs(plan):
+    """Carries out a plan's directory creation and sets up the decisions about the rest: deleting outdated mp3s and
+    converting FLAC files with tag warnings are Review() decisions, answered by the --on-delete and --on-tag-warnings
+    policies or the user.
+
+    Positional arguments:
+    plan -- build_plan() or load_plan() dictionary.
+
+    Returns (tuple):
+    review -- Review() instance of all planned queue items, ready() ones may be converted right away.
+    changed_dirs -- set of directories created, and directories of deleted files (added once deletions are
+        accepted). Candidates for prune_empty_dirs().
+    """
+    jobs, delete_mp3s, tag_warnings = plan['jobs'], plan['delete'], plan['tag_warnings']
+
+    # Notify user of foreign files in mp3 directory. Nothing happens to them, so nothing waits for the user.
+    if plan['foreign']:
+        logging.info(Color('{yellow}The following non-mp3 files were found:{/yellow}'))
+        for path in plan['foreign']:
+            logging.info(path)
+
+    # Create directories.
+    changed_dirs = set(plan['mkdir'])
+    mutations = Mutations()
+    for directory in plan['mkdir']:
+        mutations.mkdir(directory)
+    for error in (e for e in mutations.run().values() if e):
+        raise error
+    review = Review(jobs)
+
+    # Delete mp3s with user's permission. Converting their updated FLAC files would replace them, so that waits too.
+    if delete_mp3s:
+        deleting = set(delete_mp3s)
+        held = [j[0] for j in jobs if any(o[2] in deleting for o in j[1] + [o for d in j[2] for o in d[1]])]
+
+        def delete():
+            for path in delete_mp3s:
+                mutations.unlink(path)
+            for (_, path, _), error in sorted(mutations.run().items()):
+                if error:
+                    logging.error('Could not delete {}: {}'.format(path, error))
+                else:
+                    changed_dirs.add(os.path.dirname(path))
+        review.add('The following files need to be deleted:', delete_mp3s, 'delete these files', held, delete,
+                   dict(delete=True, keep=False).get(OPTIONS['on_delete']))
+
+    # Notify user of inconsistencies in FLAC id3 tags and file names. Only a FLAC file's own warnings hold its queue
+    # item back, linked duplicates' outputs are derived from it and just reported.
+    def warning_lines(paths):
+        lines, printed_before = list(), False
+        for path in paths:
+            warnings = tag_warnings[path]
+            if len(warnings) == 1:
+                printed_before = True
+                lines.append('{}: {}'.format(os.path.basename(path), warnings[0]))
+            else:
+                if printed_before:
+                    lines.append('')
+                    printed_before = False
+                lines.append('{}:'.format(os.path.basename(path)))
+                lines.extend(warnings)
+                lines.append('')
+        return lines
+    primaries = {j[0] for j in jobs}
+    linked = [p for p in tag_warnings if p not in primaries]
+    if linked:
+        logging.info(Color('{yellow}The following inconsistencies have been found in id3 tags/file names of '
+                           'duplicates (converted with the FLAC files they duplicate):{/yellow}'))
+        for line in warning_lines(linked):
+            if line:
+                logging.info(line)
+            else:
+                print()
+    held = [p for p in tag_warnings if p in primaries]
+    if held:
+        answer = dict(convert=True, skip=False).get(OPTIONS['on_tag_warnings'])
+        review.add('The following inconsistencies have been found in id3 tags/file names:', warning_lines(held),
+                   'convert these files anyway', held, answer=answer)
+    return review, changed_dirs
+
+
+class Inotify(object):
+    """Watches directories with Linux inotify, through ctypes since the standard library has no binding."""
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x100, 0x200, 0x4000, 0x8000, 0x40000000
+    EVENT = struct.Struct('iIII')  # struct inotify_event without the name: wd, mask, cookie, len.
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)  # Not inherited by flac/encoder processes.
+        self.watches = dict()  # {watch descriptor: directory}
+
+    def add_watch(self, directory, mask):
+        """Watches a directory (not recursively) for events in mask."""
+        path = directory if isinstance(directory, bytes) else directory.encode('utf-8')
+        descriptor = self.libc.inotify_add_watch(self.fd, path, mask)
+        if descriptor < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+        self.watches[descriptor] = directory
+
+    def read(self, timeout):
+        """Waits up to timeout seconds for events. Returns a list of 2-value tuples: ('path', mask). The path is None
+        for IN_Q_OVERFLOW (events were lost)."""
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return list()
+        except select.error:
+            return list()  # Interrupted by a signal.
+        data, events, position = os.read(self.fd, 64 * 1024), list(), 0
+        while position < len(data):
+            descriptor, mask, _, length = self.EVENT.unpack_from(data, position)
+            name = data[position + self.EVENT.size:position + self.EVENT.size + length].rstrip(b'\0')
+            position += self.EVENT.size + length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(descriptor, None)  # Directory deleted.
+                continue
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self.watches.get(descriptor)
+            if directory is None:
+                continue
+            if not isinstance(name, str):
+                name = name.decode('utf-8', 'surrogateescape')
+            events.append((os.path.join(directory, name) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Keeps the target directories in sync with the FLAC directory after the initial run (--watch). inotify events
+    of FLAC files are debounced (rippers write in bursts), then only the affected FLAC files are converted or their
+    outputs deleted. Nothing is rescanned unless the kernel's event queue overflowed.
+
+    FLAC files known to be converted are remembered as [mtime, size] in memory. Others are checked against the sync
+    metadata of their outputs, the same check find_files() does.
+    """
+    MASK = (Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO |
+            Inotify.IN_CREATE | Inotify.IN_DELETE)
+
+    def __init__(self, flac_dir, targets, delay, threads=1, scratch_dir=None, ignore_art=False, ignore_lyrics=False,
+                 inotify=None, shard=None, keep_empty_dirs=False):
+        """
+        Positional arguments:
+        flac_dir -- parent directory string which holds source FLAC files.
+        targets -- list of 2-value tuples: ('mp3_dir', 'profile').
+        delay -- seconds a FLAC file must go without events before it's converted.
+
+        Keyword arguments:
+        threads -- number of ConvertFiles threads converting a batch.
+        scratch_dir -- passed to build_outputs().
+        ignore_art -- passed to find_inconsistent_tags(), whose warnings are logged.
+        ignore_lyrics -- passed to find_inconsistent_tags().
+        inotify -- Inotify() instance, a new one by default.
+        shard -- optional 3-value tuple passed to shard_filter(), FLAC files of other shards are ignored.
+        keep_empty_dirs -- don't remove output directories emptied by deleted FLAC files.
+        """
+        self.flac_dir, self.targets, self.delay, self.threads = flac_dir, targets, delay, threads
+        self.scratch_dir, self.ignore_art, self.ignore_lyrics = scratch_dir, ignore_art, ignore_lyrics
+        self.shard, self.keep_empty_dirs = shard, keep_empty_dirs
+        self.inotify = inotify or Inotify()
+        self.lock = threading.Lock()
+        self.pending = dict()  # {flac path: time of its last event}
+        self.forced = set()  # FLAC files enqueued through the control socket, converted even if up to date.
+        self.state = dict()  # {flac path: [mtime, size]} of FLAC files known to be converted.
+        self.converting = list()
+        self.rescan = False
+        self.stats = dict(events=0, converted=0, deleted=0, failed=0)
+        self.watch(flac_dir)
+
+    def watch(self, directory):
+        """Watches a directory and its subdirectories. Returns the FLAC files in them (moved in with the directory)."""
+        flac_paths = list()
+        for root, _, files in os.walk(directory):
+            self.inotify.add_watch(root, self.MASK)
+            flac_paths.extend(os.path.join(root, f) for f in fnmatch.filter(files, '*.flac'))
+        return [p for p in flac_paths if self.owns(p)]
+
+    def owns(self, flac_path):
+        """Returns True if a FLAC file belongs to this host's shard (always without --shard)."""
+        directory, filename = os.path.split(flac_path)
+        return bool(shard_filter(self.flac_dir, directory, [filename], self.shard))
+
+    def handle(self, events, now):
+        """Records inotify events, restarting the debounce delay of their FLAC files."""
+        with self.lock:
+            self.stats['events'] += len(events)
+            for path, mask in events:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    logging.warning('Missed inotify events, rescanning.')
+                    self.rescan = True
+                elif mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    for flac_path in self.watch(path):
+                        self.pending[flac_path] = now
+                elif mask & Inotify.IN_ISDIR and mask & Inotify.IN_MOVED_FROM:
+                    self.rescan = True  # No events for the FLAC files moved away with it.
+                elif path.endswith('.flac') and self.owns(path):
+                    self.pending[path] = now
+
+    def ready(self, now):
+        """Returns the FLAC files whose debounce delay passed, removing them from pending."""
+        with self.lock:
+            ready = sorted(p for p, t in self.pending.items() if now - t >= self.delay)
+            for path in ready:
+                self.pending.pop(path)
+            return ready
+
+    def enqueue(self, path):
+        """Converts a FLAC file, or every FLAC file in a directory, for every target right away. path may be relative
+        to the FLAC directory. Returns the control socket reply."""
+        path = os.path.abspath(os.path.join(self.flac_dir, path))
+        if not path.startswith(self.flac_dir + os.sep) and path != self.flac_dir:
+            return dict(error='Not in the FLAC directory: {}'.format(path))
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(r, f) for r, _, fl in os.walk(path) for f in fnmatch.filter(fl, '*.flac'))
+        elif os.path.isfile(path) and path.endswith('.flac'):
+            paths = [path]
+        else:
+            return dict(error='Not a FLAC file or directory: {}'.format(path))
+        paths = [p for p in paths if self.owns(p)]
+        with self.lock:
+            for flac_path in paths:
+                self.pending[flac_path] = 0
+                self.forced.add(flac_path)
+        return dict(queued=paths)
+
+    def status(self):
+        """Returns the control socket reply to "status"."""
+        with self.lock:
+            return dict(pending=sorted(self.pending), converting=list(self.converting), known=len(self.state),
+                        watches=len(self.inotify.watches), **self.stats)
+
+    def outdated(self, flac_path):
+        """Returns the targets whose output of a FLAC file is missing or outdated."""
+        stat = file_stat(flac_path)
+        if stat is None or self.state.get(flac_path) == stat:
+            return list()
+        outdated = list()
+        for target in self.targets:
+            encoder = ENCODERS[ENCODER_PROFILES[target[1]][0]]
+            output = build_outputs(flac_path, self.flac_dir, [target])[0][2]
+            metadata = encoder.read_sync_metadata(output) if os.path.isfile(output) else None
+            if not isinstance(metadata, dict) or not sync_metadata_current(metadata, stat, output):
+                outdated.append(target)
+        if not outdated:
+            self.state[flac_path] = stat
+        return outdated
+
+    def remove(self, flac_path):
+        """Deletes the outputs of a deleted FLAC file, and their folder.jpg/directory once no FLAC file is left."""
+        self.state.pop(flac_path, None)
+        flac_dir_left = os.path.isdir(os.path.dirname(flac_path)) and fnmatch.filter(
+            os.listdir(os.path.dirname(flac_path)), '*.flac')
+        for target in self.targets:
+            output = build_outputs(flac_path, self.flac_dir, [target])[0][2]
+            if os.path.isfile(output):
+                os.remove(output)
+                logging.info('Deleted {}'.format(output))
+                self.stats['deleted'] += 1
+            directory = os.path.dirname(output)
+            if not flac_dir_left and os.path.isdir(directory):
+                if os.path.isfile(os.path.join(directory, FOLDER_ART_NAME)):
+                    os.remove(os.path.join(directory, FOLDER_ART_NAME))
+                if not self.keep_empty_dirs:
+                    prune_empty_dirs([directory], target[0])
+
+    def sync(self, flac_paths):
+        """Converts changed FLAC files and deletes outputs of deleted ones."""
+        with self.lock:
+            forced, self.forced = self.forced, set()
+            rescan, self.rescan = self.rescan, False
+        jobs = list()
+        for flac_path in flac_paths:
+            if not os.path.isfile(flac_path):
+                self.remove(flac_path)
+                continue
+            if ConvertFiles.quarantine and ConvertFiles.quarantine.contains(flac_path) and flac_path not in forced:
+                continue
+            targets = self.targets if flac_path in forced else self.outdated(flac_path)
+            if targets:
+                jobs.append((flac_path, build_outputs(flac_path, self.flac_dir, targets, self.scratch_dir), list()))
+        if rescan:
+            try:
+                flac_files, flac_targets, delete_mp3s, _, _ = find_target_files(self.flac_dir, self.targets, self.shard)
+            except IOError:
+                flac_files, flac_targets, delete_mp3s = dict(), dict(), list()
+            mutations = Mutations()
+            for path in delete_mp3s:
+                mutations.unlink(path)
+            for (_, path, _), error in sorted(mutations.run().items()):
+                if error:
+                    logging.error('Could not delete {}: {}'.format(path, error))
+                else:
+                    logging.info('Deleted {}'.format(path))
+                    self.stats['deleted'] += 1
+            queued = {j[0] for j in jobs}
+            jobs.extend((f, build_outputs(f, self.flac_dir, flac_targets[f], self.scratch_dir), list())
+                        for f in sorted(flac_files) if f not in queued)
+        if jobs:
+            self.convert(jobs)
+
+    def convert(self, jobs):
+        """Converts a batch of queue items with ConvertFiles threads, waiting for them."""
+        warnings = find_inconsistent_tags([j[0] for j in jobs], self.ignore_art, self.ignore_lyrics,
+                                          ConvertFiles.tag_pool)
+        for path, messages in sorted((p, m) for p, m in warnings.items() if m):
+            logging.warning('{}: {}'.format(path, ' '.join(messages)))
+        for directory in {os.path.dirname(o[2]) for j in jobs for o in j[1]}:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        if ConvertFiles.replaygain:
+            ConvertFiles.replaygain = ReplayGain([j[0] for j in jobs])
+        failures = dict((p, len(m)) for p, m in ConvertFiles.failures.items())
+        with self.lock:
+            self.converting = [j[0] for j in jobs]
+        logging.info('Converting {} file{}.'.format(len(jobs), '' if len(jobs) == 1 else 's'))
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        threads = [ConvertFiles(queue) for _ in range(min(self.threads, len(jobs)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while [t for t in threads if t.is_alive()]:
+            time.sleep(0.2)
+        if ConvertFiles.durability:
+            ConvertFiles.durability.checkpoint()
+        with self.lock:
+            self.converting = list()
+            for flac_path, outputs, _ in jobs:
+                if all(os.path.isfile(o[2]) for o in outputs):
+                    self.state[flac_path] = file_stat(flac_path)
+                    self.stats['converted'] += 1
+                if len(ConvertFiles.failures.get(flac_path, [])) > failures.get(flac_path, 0):
+                    self.stats['failed'] += 1
+
+    def run(self, stopping):
+        """Handles events until stopping (threading.Event()) is set."""
+        while not stopping.is_set():
+            self.handle(self.inotify.read(min(1.0, self.delay or 1.0)), time.time())
+            ready = self.ready(time.time())
+            if ready or self.rescan:
+                self.sync(ready)
+
+
+class ControlSocket(threading.Thread):
+    """Unix socket controlling the --watch daemon. A client sends one command line and gets one JSON line back.
+
+    Commands:
+    status -- pending and converting FLAC files, counters.
+    enqueue PATH -- converts a FLAC file (or every FLAC file in a directory) for every target, even if up to date.
+    """
+
+    def __init__(self, path, watcher):
+        """
+        Positional arguments:
+        path -- socket file path. A stale socket file left behind by a killed daemon is replaced.
+        watcher -- Watcher() instance.
+        """
+        super(ControlSocket, self).__init__()
+        self.daemon = True
+        self.path, self.watcher = path, watcher
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen(5)
+        self.server.settimeout(1)
+        self.closed = threading.Event()
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                connection = self.server.accept()[0]
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            try:
+                connection.settimeout(5)
+                request = b''
+                while not request.endswith(b'\n'):
+                    data = connection.recv(4096)
+                    if not data:
+                        break
+                    request += data
+                reply = self.handle(request if isinstance(request, str) else request.decode('utf-8'))
+                connection.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+
+    def handle(self, request):
+        """Returns the reply dictionary of a command line."""
+        command, _, argument = request.strip().partition(' ')
+        if command == 'status':
+            return self.watcher.status()
+        if command == 'enqueue' and argument:
+            return self.watcher.enqueue(argument)
+        return dict(error='Unknown command: {}'.format(request.strip()))
+
+    def close(self):
+        """Stops listening and deletes the socket file."""
+        self.closed.set()
+        self.server.close()
+        os.remove(self.path)
+
+
+def watch(targets):
+    """Runs the --watch daemon until Control+C/SIGTERM.
+
+    Positional arguments:
+    targets -- list of 2-value tuples: ('mp3_dir', 'profile').
+    """
+    watcher = Watcher(OPTIONS['flac_dir'], targets, OPTIONS['watch_delay'], OPTIONS['threads'],
+                      OPTIONS['scratch_dir'], OPTIONS['ignore_art'], OPTIONS['ignore_lyrics'], shard=OPTIONS['shard'],
+                      keep_empty_dirs=OPTIONS['keep_empty_dirs'])
+    control = None
+    if OPTIONS['control_socket']:
+        control = ControlSocket(OPTIONS['control_socket'], watcher)
+        control.start()
+    logging.info('Watching {} ({} directories) for changes, Control+C to stop.'.format(
+        OPTIONS['flac_dir'], len(watcher.inotify.watches)))
+    handlers = dict()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        handlers[signal_number] = signal.signal(signal_number, lambda *_: ConvertFiles.kill_children())
+    try:
+        watcher.run(ConvertFiles.stopping)
+    finally:
+        for signal_number, handler in handlers.items():
+            signal.signal(signal_number, handler)
+        if control:
+            control.close()
+        watcher.inotify.close()
+    logging.info('Stopped watching: {converted} converted, {deleted} deleted, {failed} failed.'.format(
+        **watcher.stats))
+
+
+def parse_address(address):
+    """Returns a 2-value tuple for socket.socket() and its connect()/bind(): (address family, address). Addresses with
+    a slash are Unix socket paths, others HOST:PORT."""
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '0.0.0.0', int(port))
+
+
+class Coordinator(object):
+    """Hands the encoding of queue items to --worker processes on other machines (sharing the FLAC and mp3
+    directories under the same paths). The coordinator keeps doing everything else: scanning, the journal, tags and
+    moving files into place.
+
+    Workers pull up to one job per thread and claim a job right before encoding it. A worker running out of jobs
+    steals half of the unclaimed jobs of the worker holding the most. Workers send a heartbeat every HEARTBEAT_SECONDS,
+    jobs of a worker silent for three heartbeats (or disconnected) are queued again.
+
+    Protocol: one JSON object per line, every worker request gets one reply. Requests have a "type": hello (name,
+    threads), take, start (id), result (id, error), heartbeat. Requests of a lost worker get an error reply, results
+    only count from the worker currently running the job.
+    """
+
+    def __init__(self, address):
+        """
+        Positional arguments:
+        address -- HOST:PORT or Unix socket path to listen on.
+        """
+        family, self.address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen(16)
+        self.lock = threading.Condition()
+        self.closed = False
+        self.next_id = 0
+        self.queue = collections.deque()  # Job ids waiting for a worker.
+        self.jobs = dict()  # {job id: dictionary of the job message, its error and whether it's done}
+        self.workers = dict()  # {worker name: [last message time, threads, list of unclaimed job ids]}
+        self.running = dict()  # {job id: worker name}
+        self.stats = dict(workers=0, jobs=0, stolen=0, lost=0)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        """Serves every worker connection in its own thread."""
+        while True:
+            try:
+                connection = self.server.accept()[0]
+            except socket.error:
+                return  # Closed.
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, connection):
+        """Answers the requests of one worker until it disconnects."""
+        name = None
+        try:
+            for line in iter(connection.makefile('rb').readline, b''):
+                message = json.loads(line.decode('utf-8'))
+                with self.lock:
+                    if message['type'] == 'hello':
+                        name = message['name']
+                    reply = self.handle(name, message)
+                connection.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+        except (socket.error, ValueError, KeyError) as exc:
+            logging.warning('Worker {} disconnected: {}'.format(name, exc))
+        finally:
+            connection.close()
+            with self.lock:
+                self.lose(name)
+
+    def handle(self, name, message):
+        """Returns the reply to a worker's request. Call with the lock held."""
+        if message['type'] == 'hello':
+            self.workers[name] = [time.time(), message['threads'], list()]
+            self.stats['workers'] += 1
+            logging.info('Worker {} connected with {} threads.'.format(name, message['threads']))
+            return dict(heartbeat=HEARTBEAT_SECONDS)
+        if name not in self.workers:
+            return dict(error='Unknown or lost worker, its jobs were queued again.')
+        worker = self.workers[name]
+        worker[0] = time.time()
+        if message['type'] == 'take':
+            jobs = list()
+            while self.queue and len(worker[2]) + len(jobs) < worker[1]:
+                jobs.append(self.queue.popleft())
+            others = [w for n, w in self.workers.items() if n != name]
+            if not jobs and others:
+                victim = max(others, key=lambda w: len(w[2]))
+                jobs = victim[2][len(victim[2]) // 2:]
+                del victim[2][len(victim[2]) // 2:]
+                self.stats['stolen'] += len(jobs)
+            worker[2].extend(jobs)
+            return dict(jobs=[self.jobs[i]['message'] for i in jobs], finished=self.closed and not jobs)
+        if message['type'] == 'start':
+            claimed = message['id'] in worker[2]
+            if claimed:
+                worker[2].remove(message['id'])
+                self.running[message['id']] = name
+            return dict(ok=claimed)
+        if message['type'] == 'result':
+            if self.running.get(message['id']) != name:
+                return dict(ok=False)  # Lost and queued again, another worker's result counts.
+            del self.running[message['id']]
+            if message['id'] in self.jobs:
+                self.jobs[message['id']].update(done=True, error=message['error'])
+                self.lock.notify_all()
+            return dict(ok=True)
+        return dict(ok=True)  # Heartbeat.
+
+    def lose(self, name):
+        """Queues the jobs of a worker that disconnected or went silent again. Call with the lock held."""
+        worker = self.workers.pop(name, None)
+        if worker is None:
+            return
+        jobs = sorted(worker[2] + [i for i, n in self.running.items() if n == name])
+        for job_id in jobs:
+            self.running.pop(job_id, None)
+        self.queue.extendleft(reversed([i for i in jobs if i in self.jobs]))
+        if jobs:
+            self.stats['lost'] += len(jobs)
+            logging.warning('Worker {} lost, queued its {} jobs again.'.format(name, len(jobs)))
+
+    def encode(self, source_flac_path, outputs, stopping):
+        """Called by ConvertFiles threads instead of encoding: waits until a worker encoded the outputs (4-value
+        tuples) of a FLAC file. Raises RuntimeError if the worker failed or stopping (threading.Event()) is set."""
+        with self.lock:
+            job_id, self.next_id = self.next_id, self.next_id + 1
+            self.jobs[job_id] = dict(message=dict(id=job_id, flac=source_flac_path, outputs=outputs), done=False,
+                                     error=None)
+            self.queue.append(job_id)
+            self.stats['jobs'] += 1
+            while not self.jobs[job_id]['done'] and not stopping.is_set():
+                self.lock.wait(1)
+                now = time.time()
+                for name in [n for n, w in self.workers.items() if now - w[0] > 3 * HEARTBEAT_SECONDS]:
+                    self.lose(name)
+            job = self.jobs.pop(job_id)
+            if job_id in self.queue:
+                self.queue.remove(job_id)
+        if not job['done']:
+            raise RuntimeError('Stopping, not waiting for workers.')
+        if job['error']:
+            raise RuntimeError('Worker failed: {}'.format(job['error']))
+
+    def close(self):
+        """Tells workers asking for jobs that everything is done, stops accepting new workers."""
+        with self.lock:
+            self.closed = True
+        self.server.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class Worker(object):
+    """Encodes jobs of a Coordinator (--worker) in several threads until the coordinator has no more jobs. Tags and
+    final file names are left to the coordinator."""
+
+    def __init__(self, address, threads=1, name=None):
+        """
+        Positional arguments:
+        address -- HOST:PORT or Unix socket path of the coordinator.
+
+        Keyword arguments:
+        threads -- number of jobs encoded at once.
+        name -- unique worker name, host name and process ID by default.
+        """
+        family, address = parse_address(address)
+        self.connection = socket.socket(family, socket.SOCK_STREAM)
+        self.connection.connect(address)
+        self.reader = self.connection.makefile('rb')
+        self.threads, self.name = threads, name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.jobs = collections.deque()
+        self.finished = threading.Event()
+        self.lost = False  # Dropped by the coordinator.
+        self.stats_lock = threading.Lock()
+        self.stats = dict(encoded=0, failed=0)
+
+    def request(self, **message):
+        """Sends a request, returns the coordinator's reply. Raises RuntimeError if the coordinator dropped this
+        worker (replied with an error)."""
+        with self.lock:
+            self.connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            line = self.reader.readline()
+        if not line:
+            raise socket.error('Coordinator closed the connection.')
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def dropped(self, error):
+        """Stops encoding jobs the coordinator already queued again for other workers."""
+        if not self.lost:
+            logging.warning('Dropped by the coordinator ({}), stopping.'.format(error))
+        self.lost = True
+        self.finished.set()
+        ConvertFiles.kill_children()
+
+    def run(self):
+        """Encodes jobs until the coordinator is done or gone."""
+        heartbeat = self.request(type='hello', name=self.name, threads=self.threads)['heartbeat']
+        threads = [threading.Thread(target=self.work) for _ in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while not self.finished.wait(heartbeat) and [t for t in threads if t.is_alive()]:
+            try:
+                self.request(type='heartbeat')
+            except socket.error:
+                break
+            except RuntimeError as exc:
+                self.dropped(exc)
+        self.finished.set()
+        for thread in threads:
+            thread.join()
+        self.connection.close()
+
+    def next_job(self):
+        """Returns the next job message, taking more from the coordinator when out of them. None once finished."""
+        while not ConvertFiles.stopping.is_set():
+            try:
+                return self.jobs.popleft()
+            except IndexError:
+                if self.finished.is_set():
+                    return None
+            reply = self.request(type='take')
+            if reply['finished']:
+                self.finished.set()
+            self.jobs.extend(reply['jobs'])
+            if not reply['jobs']:
+                time.sleep(1)
+        return None
+
+    def work(self):
+        """Body of an encoding thread."""
+        converter = ConvertFiles(None)
+        converter.name = threading.current_thread().name  # Child processes are owned by this thread.
+        try:
+            while True:
+                job = self.next_job()
+                if job is None:
+                    return
+                if not self.request(type='start', id=job['id'])['ok']:
+                    continue  # Stolen by another worker.
+                logging.info('Encoding {}'.format(job['flac']))
+                timer, error = converter.start_timer(job['flac']), None
+                try:
+                    converter.encode(job['flac'], [tuple(o) for o in job['outputs']])
+                    with self.stats_lock:
+                        self.stats['encoded'] += 1
+                except Exception as exc:
+                    if self.lost:
+                        return  # Killed by dropped(), the job and its temporary files belong to another worker now.
+                    error = '{}: {}'.format(exc.__class__.__name__, exc)
+                    if converter.timed_out:
+                        error = 'Timed out after {:.0f} seconds.'.format(converter.timed_out)
+                    remove_stale_parts([(job['flac'], job['outputs'], list())])
+                    with self.stats_lock:
+                        self.stats['failed'] += 1
+                finally:
+                    if timer:
+                        timer.cancel()
+                self.request(type='result', id=job['id'], error=error)
+        except socket.error as exc:
+            logging.info('Disconnected from the coordinator ({}), stopping.'.format(exc))
+            self.finished.set()
+        except RuntimeError as exc:
+            self.dropped(exc)
+
+
+def run_worker():
+    """Runs a --worker process until its coordinator is done."""
+    ConvertFiles.flac_bin = OPTIONS['flac_bin']
+    ConvertFiles.lame_bin = OPTIONS['lame_bin']
+    ConvertFiles.opusenc_bin = OPTIONS['opusenc_bin']
+    ConvertFiles.oggenc_bin = OPTIONS['oggenc_bin']
+    ConvertFiles.timeout_factor = OPTIONS['timeout_factor']
+    ConvertFiles.chunk_threshold = OPTIONS['chunk_threshold']
+    ConvertFiles.chunk_seconds = OPTIONS['chunk_seconds']
+    ConvertFiles.chunk_jobs = OPTIONS['threads']
+    try:
+        worker = Worker(OPTIONS['worker'], OPTIONS['threads'])
+    except socket.error as exc:
+        logging.error('Cannot connect to coordinator {}: {}'.format(OPTIONS['worker'], exc))
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda *_: ConvertFiles.kill_children())
+    logging.info('Worker {} encoding for {} with {} threads.'.format(worker.name, OPTIONS['worker'], worker.threads))
+    worker.run()
+    logging.info('Worker done: {encoded} encoded, {failed} failed.'.format(**worker.stats))
+
+
+def run_verify(quarantine):
+    """Tests the FLAC files of <flac_dir> which are due (--verify) and quarantines corrupt ones, keeping them out of
+    the conversion queue until they change.
+
+    Positional arguments:
+    quarantine -- Quarantine() instance.
+    """
+    verified = Verified(os.path.join(OPTIONS['state_dir'], 'verified.json'))
+    flac_files = list_flac_files(OPTIONS['flac_dir'], OPTIONS['shard'])
+    due = [p for p in flac_files if not quarantine.contains(p) and verified.due(p, OPTIONS['verify_age'] * 86400)]
+    logging.info('Verifying {} of {} FLAC files...'.format(len(due), len(flac_files)))
+    failures = verify_flacs(OPTIONS['flac_bin'], due, OPTIONS['threads'])
+    for path in due:
+        if path in failures:
+            quarantine.add(path, 'Corrupt: {}'.format(failures[path]))
+        else:
+            verified.add(path)
+    verified.save()
+    if failures:
+        logging.warning(Color('{{yellow}}{} corrupt FLAC file{} quarantined, not converting:{{/yellow}}'.format(
+            len(failures), '' if len(failures) == 1 else 's')))
+        for path in sorted(failures):
+            logging.warning('{} ({})'.format(path, failures[path]))
+
+
+def run_query():
+    """Prints the groups of indexed FLAC files matching --where, with their number, duration, and size."""
+    index = Index(os.path.join(OPTIONS['state_dir'], Index.name(OPTIONS['flac_dir'])))
+    if not index.entries:
+        logging.error('No index for {}, run a conversion with --reindex first.'.format(OPTIONS['flac_dir']))
+        sys.exit(1)
+    total = [0, 0.0, 0]
+    for group, count, seconds, size in index.query(OPTIONS['where'], OPTIONS['group_by']):
+        logging.info('{}: {} {}, {}, {:.1f} MiB'.format(group, count, 'track' if count == 1 else 'tracks',
+                                                        datetime.timedelta(seconds=int(round(seconds))),
+                                                        size / 1024 ** 2))
+        total = [total[0] + count, total[1] + seconds, total[2] + size]
+    logging.info(Color('{{b}}Total: {} {}, {}, {:.1f} MiB{{/b}}'.format(
+        total[0], 'track' if total[0] == 1 else 'tracks', datetime.timedelta(seconds=int(round(total[1]))),
+        total[2] / 1024 ** 2)))
+
+
+def main():
+    if OPTIONS['worker']:
+        run_worker()
+        return
+    if OPTIONS['query']:
+        run_query()
+        return
+
+    # Set up the album art cache before the tag pool forks, so its processes inherit it.
+    if OPTIONS['art_size'] or OPTIONS['art_cache'] or OPTIONS['folder_art']:
+        budget = OPTIONS['art_cache_size'] * 1024 ** 2
+        ConvertFiles.art_cache = AlbumArtCache(OPTIONS['art_size'], OPTIONS['art_quality'], budget,
+                                               OPTIONS['art_cache'], budget, OPTIONS['folder_art'])
+
+    # Start the tag pool before any threads exist, forking a multi-threaded process isn't safe.
+    tag_pool = None
+    if OPTIONS['tag_processes']:
+        tag_pool = multiprocessing.Pool(OPTIONS['tag_processes'], init_tag_process)
+
+    targets = [(OPTIONS['mp3_dir'], OPTIONS['profile'])] + OPTIONS['targets']
+    throughput = Throughput(os.path.join(OPTIONS['state_dir'], 'throughput.json'))
+    quarantine = Quarantine(os.path.join(OPTIONS['state_dir'], 'quarantine.json'))
+    if OPTIONS['verify']:
+        run_verify(quarantine)
+    if OPTIONS['plan']:
+        plan = build_plan(targets, tag_pool)
+        plan['jobs'] = [j for j in plan['jobs'] if not quarantine.contains(j[0])]
+        save_plan(OPTIONS['plan'], plan, throughput.speed or DEFAULT_SPEED, throughput.speed is not None)
+        if tag_pool:
+            tag_pool.close()
+            tag_pool.join()
+        return
+    journal_name = Journal.name(OPTIONS['flac_dir'], targets, OPTIONS['shard'])
+    journal = Journal(os.path.join(OPTIONS['state_dir'], journal_name))
+    jobs, review = journal.resume(OPTIONS['flac_dir'], targets), None
+    if jobs is None:
+        plan = load_plan(OPTIONS['run_plan'], targets) if OPTIONS['run_plan'] else build_plan(targets, tag_pool)
+        review, changed_dirs = prepare_jobs(plan)
+        jobs = review.ready()
+        journal.write_plan(OPTIONS['flac_dir'], targets, jobs)
+    else:
+        # Skip scanning and tag validation, the interrupted run did that already.
+        removed = remove_stale_parts(jobs)
+        logging.info('Resuming interrupted run: {} file{} remaining, {} stale temporary file{} removed.'.format(
+            len(jobs), '' if len(jobs) == 1 else 's', removed, '' if removed == 1 else 's'))
+        changed_dirs = {os.path.dirname(o[2]) for j in jobs for o in j[1] + [o for d in j[2] for o in d[1]]}
+
+    # Skip files which failed in an earlier run (or --verify) and didn't change since.
+    quarantined = [j[0] for j in jobs if quarantine.contains(j[0])]
+    if quarantined:
+        logging.info(Color('{yellow}Skipping quarantined files (failed to convert or --verify before, unchanged '
+                           'since):{/yellow}'))
+        for path in quarantined:
+            logging.info('{} ({})'.format(path, quarantine.entries[path][2]))
+        jobs = [j for j in jobs if j[0] not in quarantined]
+
+    # Prepare for conversion.
+    ConvertFiles.flac_bin = OPTIONS['flac_bin']
+    ConvertFiles.lame_bin = OPTIONS['lame_bin']
+    ConvertFiles.opusenc_bin = OPTIONS['opusenc_bin']
+    ConvertFiles.oggenc_bin = OPTIONS['oggenc_bin']
+    ConvertFiles.tag_pool = tag_pool
+    ConvertFiles.journal = journal
+    ConvertFiles.retries = OPTIONS['retries']
+    ConvertFiles.chunk_threshold = OPTIONS['chunk_threshold']
+    ConvertFiles.chunk_seconds = OPTIONS['chunk_seconds']
+    ConvertFiles.chunk_jobs = OPTIONS['threads']
+    ConvertFiles.timeout_factor = OPTIONS['timeout_factor']
+    ConvertFiles.quarantine = quarantine
+    if OPTIONS['scratch_dir']:
+        ConvertFiles.scratch = ScratchSpace(OPTIONS['scratch_size'] * 1024 ** 2)
+    ConvertFiles.durability = Durability(OPTIONS['durability'], OPTIONS['fsync_interval'], journal)
+    if OPTIONS['writers']:
+        ConvertFiles.publisher = Publisher(OPTIONS['writers'], OPTIONS['write_buffer'] * 1024 ** 2,
+                                           ConvertFiles.stopping, OPTIONS['durability'] == 'strict')
+    if OPTIONS['prefetch']:
+        ConvertFiles.prefetcher = Prefetcher([j[0] for j in jobs], OPTIONS['prefetch'],
+                                             OPTIONS['prefetch_size'] * 1024 ** 2, OPTIONS['prefetch_dir'],
+                                             ConvertFiles.stopping)
+    if OPTIONS['replaygain']:
+        ConvertFiles.replaygain = ReplayGain([j[0] for j in jobs])
+    if OPTIONS['coordinator']:
+        ConvertFiles.coordinator = Coordinator(OPTIONS['coordinator'])
+        logging.info('Workers encode, waiting for them on {}.'.format(OPTIONS['coordinator']))
+    if OPTIONS['encode_cache']:
+        ConvertFiles.encode_cache = EncodeCache(OPTIONS['encode_cache'], OPTIONS['encode_cache_size'] * 1024 ** 2)
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+
+    # Start the conversion.
+    total = queue.qsize()
+    count = total
+    logging.info('Converting {} file{}:'.format(total, '' if total == 1 else 's'))
+    if review and review.decisions:
+        held = len([p for p, c in review.held.items() if c])
+        logging.info('{} more file{} for the answers below.'.format(held, ' waits' if held == 1 else 's wait'))
+    # Control+C/SIGTERM stop the conversion gracefully from here on: kill encoders, keep the journal for resuming.
+    handlers = dict()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        handlers[signal_number] = signal.signal(signal_number, lambda *_: ConvertFiles.kill_children())
+    if ConvertFiles.prefetcher:
+        ConvertFiles.prefetcher.start()
+    ConvertFiles.reviewing = bool(review and review.decisions)  # Threads wait for answers, even if all are held.
+    threads = []
+    for i in range(OPTIONS['threads']):
+        thread = ConvertFiles(queue)
+        thread.daemon = True  # Fixes script hang on ctrl+c.
+        thread.start()
+        threads.append(thread)
+
+    # Ask about the scan's findings while the threads convert everything else.
+    if review and review.decisions:
+        released = list()
+
+        def release(items):
+            items = [i for i in items if not quarantine.contains(i[0])]
+            journal.add(items)
+            for item in items:
+                queue.put(item)
+            released.extend(items)
+        try:
+            review.ask(release, ConvertFiles.stopping)
+        finally:
+            ConvertFiles.reviewing = False
+        total += len(released)
+        count = total
+
+    # Wait for everything to finish.
+    while count and not ConvertFiles.stopping.is_set():
+        if not OPTIONS['quiet']:
+            sys.stdout.write('{}/{} ({:02d}%) files remaining...\r'.format(count, total, int(100 * count / total)))
+            sys.stdout.flush()
+        time.sleep(1)
+        count = queue.qsize() + ConvertFiles.retrying + len([True for t in threads if t.is_alive()])
+        # Look for threads that crashed.
+        if len([t for t in threads if t.is_alive()]) < OPTIONS['threads']:
+            # One or more thread isn't running.
+            if queue.qsize():
+                # But the queue isn't empty, something bad happened.
+                raise RuntimeError('Worker thread(s) prematurely terminated.')
+    if ConvertFiles.coordinator:
+        ConvertFiles.coordinator.close()
+    if ConvertFiles.stopping.is_set():
+        ConvertFiles.kill_children()  # Children started right before the signal.
+        for thread in threads:
+            thread.join()
+        if tag_pool:
+            tag_pool.terminate()
+        print(file=sys.stderr)
+        logging.info('Interrupted, run again with the same directories to resume.')
+        sys.exit(130)
+    if ConvertFiles.publisher:
+        ConvertFiles.publisher.close()
+    ConvertFiles.durability.checkpoint()
+    for signal_number, handler in handlers.items():
+        signal.signal(signal_number, handler)
+    journal.finish()
+    if not ConvertFiles.coordinator:
+        throughput.record(**ConvertFiles.throughput)
+    if tag_pool and not OPTIONS['watch']:
+        tag_pool.close()
+        tag_pool.join()
+    if ConvertFiles.encode_cache:
+        logging.info('Encode cache: {hits} hits, {misses} misses, {stored} stored.'.format(
+            **ConvertFiles.encode_cache.stats))
+    failed = [p for p in ConvertFiles.failures if quarantine.contains(p)]
+    if ConvertFiles.failures:
+        logging.info(Color('{{yellow}}{} file{} failed to convert at least once, {} quarantined:{{/yellow}}'.format(
+            len(ConvertFiles.failures), '' if len(ConvertFiles.failures) == 1 else 's', len(failed))))
+        for path in failed:
+            logging.info('{} ({})'.format(path, ConvertFiles.failures[path][-1]))
+    if ConvertFiles.publisher:
+        logging.info('Write-behind: {} files ({:.1f} MiB) written, encoders waited {} times.'.format(
+            ConvertFiles.publisher.stats['published'], ConvertFiles.publisher.stats['bytes'] / 1024 ** 2,
+            ConvertFiles.publisher.stats['waits']))
+    if ConvertFiles.coordinator:
+        logging.info('Workers: {workers} connected, {jobs} jobs, {stolen} stolen, {lost} lost and queued again.'.format(
+            **ConvertFiles.coordinator.stats))
+    if ConvertFiles.prefetcher:
+        logging.info('Prefetch: {prefetched} files read ahead, workers waited {waits} times, {misses} misses.'.format(
+            **ConvertFiles.prefetcher.stats))
+    if ConvertFiles.scratch:
+        waits = ConvertFiles.scratch.stats['waits']
+        logging.info('Scratch space: peak {:.1f} of {} MiB reserved, dispatch waited {} time{}.'.format(
+            ConvertFiles.scratch.stats['peak'] / 1024 ** 2, OPTIONS['scratch_size'], waits, '' if waits == 1 else 's'))
+    if OPTIONS['link_duplicates']:
+        logging.info('Duplicate audio: {linked} hardlinked, {copied} copied; saved {:.0f} seconds of encoding and '
+                     '{:.1f} MiB of disk space.'.format(ConvertFiles.duplicate_stats['seconds_saved'],
+                                                        ConvertFiles.duplicate_stats['bytes_saved'] / 1024 ** 2,
+                                                        **ConvertFiles.duplicate_stats))
+
+    # Done, now clean up directories this run emptied (or created and didn't fill).
+    empty_dirs = list()
+    if not OPTIONS['keep_empty_dirs']:
+        empty_dirs = [d for mp3_dir, _ in targets for d in prune_empty_dirs(changed_dirs, mp3_dir)]
+    if empty_dirs:
+        logging.info(Color('{yellow}Removed the following empty directories:{/yellow}'))
+        for path in empty_dirs:
+            logging.info(path)
+
+    # Keep converting changes, in worker threads started per batch. Their journal is done, files are moved into place
+    # and encoded by the converting threads.
+    if OPTIONS['watch']:
+        ConvertFiles.journal = ConvertFiles.prefetcher = ConvertFiles.publisher = ConvertFiles.coordinator = None
+        ConvertFiles.durability.journal = None
+        watch(targets)
+        if tag_pool:
+            tag_pool.close()
+            tag_pool.join()
+
+
+def validate_options():
+    """Re-formats dict from docopt and does some sanity checks on it.
+
+    Positional arguments:
+    OPTIONS -- dictionary from docopt.docopt().
+
+    Returns:
+    Dictionary similar to OPTIONS but only relevant data without CLI notation.
+    """
+    logger = logging.getLogger('%s.parse_n_check' % __name__)
+    config = dict(
+        flac_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--flac-bin-path'))),
+        lame_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--lame-bin-path'))),
+        opusenc_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--opusenc-bin-path'))),
+        oggenc_bin=os.path.abspath(os.path.expanduser(OPTIONS.get('--oggenc-bin-path'))),
+        ignore_art=bool(OPTIONS.get('--ignore-art')),
+        ignore_lyrics=bool(OPTIONS.get('--ignore-lyrics')),
+        check_albums=bool(OPTIONS.get('--check-albums')),
+        threads=OPTIONS.get('--threads'),
+        tag_processes=OPTIONS.get('--tag-processes'),
+        art_cache=OPTIONS.get('--art-cache') and os.path.abspath(os.path.expanduser(OPTIONS.get('--art-cache'))),
+        art_cache_size=OPTIONS.get('--art-cache-size'),
+        art_quality=OPTIONS.get('--art-quality'),
+        art_size=OPTIONS.get('--art-size'),
+        folder_art=bool(OPTIONS.get('--folder-art')),
+        link_duplicates=bool(OPTIONS.get('--link-duplicates')),
+        keep_empty_dirs=bool(OPTIONS.get('--keep-empty-dirs')),
+        encode_cache=OPTIONS.get('--encode-cache') and os.path.abspath(os.path.expanduser(OPTIONS['--encode-cache'])),
+        encode_cache_size=OPTIONS.get('--encode-cache-size'),
+        prefetch=OPTIONS.get('--prefetch'),
+        prefetch_dir=OPTIONS.get('--prefetch-dir') and os.path.abspath(os.path.expanduser(OPTIONS['--prefetch-dir'])),
+        prefetch_size=OPTIONS.get('--prefetch-size'),
+        profile=OPTIONS.get('--profile'),
+        targets=[tuple(t.rsplit(':', 1)) for t in OPTIONS.get('--target') or []],
+        flac_dir=OPTIONS.get('<flac_dir>') and os.path.abspath(os.path.expanduser(OPTIONS['<flac_dir>'])),
+        mp3_dir=OPTIONS.get('<mp3_dir>') and os.path.abspath(os.path.expanduser(OPTIONS['<mp3_dir>'])),
+        scratch_dir=OPTIONS.get('--scratch-dir') and os.path.abspath(os.path.expanduser(OPTIONS['--scratch-dir'])),
+        scratch_size=OPTIONS.get('--scratch-size'),
+        chunk_seconds=OPTIONS.get('--chunk-seconds'),
+        chunk_threshold=OPTIONS.get('--chunk-threshold'),
+        replaygain=bool(OPTIONS.get('--replaygain')),
+        retries=OPTIONS.get('--retries'),
+        timeout_factor=OPTIONS.get('--timeout-factor'),
+        durability=OPTIONS.get('--durability'),
+        fsync_interval=OPTIONS.get('--fsync-interval'),
+        writers=OPTIONS.get('--writers'),
+        write_buffer=OPTIONS.get('--write-buffer'),
+        plan=OPTIONS.get('--plan') and os.path.abspath(os.path.expanduser(OPTIONS['--plan'])),
+        run_plan=OPTIONS.get('--run-plan') and os.path.abspath(os.path.expanduser(OPTIONS['--run-plan'])),
+        on_delete=OPTIONS.get('--on-delete'),
+        on_tag_warnings=OPTIONS.get('--on-tag-warnings'),
+        shard=OPTIONS.get('--shard'),
+        shard_by=OPTIONS.get('--shard-by'),
+        verify=bool(OPTIONS.get('--verify')),
+        verify_age=OPTIONS.get('--verify-age'),
+        query=bool(OPTIONS.get('query')),
+        where=OPTIONS.get('--where') or [],
+        group_by=OPTIONS.get('--group-by'),
+        reindex=bool(OPTIONS.get('--reindex')),
+        state_dir=os.path.abspath(os.path.expanduser(OPTIONS.get('--state-dir'))),
+        coordinator=OPTIONS.get('--coordinator'),
+        worker=OPTIONS.get('--worker'),
+        watch=bool(OPTIONS.get('--watch')),
+        watch_delay=OPTIONS.get('--watch-delay'),
+        control_socket=OPTIONS.get('--control-socket') and os.path.abspath(
+            os.path.expanduser(OPTIONS['--control-socket'])),
+        quiet=False,
+    )
+    # Sanity checks.
+    if config['threads'] == 'automatic':
+        config['threads'] = os.sysconf('SC_NPROCESSORS_ONLN') or 1
+    elif not str(config['threads']).isdigit() or not int(config['threads']):
+        logging.error('--threads is not an integer or is zero: {}'.format(config['threads']))
+        raise ValueError
+    else:
+        config['threads'] = int(config['threads'])
+    if config['tag_processes'] == 'automatic':
+        config['tag_processes'] = multiprocessing.cpu_count()
+    elif not str(config['tag_processes']).isdigit():
+        logging.error('--tag-processes is not an integer: {}'.format(config['tag_processes']))
+        raise ValueError
+    else:
+        config['tag_processes'] = int(config['tag_processes'])
+    for key in ('art_cache_size', 'art_quality', 'art_size', 'encode_cache_size', 'prefetch', 'prefetch_size',
+                'scratch_size', 'writers', 'write_buffer', 'fsync_interval',
+                'retries', 'timeout_factor', 'chunk_seconds', 'chunk_threshold', 'watch_delay', 'verify_age'):
+        if not str(config[key]).isdigit():
+            logging.error('--{} is not an integer: {}'.format(key.replace('_', '-'), config[key]))
+            raise ValueError
+        config[key] = int(config[key])
+    if (config['art_size'] or config['folder_art']) and Image is None:
+        logging.error('--{} requires Pillow, install it with: pip install Pillow'.format(
+            'art-size' if config['art_size'] else 'folder-art'))
+        raise ValueError
+    if config['replaygain'] and numpy is None:
+        logging.error('--replaygain requires NumPy, install it with: pip install numpy')
+        raise ValueError
+    for target in config['targets']:
+        if len(target) != 2 or target[1] not in ENCODER_PROFILES:
+            logging.error('--target is not DIR:PROFILE with a valid profile: {}'.format(':'.join(target)))
+            raise ValueError
+    config['targets'] = [(os.path.abspath(os.path.expanduser(d)), p) for d, p in config['targets']]
+    for mp3_dir, profile in config['targets']:
+        if not os.path.isdir(mp3_dir) or not os.access(mp3_dir, os.W_OK | os.R_OK | os.X_OK):
+            logging.error('--target directory does not exist or is not writable: {}'.format(mp3_dir))
+            raise ValueError
+    if config['profile'] not in ENCODER_PROFILES:
+        logging.error('--profile is not one of {}: {}'.format(', '.join(sorted(ENCODER_PROFILES)), config['profile']))
+        raise ValueError
+    for encoder_name in {ENCODER_PROFILES[p][0] for p in [config['profile']] + [t[1] for t in config['targets']]}:
+        attribute = ENCODERS[encoder_name].binary_attribute
+        if encoder_name != 'mp3' and not os.access(config[attribute], os.R_OK | os.X_OK):
+            logging.error('--{}-bin-path is not readable or no execute permissions: {}'.format(
+                attribute[:-4], config[attribute]))
+            raise ValueError
+    for key, policies in (('on_delete', ('ask', 'delete', 'keep')), ('on_tag_warnings', ('ask', 'convert', 'skip'))):
+        if config[key] not in policies:
+            logging.error('--{} is not one of {}: {}'.format(key.replace('_', '-'), ', '.join(policies), config[key]))
+            raise ValueError
+    if config['shard']:
+        index, _, count = config['shard'].partition('/')
+        if not index.isdigit() or not count.isdigit() or not 1 <= int(index) <= int(count):
+            logging.error('--shard is not I/N with 1 <= I <= N: {}'.format(config['shard']))
+            raise ValueError
+        if config['shard_by'] not in ('album', 'path'):
+            logging.error('--shard-by is not album or path: {}'.format(config['shard_by']))
+            raise ValueError
+        config['shard'] = (int(index) - 1, int(count), config['shard_by'])
+    try:
+        config['where'] = [Index.parse_filter(w) for w in config['where']]
+    except ValueError as exc:
+        logging.error('--where is not FIELD=VALUE, FIELD!=VALUE or FIELD~TEXT with a field of {}: {}'.format(
+            ', '.join(Index.FIELDS), exc.args[0]))
+        raise ValueError
+    if config['group_by'] not in Index.GROUPS:
+        logging.error('--group-by is not one of {}: {}'.format(', '.join(Index.GROUPS), config['group_by']))
+        raise ValueError
+    if config['durability'] not in Durability.MODES:
+        logging.error('--durability is not one of {}: {}'.format(', '.join(Durability.MODES), config['durability']))
+        raise ValueError
+    if config['watch'] and not sys.platform.startswith('linux'):
+        logging.error('--watch requires Linux (inotify).')
         raise ValueError
-    if not os.access(OPTIONS['flac_dir'], os.R_OK | os.X_OK):
-        logging.error('<flac_dir> is not readable or no execute permissions: {}'.format(OPTIONS['flac_dir']))
+    if config['plan'] and (config['run_plan'] or config['watch'] or config['coordinator']):
+        logging.error('--plan can not be used with --run-plan, --watch or --coordinator, it only scans.')
         raise ValueError
-    if not os.path.isdir(OPTIONS['mp3_dir']):
-        logging.error('<mp3_dir> is not a directory or does not exist: {}'.format(OPTIONS['mp3_dir']))
+    if config['control_socket'] and not config['watch']:
+        logging.error('--control-socket requires --watch.')
         raise ValueError
-    if not os.access(OPTIONS['mp3_dir'], os.W_OK | os.R_OK | os.X_OK):
-        logging.error('<mp3_dir> is not readable, writable, or no execute permissions: {}'.format(OPTIONS['mp3_dir']))
+    for key in ('coordinator', 'worker'):
+        if config[key] and '/' not in config[key] and not config[key].rpartition(':')[2].isdigit():
+            logging.error('--{} is not HOST:PORT or a Unix socket path: {}'.format(key, config[key]))
+            raise ValueError
+    if config['coordinator'] and (config['scratch_dir'] or config['replaygain']):
+        logging.error('--coordinator can not be used with --scratch-dir or --replaygain, workers encode elsewhere.')
+        raise ValueError
+    if config['writers'] and not config['scratch_dir']:
+        logging.error('--writers requires --scratch-dir.')
+        raise ValueError
+    if config['prefetch_dir'] and not os.access(config['prefetch_dir'], os.W_OK | os.R_OK | os.X_OK):
+        logging.error('--prefetch-dir is not a writable directory: {}'.format(config['prefetch_dir']))
+        raise ValueError
+    if config['scratch_dir'] and not os.access(config['scratch_dir'], os.W_OK | os.R_OK | os.X_OK):
+        logging.error('--scratch-dir is not a writable directory: {}'.format(config['scratch_dir']))
+        raise ValueError
+    if config['encode_cache'] and not os.access(config['encode_cache'], os.W_OK | os.R_OK | os.X_OK):
+        logging.error('--encode-cache is not a writable directory: {}'.format(config['encode_cache']))
+        raise ValueError
+    if not os.path.isdir(config['state_dir']):
+        try:
+            os.makedirs(config['state_dir'])
+        except OSError:
+            logging.error('--state-dir cannot be created: {}'.format(config['state_dir']))
+            raise ValueError
+    if config['art_cache'] and not os.path.isdir(config['art_cache']):
+        logging.error('--art-cache is not a directory or does not exist: {}'.format(config['art_cache']))
+        raise ValueError
+    if config['query']:
+        if not os.path.isdir(config['flac_dir']):
+            logging.error('<flac_dir> is not a directory or does not exist: {}'.format(config['flac_dir']))
+            raise ValueError
+        return config  # Queries only read the index.
+    if not os.path.isfile(config['flac_bin']):
+        logging.error('--flac-bin-path is not a file or does not exist: {}'.format(config['flac_bin']))
+        raise ValueError
+    if not os.access(config['flac_bin'], os.R_OK | os.X_OK):
+        logging.error('--flac-bin-path is not readable or no execute permissions: {}'.format(config['flac_bin']))
+        raise ValueError
+    if not os.path.isfile(config['lame_bin']):
+        logging.error('--lame-bin-path is not a file or does not exist: {}'.format(config['lame_bin']))
+        raise ValueError
+    if not os.access(config['lame_bin'], os.R_OK | os.X_OK):
+        logging.error('--lame-bin-path is not readable or no execute permissions: {}'.format(config['lame_bin']))
+        raise ValueError
+    if config['worker']:
+        return config  # Workers get their directories from the coordinator.
+    if not os.path.isdir(config['flac_dir']):
+        logging.error('<flac_dir> is not a directory or does not exist: {}'.format(config['flac_dir']))
+        raise ValueError
+    if not os.access(config['flac_dir'], os.R_OK | os.X_OK):
+        logging.error('<flac_dir> is not readable or no execute permissions: {}'.format(config['flac_dir']))
+        raise ValueError
+    if not os.path.isdir(config['mp3_dir']):
+        logging.error('<mp3_dir> is not a directory or does not exist: {}'.format(config['mp3_dir']))
+        raise ValueError
+    if not os.access(config['mp3_dir'], os.W_OK | os.R_OK | os.X_OK):
+        logging.error('<mp3_dir> is not readable, writable, or no execute permissions: {}'.format(config['mp3_dir']))
         raise ValueError
     return config
 
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, lambda *_: error('', 0))  # Properly handle Control+C
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    try:
+        OPTIONS.update(validate_options())
+    except ValueError:
+        sys.exit(1)
     main()
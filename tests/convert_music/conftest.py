@@ -1,8 +1,79 @@
+import os
+import shutil
+import textwrap
+
+from mutagen.flac import FLAC, Picture
 import pytest
 
-from convert_music import OPTIONS
+from convert_music import OPTIONS, ConvertFiles
+
+HERE = os.path.dirname(__file__)
+
+FAKE_FLAC = """\
+    #!/bin/bash
+    case "$(basename "${{@: -1}}")" in
+        bad*) echo "corrupt" >&2; exit 1 ;;
+        slow*) exec sleep 30 ;;
+    esac
+    if [ "$3" == "-o" ]; then cp "$5" "$4"; else cat "${{@: -1}}"; fi
+"""
+FAKE_LAME = """\
+    #!/bin/bash
+    if [ "${{@: -2:1}}" == "-" ]; then cat > /dev/null; fi
+    cp '{mp3}' "${{@: -1}}"
+"""
 
 
 @pytest.fixture(autouse=True, scope='function')
 def reset_options():
     OPTIONS.clear()
+
+
+@pytest.fixture
+def install_bins(tmpdir, request):
+    """Returns a function writing fake flac/lame binaries and making ConvertFiles use them until the test ends.
+
+    Scripts are dedented and formatted with tmpdir and mp3 (the path of a real mp3), so literal braces are doubled.
+    The defaults: flac fails for FLACs named bad*, hangs for slow*, else copies the FLAC to the wav path or stdout.
+    lame reads stdin if it's the input and copies a real mp3 to its output path.
+    """
+    old = ConvertFiles.flac_bin, ConvertFiles.lame_bin
+
+    def fin():
+        ConvertFiles.flac_bin, ConvertFiles.lame_bin = old
+    request.addfinalizer(fin)
+
+    def install(flac=FAKE_FLAC, lame=FAKE_LAME):
+        bin_dir = tmpdir.join('bin').ensure(dir=True)
+        paths = list()
+        for name, script in (('flac', flac), ('lame', lame)):
+            path = bin_dir.join(name)
+            path.write(textwrap.dedent(script).format(tmpdir=str(tmpdir), mp3=os.path.join(HERE, '1khz_sine.mp3')))
+            path.chmod(0o755)
+            paths.append(str(path))
+        ConvertFiles.flac_bin, ConvertFiles.lame_bin = paths
+        return tuple(paths)
+    return install
+
+
+@pytest.fixture
+def fake_bins(install_bins):
+    """Default fake flac/lame binaries, see install_bins()."""
+    return install_bins()
+
+
+def make_flac(flac_dir, name, picture=False, **tags):
+    """Copies the one second test FLAC to flac_dir/name (creating directories), sets tags and optionally a front cover,
+    and returns its real path."""
+    path = str(flac_dir.join(name).ensure(file=True).realpath())
+    shutil.copy(os.path.join(HERE, '1khz_sine.flac'), path)
+    flac_tags = FLAC(path)
+    flac_tags.update(tags)
+    if picture:
+        image = Picture()
+        image.type, image.mime = 3, 'image/jpeg'
+        with open(os.path.join(HERE, '1_album_art.jpg'), 'rb') as f:
+            image.data = f.read()
+        flac_tags.add_picture(image)
+    flac_tags.save()
+    return path
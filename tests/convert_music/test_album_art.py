@@ -0,0 +1,130 @@
+import Queue
+import io
+import os
+
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import ID3
+import pytest
+
+from convert_music import FOLDER_ART_NAME, AlbumArtCache, ConvertFiles, build_outputs, find_files
+from .conftest import make_flac
+
+with open(os.path.join(os.path.dirname(__file__), '1_album_art.jpg'), 'rb') as _f:
+    ART = _f.read()
+
+
+@pytest.fixture
+def art_cache(request):
+    def fin():
+        ConvertFiles.art_cache = None
+    request.addfinalizer(fin)
+
+
+def make_png(size):
+    image = pytest.importorskip('PIL.Image').new('RGB', (size, size), (200, 10, 10))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def test_passthrough_once():
+    """Test that identical pictures are only converted once when not resizing."""
+    cache = AlbumArtCache()
+    assert ('image/jpeg', ART) == cache.get(ART, 'image/jpeg')
+    assert ('image/jpeg', ART) == cache.get(ART, 'image/jpeg')
+    assert dict(hits=1, conversions=1) == cache.stats
+
+
+def test_resize():
+    """Test scaling a large PNG down to a JPEG."""
+    image_module = pytest.importorskip('PIL.Image')
+    png = make_png(600)
+    cache = AlbumArtCache(max_size=100)
+    mime, data = cache.get(png, 'image/png')
+    assert 'image/jpeg' == mime
+    assert len(data) < len(png)
+    assert (100, 100) == image_module.open(io.BytesIO(data)).size
+
+
+def test_memory_lru():
+    """Test that the least recently used picture is evicted when over budget."""
+    cache = AlbumArtCache(memory_budget=25)
+    for data in ('a' * 10, 'b' * 10, 'a' * 10, 'c' * 10):
+        cache.get(data.encode('ascii'), 'image/jpeg')
+    assert [cache.key(b'a' * 10), cache.key(b'c' * 10)] == list(cache.memory)
+    assert 20 == cache.memory_bytes
+
+
+def test_disk_cache(tmpdir):
+    """Test that converted pictures survive between cache instances and the disk budget is enforced."""
+    cache_dir = str(tmpdir.mkdir('art').realpath())
+    cache = AlbumArtCache(cache_dir=cache_dir, disk_budget=25)
+    cache.get(b'a' * 10, 'image/jpeg')
+    assert [cache.key(b'a' * 10) + '.jpg'] == os.listdir(cache_dir)
+
+    cache = AlbumArtCache(cache_dir=cache_dir, disk_budget=25)
+    assert ('image/jpeg', b'a' * 10) == cache.get(b'a' * 10, 'image/jpeg')
+    assert dict(hits=1, conversions=0) == cache.stats
+    os.utime(os.path.join(cache_dir, cache.key(b'a' * 10) + '.jpg'), (1, 1))
+    cache.get(b'b' * 10, 'image/jpeg')
+    cache.get(b'c' * 10, 'image/jpeg')
+    assert sorted([cache.key(b'b' * 10) + '.jpg', cache.key(b'c' * 10) + '.jpg']) == sorted(os.listdir(cache_dir))
+
+
+def test_folder_art(tmpdir, art_cache):
+    """Test writing folder.jpg instead of embedding album art, and deleting it once its FLACs are gone."""
+    flac = tmpdir.mkdir('flac').join('song.flac').ensure(file=True)
+    mp3 = tmpdir.mkdir('mp3').join('song.mp3').ensure(file=True)
+    with open(os.path.join(os.path.dirname(__file__), '1khz_sine.flac'), 'rb') as f:
+        flac.write(f.read(), 'wb')
+    with open(os.path.join(os.path.dirname(__file__), '1khz_sine.mp3'), 'rb') as f:
+        mp3.write(f.read(), 'wb')
+    flac, mp3 = str(flac.realpath()), str(mp3.realpath())
+    tags = FLAC(flac)
+    image = Picture()
+    image.type, image.mime, image.data = 3, 'image/jpeg', ART
+    tags.add_picture(image)
+    tags.save()
+    ConvertFiles.art_cache = AlbumArtCache(folder_art=True)
+    ConvertFiles.write_tags(flac, mp3)
+    assert 'APIC:' not in ID3(mp3)
+    with open(str(tmpdir.join('mp3', FOLDER_ART_NAME)), 'rb') as f:
+        assert ART == f.read()
+
+    # folder.jpg isn't a foreign file.
+    assert [] == find_files(str(tmpdir.join('flac')), str(tmpdir.join('mp3')))[3]
+    # Stale folder.jpg is deleted.
+    stale = tmpdir.join('mp3').mkdir('Old').join(FOLDER_ART_NAME).ensure(file=True)
+    assert str(stale.realpath()) in find_files(str(tmpdir.join('flac')), str(tmpdir.join('mp3')))[1]
+
+
+def test_folder_art_scratch(tmpdir, art_cache, fake_bins):
+    """Test that folder.jpg goes next to the outputs, not into the scratch directory."""
+    flac_dir, mp3_dir, scratch_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3'), tmpdir.mkdir('scratch')
+    flac = make_flac(flac_dir.mkdir('Album'), 'song.flac', picture=True)
+    mp3_dir.mkdir('Album')
+    ConvertFiles.art_cache = AlbumArtCache(folder_art=True)
+    queue = Queue.Queue()
+    queue.put((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')], str(scratch_dir)), []))
+    ConvertFiles(queue).run()
+    assert [] == scratch_dir.listdir()
+    assert [FOLDER_ART_NAME, 'song.mp3'] == sorted(os.listdir(str(mp3_dir.join('Album'))))
+    with open(str(mp3_dir.join('Album', FOLDER_ART_NAME)), 'rb') as f:
+        assert ART == f.read()
+
+
+def test_folder_art_png(tmpdir, art_cache):
+    """Test that a PNG cover is written to folder.jpg as a JPEG."""
+    flac = make_flac(tmpdir.mkdir('flac'), 'song.flac')
+    mp3 = str(tmpdir.mkdir('mp3').join('song.mp3'))
+    with open(os.path.join(os.path.dirname(__file__), '1khz_sine.mp3'), 'rb') as f, open(mp3, 'wb') as out:
+        out.write(f.read())
+    tags = FLAC(flac)
+    image = Picture()
+    image.type, image.mime, image.data = 3, 'image/png', make_png(50)
+    tags.add_picture(image)
+    tags.save()
+    ConvertFiles.art_cache = AlbumArtCache(folder_art=True)
+    ConvertFiles.write_tags(flac, mp3)
+    with open(str(tmpdir.join('mp3', FOLDER_ART_NAME)), 'rb') as f:
+        assert f.read().startswith(b'\xff\xd8')  # JPEG start of image marker, not PNG's.
@@ -0,0 +1,104 @@
+import Queue
+import os
+import struct
+
+import pytest
+
+from convert_music import ConvertFiles, build_outputs, crc16, join_mp3_segments, mp3_frames, xing_offset
+from .conftest import make_flac
+
+HERE = os.path.dirname(__file__)
+with open(os.path.join(HERE, '1khz_sine.mp3'), 'rb') as _f:
+    MP3 = bytearray(_f.read())
+
+
+@pytest.fixture
+def fake_bins(install_bins, request):
+    """lame logs its arguments and writes a real mp3 to its output path, or garbage when encoding a segment."""
+    def fin():
+        ConvertFiles.chunk_threshold, ConvertFiles.chunk_seconds, ConvertFiles.chunk_jobs = 0, 300, 1
+    request.addfinalizer(fin)
+    return install_bins(lame="""\
+        #!/bin/bash
+        cat > /dev/null
+        echo "$@" >> '{tmpdir}/lame.log'
+        if [[ "$*" == *--nores* ]]; then echo garbage > "${{@: -1}}"; else cp '{mp3}' "${{@: -1}}"; fi
+    """)
+
+
+def test_plan_segments():
+    """Test that segments start on frame boundaries and overlap by the warm up frames."""
+    segments = ConvertFiles.plan_segments(1152 * 100, 44100, 1152 * 20 / 44100.0)
+    assert [(0, 1152 * 24, 0, 20), (1152 * 16, 1152 * 44, 4, 20), (1152 * 36, 1152 * 64, 4, 20),
+            (1152 * 56, 1152 * 84, 4, 20), (1152 * 76, None, 4, None)] == segments
+    assert [(0, None, 0, None)] == ConvertFiles.plan_segments(1152 * 100, 44100, 60)
+
+
+def test_mp3_frames():
+    """Test finding the frames of an mp3 file with an ID3v2 tag and an Info frame."""
+    frames, sample_rate, samples_per_frame = mp3_frames(MP3)
+    assert 41 == len(frames)
+    assert (44100, 1152) == (sample_rate, samples_per_frame)
+    assert len(MP3) == frames[-1][0] + frames[-1][1]
+    assert xing_offset(MP3, frames[0][0]) is not None
+    assert xing_offset(MP3, frames[1][0]) is None
+
+
+def test_join():
+    """Test that overlapping segments join into the same file as encoding the whole audio."""
+    def cut(first, count=None):
+        return join_mp3_segments([(MP3, first, count)])
+
+    whole = cut(0)
+    joined = join_mp3_segments([(cut(0, 14), 0, 10), (cut(6, 18), 4, 10), (cut(16), 4, None)])
+    assert whole == joined
+    frames = mp3_frames(bytearray(joined))[0]
+    assert 41 == len(frames)
+    tag = xing_offset(bytearray(joined), 0)
+    assert (40, len(joined)) == struct.unpack('>II', joined[tag + 8:tag + 16])
+
+    with pytest.raises(ValueError):
+        join_mp3_segments([(cut(0, 14), 0, 15), (cut(6), 4, None)])
+
+
+def test_join_lame_tag():
+    """Test updating the LAME tag: padding of the last segment, music length and CRCs."""
+    frames = mp3_frames(MP3)[0]
+    lame = xing_offset(MP3, frames[0][0]) + 116
+    first, last = bytearray(MP3), bytearray(MP3)
+    first[lame:lame + 4] = last[lame:lame + 4] = b'LAME'
+    first[lame + 21:lame + 24] = b'\x24\x00\x00'  # Delay 576, padding 0.
+    first[lame + 28:lame + 32] = struct.pack('>I', len(MP3) - frames[0][0])  # Music length of the segment.
+    last[lame + 21:lame + 24] = b'\x00\x04\x56'  # Delay 0, padding 1110.
+    joined = bytearray(join_mp3_segments([(first, 0, 20), (last, 20, None)]))
+
+    lame -= frames[0][0]  # No ID3 tag in the joined file.
+    assert b'\x24\x04\x56' == joined[lame + 21:lame + 24]
+    assert len(joined) == struct.unpack('>I', bytes(joined[lame + 28:lame + 32]))[0]
+    assert crc16(joined[frames[0][1]:]) == struct.unpack('>H', bytes(joined[lame + 32:lame + 34]))[0]
+    assert crc16(joined[:lame + 34]) == struct.unpack('>H', bytes(joined[lame + 34:lame + 36]))[0]
+
+
+def test_crc16():
+    """Test the CRC-16 check value."""
+    assert 0xBB3D == crc16(b'123456789')
+
+
+def test_convert_chunked_fallback(tmpdir, fake_bins):
+    """Test encoding segments in parallel, and falling back to encoding the whole file when they can't be joined."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    flac = make_flac(flac_dir, 'song.flac')
+    ConvertFiles.chunk_threshold, ConvertFiles.chunk_seconds, ConvertFiles.chunk_jobs = 0.5, 0.2, 3
+    assert ConvertFiles(None).chunkable(flac, 'v0')
+    assert not ConvertFiles(None).chunkable(flac, 'phone')
+    queue = Queue.Queue()
+    queue.put((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')]), []))
+    ConvertFiles(queue).run()
+
+    assert ['song.mp3'] == os.listdir(str(mp3_dir))
+    with open(str(tmpdir.join('lame.log'))) as f:
+        commands = f.read().splitlines()
+    assert 6 == len(commands)
+    assert all('--nores' in c for c in commands[:5])
+    assert '--nores' not in commands[5]  # Fallback.
+    assert [] == [p for p in os.listdir(str(mp3_dir)) if p.endswith('.part')]
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import time
+
+from mutagen.flac import FLAC
+
+from .conftest import make_flac
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', '..', 'convert_music.py')
+
+
+def run(*argv, **kwargs):
+    """Runs the script like a user would, returns its exit status and output. Keyword argument answers is written to
+    its stdin."""
+    process = subprocess.Popen([sys.executable, SCRIPT] + list(argv), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate(kwargs.get('answers', b''))[0].decode('utf-8')
+    return process.returncode, output
+
+
+def test_convert_and_query(tmpdir, fake_bins):
+    """Test a plain conversion and querying the index it left behind."""
+    flac_dir, mp3_dir, state_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3'), tmpdir.join('state')
+    make_flac(flac_dir.mkdir('Artist - 2012 - Album'), 'Artist - 2012 - Album - 01 - Title.flac', artist='Artist',
+              date='2012', album='Album', tracknumber='01', title='Title')
+    options = ['--flac-bin-path={}'.format(fake_bins[0]), '--lame-bin-path={}'.format(fake_bins[1]),
+               '--state-dir={}'.format(state_dir), '--threads=2', '-a', '-y']
+    code, output = run(str(flac_dir), str(mp3_dir), *options)
+    assert 0 == code, output
+    assert ['Artist - 2012 - Album - 01 - Title.mp3'] == os.listdir(str(mp3_dir.join('Artist - 2012 - Album')))
+
+    code, output = run('query', str(flac_dir), '--state-dir={}'.format(state_dir))
+    assert 0 == code, output
+    assert 'Artist - 2012 - Album: 1 track' in output
+
+
+def test_all_held(tmpdir, fake_bins):
+    """Test that threads wait for the answers when every file is held back by a question."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    album = flac_dir.mkdir('Artist - 2012 - Album')
+    for number in ('01', '02'):
+        make_flac(album, 'Artist - 2012 - Album - {} - Title.flac'.format(number), artist='Artist', date='2012',
+                  album='Album', tracknumber=number, title='Title')  # No lyrics, a tag warning.
+    options = ['--flac-bin-path={}'.format(fake_bins[0]), '--lame-bin-path={}'.format(fake_bins[1]),
+               '--state-dir={}'.format(tmpdir.join('state')), '--threads=2', '-a']
+    code, output = run(str(flac_dir), str(mp3_dir), *options, answers=b'y\n')
+    assert 0 == code, output
+    assert 'Converting 0 files:' in output
+    assert 2 == len(os.listdir(str(mp3_dir.join('Artist - 2012 - Album'))))
+
+
+def test_invalid_option(tmpdir):
+    """Test that invalid options are reported without a traceback."""
+    code, output = run(str(tmpdir), str(tmpdir), '--threads=abc', '--state-dir={}'.format(tmpdir.join('state')))
+    assert 1 == code
+    assert '--threads is not an integer or is zero: abc\n' == output
+
+
+def test_edited_flac_stays_indexed(tmpdir, fake_bins):
+    """Test that re-converting an edited FLAC keeps it in the index, while deleted FLACs leave it."""
+    flac_dir, mp3_dir, state_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3'), tmpdir.join('state')
+    album = flac_dir.mkdir('Artist - 2012 - Album')
+    paths = [make_flac(album, 'Artist - 2012 - Album - {} - Title.flac'.format(n), artist='Artist', date='2012',
+                       album='Album', tracknumber=n, title='Title') for n in ('01', '02')]
+    options = ['--flac-bin-path={}'.format(fake_bins[0]), '--lame-bin-path={}'.format(fake_bins[1]),
+               '--state-dir={}'.format(state_dir), '-a', '-y']
+    code, output = run(str(flac_dir), str(mp3_dir), *options)
+    assert 0 == code, output
+
+    flac_tags = FLAC(paths[0])
+    flac_tags['genre'] = 'Edited'
+    flac_tags.save()
+    os.utime(paths[0], (time.time() + 10, time.time() + 10))
+    os.remove(paths[1])
+    code, output = run(str(flac_dir), str(mp3_dir), *options, answers=b'\n')  # Confirm deleting both mp3s.
+    assert 0 == code, output
+    assert ['Artist - 2012 - Album - 01 - Title.mp3'] == os.listdir(str(mp3_dir.join('Artist - 2012 - Album')))
+
+    code, output = run('query', str(flac_dir), '--state-dir={}'.format(state_dir))
+    assert 0 == code, output
+    assert 'Artist - 2012 - Album: 1 track' in output
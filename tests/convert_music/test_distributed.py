@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+import pytest
+
+from convert_music import ConvertFiles, Coordinator, Worker, build_outputs
+from .conftest import make_flac
+
+
+@pytest.fixture
+def coordinator(tmpdir, request):
+    coordinator = Coordinator(str(tmpdir.join('coordinator.sock')))
+    request.addfinalizer(coordinator.close)
+    return coordinator
+
+
+def test_encode(tmpdir, fake_bins, coordinator):
+    """Test that workers encode the outputs a coordinator thread waits for, and report failures."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    items = list()
+    for name in ('a.flac', 'b.flac', 'bad.flac'):
+        flac = make_flac(flac_dir, name)
+        items.append((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')])))
+    workers = [Worker(coordinator.address, threads=2, name=n) for n in ('one', 'two')]
+    worker_threads = [threading.Thread(target=w.run) for w in workers]
+    for thread in worker_threads:
+        thread.start()
+
+    errors = dict()
+
+    def wait(flac, outputs):
+        try:
+            coordinator.encode(flac, outputs, threading.Event())
+        except RuntimeError as exc:
+            errors[flac] = str(exc)
+    threads = [threading.Thread(target=wait, args=item) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    coordinator.close()
+    for thread in worker_threads:
+        thread.join()
+
+    assert os.path.isfile(items[0][1][0][1])
+    assert os.path.isfile(items[1][1][0][1])
+    assert not os.path.exists(items[2][1][0][1])
+    assert [items[2][0]] == list(errors)
+    assert errors[items[2][0]].startswith('Worker failed: RuntimeError: Process {} returned 1;'.format(
+        ConvertFiles.flac_bin))
+    assert 3 == coordinator.stats['jobs']
+    assert 2 == coordinator.stats['workers']
+    assert 3 == sum(w.stats['encoded'] + w.stats['failed'] for w in workers)
+
+
+def test_steal_and_lose(coordinator):
+    """Test that an idle worker steals unclaimed jobs, and that jobs of a lost worker are queued again."""
+    coordinator.queue.extend(range(4))
+    coordinator.jobs.update((i, dict(message=dict(id=i), done=False, error=None)) for i in range(4))
+    with coordinator.lock:
+        coordinator.handle('one', dict(type='hello', threads=4))
+        coordinator.handle('two', dict(type='hello', threads=4))
+        assert [0, 1, 2, 3] == [j['id'] for j in coordinator.handle('one', dict(type='take'))['jobs']]
+        assert dict(ok=True) == coordinator.handle('one', dict(type='start', id=0))
+        assert [2, 3] == [j['id'] for j in coordinator.handle('two', dict(type='take'))['jobs']]
+        assert dict(ok=False) == coordinator.handle('one', dict(type='start', id=2))  # Stolen.
+        assert 2 == coordinator.stats['stolen']
+
+        coordinator.lose('one')
+        assert [0, 1] == list(coordinator.queue)
+        assert {} == coordinator.running
+        assert 2 == coordinator.stats['lost']
+        assert 'error' in coordinator.handle('one', dict(type='result', id=0, error=None))
+        assert 'error' in coordinator.handle('one', dict(type='take'))
+        assert not coordinator.jobs[0]['done']
+        assert [0, 1] == [j['id'] for j in coordinator.handle('two', dict(type='take'))['jobs']]
+        assert dict(ok=True) == coordinator.handle('two', dict(type='start', id=0))
+        coordinator.handle('one', dict(type='hello', threads=4))  # Back, but job 0 is two's now.
+        assert dict(ok=False) == coordinator.handle('one', dict(type='result', id=0, error='Killed'))
+        assert not coordinator.jobs[0]['done']
+        assert dict(ok=True) == coordinator.handle('two', dict(type='result', id=0, error=None))
+        assert coordinator.jobs[0]['done'] and coordinator.jobs[0]['error'] is None
+        assert dict(jobs=[], finished=False) == coordinator.handle('two', dict(type='take'))
+        coordinator.closed = True
+        assert dict(jobs=[], finished=True) == coordinator.handle('two', dict(type='take'))
+
+
+def test_lost_worker(tmpdir, fake_bins, coordinator, monkeypatch, request):
+    """Test that a worker dropped for missed heartbeats stops encoding its job instead of crashing."""
+    monkeypatch.setattr('convert_music.HEARTBEAT_SECONDS', 0.2)
+    request.addfinalizer(ConvertFiles.stopping.clear)
+    flac_dir = tmpdir.mkdir('flac')
+    flac = make_flac(flac_dir, 'slow.flac')
+    stopping = threading.Event()
+    waiter = threading.Thread(target=lambda: pytest.raises(RuntimeError, coordinator.encode, flac,
+                                                           build_outputs(flac, str(flac_dir), [(str(tmpdir), 'v0')]),
+                                                           stopping))
+    waiter.start()
+    worker = Worker(coordinator.address, name='one')
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    for _ in range(100):
+        if coordinator.running:
+            break
+        time.sleep(0.05)
+    with coordinator.lock:
+        coordinator.lose('one')
+    thread.join(10)
+    assert [0] == list(coordinator.queue)  # Queued again for other workers.
+    stopping.set()
+    waiter.join(10)
+
+    assert not thread.is_alive()
+    assert worker.lost
+    assert dict(encoded=0, failed=0) == worker.stats
@@ -0,0 +1,99 @@
+import Queue
+import os
+
+from mutagen.id3 import ID3
+import pytest
+
+from convert_music import (OPTIONS, ConvertFiles, build_outputs, find_duplicate_audio, find_files, prepare_jobs,
+                           read_streaminfo_md5)
+from .conftest import make_flac
+
+HERE = os.path.dirname(__file__)
+
+
+@pytest.fixture
+def fake_bins(fake_bins, request):
+    def fin():
+        ConvertFiles.duplicate_stats.update(linked=0, copied=0, bytes_saved=0, seconds_saved=0.0)
+    request.addfinalizer(fin)
+    return fake_bins
+
+
+def test_read_streaminfo_md5(tmpdir):
+    """Test reading the audio MD5 without mutagen."""
+    assert '{:032x}'.format(300734001464203344751254830193343797182) == read_streaminfo_md5(
+        os.path.join(HERE, '1khz_sine.flac'))
+    assert read_streaminfo_md5(str(tmpdir.join('empty.flac').ensure(file=True))) is None
+    assert read_streaminfo_md5(str(tmpdir.join('missing.flac'))) is None
+
+
+def test_find_duplicate_audio(tmpdir):
+    """Test grouping by audio MD5, only merging duplicates whose profiles the primary has."""
+    flac_dir = tmpdir.mkdir('flac')
+    a, b, c = [make_flac(flac_dir, n) for n in ('a.flac', 'b.flac', 'c.flac')]
+    other = str(flac_dir.join('other.flac').ensure(file=True))
+    flac_targets = {a: [('/mp3', 'v0')], b: [('/mp3', 'v0'), ('/phone', 'phone')], c: [('/car', 'cbr128')],
+                    other: [('/mp3', 'v0')]}
+    assert {b: [a]} == find_duplicate_audio(flac_targets)
+
+
+def test_run_duplicates(tmpdir, fake_bins):
+    """Test that duplicates with identical tags are hardlinked and others copied, and all stay in sync."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    flac_dir.mkdir('Album'), flac_dir.mkdir('Best Of'), mp3_dir.mkdir('Album'), mp3_dir.mkdir('Best Of')
+    primary = make_flac(flac_dir, 'Album/song.flac', artist='Artist', title='Song')
+    same = make_flac(flac_dir, 'Best Of/song.flac', artist='Artist', title='Song')
+    different = make_flac(flac_dir, 'Best Of/song2.flac', artist='Artist', title='Song (Remaster)')
+    flac_dir, mp3_dir = str(flac_dir), str(mp3_dir)
+    targets = [(mp3_dir, 'v0')]
+    queue = Queue.Queue()
+    queue.put((primary, build_outputs(primary, flac_dir, targets),
+               [(d, build_outputs(d, flac_dir, targets)) for d in (same, different)]))
+    ConvertFiles(queue).run()
+
+    primary_mp3, same_mp3, different_mp3 = [os.path.splitext(p.replace(flac_dir, mp3_dir))[0] + '.mp3'
+                                            for p in (primary, same, different)]
+    assert os.path.samefile(primary_mp3, same_mp3)
+    assert not os.path.samefile(primary_mp3, different_mp3)
+    assert 'Song (Remaster)' == ID3(different_mp3)['TIT2']
+    assert 'Song' == ID3(same_mp3)['TIT2']
+    assert 1 == ConvertFiles.duplicate_stats['linked']
+    assert 1 == ConvertFiles.duplicate_stats['copied']
+    assert os.path.getsize(primary_mp3) == ConvertFiles.duplicate_stats['bytes_saved']
+    assert {} == find_files(flac_dir, mp3_dir)[0]
+
+
+def test_plan_duplicates_replaygain(tmpdir):
+    """Test that with ReplayGain only duplicates in the primary's album are hardlinked, their album gain is the same."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    primary = make_flac(flac_dir, 'Album/song.flac', artist='Artist', title='Song')
+    same_album = make_flac(flac_dir, 'Album/song (copy).flac', artist='Artist', title='Song')
+    other_album = make_flac(flac_dir, 'Best Of/song.flac', artist='Artist', title='Song')
+    flac_dir, mp3_dir = str(flac_dir), str(mp3_dir)
+    targets = [(mp3_dir, 'v0')]
+    outputs = build_outputs(primary, flac_dir, targets)
+    duplicates = [(d, build_outputs(d, flac_dir, targets)) for d in (same_album, other_album)]
+    os.makedirs(os.path.join(mp3_dir, 'Album'))
+    os.makedirs(os.path.join(mp3_dir, 'Best Of'))
+    with open(outputs[0][1], 'wb') as f:
+        f.write(b'audio')
+
+    _, hardlinks, copies = ConvertFiles.plan_duplicates(primary, outputs, duplicates)
+    assert (2, 0) == (len(hardlinks), len(copies))
+    _, hardlinks, copies = ConvertFiles.plan_duplicates(primary, outputs, duplicates, replaygain=True)
+    assert [duplicates[0][1][0][2]] == [h[2] for h in hardlinks]
+    assert [other_album] == [c[0] for c in copies]
+    with open(copies[0][1], 'rb') as f:
+        assert b'audio' == f.read()
+
+
+def test_duplicate_tag_warnings(tmpdir):
+    """Test that tag warnings of a linked duplicate are reported without holding back its primary."""
+    OPTIONS.update(on_delete=None, on_tag_warnings=None)
+    jobs = [('/flac/a.flac', list(), [('/flac/b.flac', list())]), ('/flac/c.flac', list(), list())]
+    plan = dict(jobs=jobs, delete=list(), mkdir=list(), foreign=list(),
+                tag_warnings={'/flac/b.flac': ['Title mismatch.'], '/flac/c.flac': ['Title mismatch.']})
+    review = prepare_jobs(plan)[0]
+    assert [jobs[0]] == review.ready()
+    assert 1 == len(review.decisions)
+    assert ['c.flac: Title mismatch.'] == review.decisions[0]['lines']
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import convert_music
+from convert_music import Durability, Journal, move_file
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    """Records fsync_path() calls."""
+    calls = list()
+    monkeypatch.setattr(convert_music, 'fsync_path', calls.append)
+    return calls
+
+
+def test_none(fsyncs):
+    """Test that queue items complete right away without any fsync."""
+    done = list()
+    Durability('none').commit(['/mp3/a.mp3'], lambda: done.append('a'))
+    assert ['a'] == done
+    assert [] == fsyncs
+
+
+def test_batched(fsyncs):
+    """Test that queue items only complete after the fsync of their group."""
+    done = list()
+    durability = Durability('batched', interval=3600)
+    durability.commit(['/mp3/A/a.mp3', '/mp3/A/b.mp3'], lambda: done.append('a'))
+    durability.commit(['/mp3/B/c.mp3'], lambda: done.append('c'))
+    assert [] == done
+    assert [] == fsyncs
+    durability.checkpoint()
+    assert ['a', 'c'] == done
+    assert ['/mp3/A/a.mp3', '/mp3/A/b.mp3', '/mp3/B/c.mp3', '/mp3/A', '/mp3/B'] == fsyncs
+    durability.checkpoint()  # Nothing pending.
+    assert dict(fsyncs=5, checkpoints=1) == durability.stats
+
+    durability.interval = 0
+    durability.commit(['/mp3/A/d.mp3'], lambda: done.append('d'))
+    assert ['a', 'c', 'd'] == done
+
+
+def test_strict(tmpdir, fsyncs):
+    """Test that files are flushed before being renamed and their directory right after."""
+    scratch = tmpdir.join('a.mp3.part')
+    scratch.write('data')
+    destination = str(tmpdir.join('a.mp3'))
+    move_file(str(scratch), destination, fsync=True)
+    done = list()
+    Durability('strict').commit([destination], lambda: done.append('a'))
+    assert [str(scratch), str(tmpdir)] == fsyncs
+    assert ['a'] == done
+
+
+def test_journal_sync(tmpdir):
+    """Test that the journal is flushed after a group completes."""
+    path = str(tmpdir.join('test.journal'))
+    journal = Journal(path)
+    journal.write_plan('/flac', [], [('/flac/a.flac', [], [])])
+    durability = Durability('batched', interval=3600, journal=journal)
+    durability.commit([str(tmpdir)], lambda: journal.done('/flac/a.flac'))
+    durability.checkpoint()
+    assert [] == Journal(path).resume('/flac', [])
+    assert os.path.exists(path)
@@ -0,0 +1,67 @@
+import os
+import shutil
+
+import pytest
+
+from convert_music import ConvertFiles, EncodeCache, evict_lru
+
+
+@pytest.fixture
+def flac(tmpdir):
+    path = str(tmpdir.join('song.flac'))
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine.flac'), path)
+    return path
+
+
+@pytest.fixture
+def lame_bin(request):
+    """Any binary works, only its --version output is used in fingerprints."""
+    old = ConvertFiles.lame_bin
+    ConvertFiles.lame_bin = '/bin/echo'
+
+    def fin():
+        ConvertFiles.lame_bin = old
+    request.addfinalizer(fin)
+
+
+def test_store_fetch(tmpdir, flac, lame_bin):
+    """Test a cache miss, storing, and a cache hit."""
+    cache = EncodeCache(str(tmpdir.mkdir('cache')), 1024 ** 2)
+    temp_path = str(tmpdir.join('song.mp3.part'))
+    assert not cache.fetch(flac, 'v0', temp_path)
+    assert not os.path.exists(temp_path)
+
+    with open(temp_path, 'wb') as f:
+        f.write(b'encoded audio')
+    cache.store(flac, 'v0', temp_path)
+    entry = cache.path(flac, 'v0')
+    assert entry.startswith(str(tmpdir.join('cache', '{:032x}-'.format(300734001464203344751254830193343797182))))
+    assert entry.endswith('.mp3')
+    assert [os.path.basename(entry)] == os.listdir(str(tmpdir.join('cache')))
+
+    os.remove(temp_path)
+    assert cache.fetch(flac, 'v0', temp_path)
+    with open(temp_path, 'rb') as f:
+        assert b'encoded audio' == f.read()
+    assert not cache.fetch(flac, 'v2', temp_path)  # Different profile, different key.
+    assert dict(hits=1, misses=2, stored=1) == cache.stats
+
+
+def test_no_md5(tmpdir, lame_bin):
+    """Test that invalid FLAC files are never cached."""
+    flac = str(tmpdir.join('song.flac').ensure(file=True))
+    cache = EncodeCache(str(tmpdir.mkdir('cache')), 1024 ** 2)
+    assert cache.path(flac, 'v0') is None
+    assert not cache.fetch(flac, 'v0', str(tmpdir.join('song.mp3.part')))
+
+
+def test_evict_lru(tmpdir):
+    """Test that the least recently used files are evicted first, but never the one to keep."""
+    cache_dir = tmpdir.mkdir('cache')
+    for i, name in enumerate(['a', 'b', 'c', 'd.part']):
+        entry = cache_dir.join(name)
+        entry.write(b'x' * 10, 'wb')
+        entry.setmtime(1000 + i)
+    cache_dir.join('a').setmtime(2000)
+    evict_lru(str(cache_dir), 20, str(cache_dir.join('b')))
+    assert ['a', 'b', 'd.part'] == sorted(os.listdir(str(cache_dir)))
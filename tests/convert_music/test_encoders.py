@@ -0,0 +1,96 @@
+import os
+import shutil
+
+from mutagen.flac import FLAC, Picture
+import pytest
+
+import convert_music
+from convert_music import (ENCODER_PROFILES, ENCODERS, Mp3Encoder, OpusEncoder, VorbisEncoder, find_files,
+                           sync_metadata_current)
+
+
+def test_commands():
+    """Test encoder command lines."""
+    expected = ['lame', '--quiet', '-h', '-V0', 'in.wav', 'out.mp3']
+    assert expected == Mp3Encoder.command('lame', ['-h', '-V0'], 'in.wav', 'out.mp3')
+    expected = ['opusenc', '--quiet', '--bitrate', '96', '-', 'o.opus']
+    assert expected == OpusEncoder.command('opusenc', ['--bitrate', '96'], '-', 'o.opus')
+    expected = ['oggenc', '--quiet', '-q', '6', '-o', 'o.ogg', 'in.wav']
+    assert expected == VorbisEncoder.command('oggenc', ['-q', '6'], 'in.wav', 'o.ogg')
+    assert all(p[0] in ENCODERS for p in ENCODER_PROFILES.values())
+
+
+@pytest.mark.parametrize('encoder', [OpusEncoder, VorbisEncoder])
+def test_ogg_write_tags(tmpdir, encoder):
+    """Test copying Vorbis comments and album art, and reading back sync metadata."""
+    flac = tmpdir.mkdir('flac').join('song.flac')
+    encoded = tmpdir.mkdir('out').join('song' + encoder.extension)
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine.flac'), str(flac))
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine' + encoder.extension), str(encoded))
+    flac, encoded = str(flac.realpath()), str(encoded.realpath())
+    tags = FLAC(flac)
+    tags.update(dict(artist='Artist2', date='2012', title='Title', unsyncedlyrics='L'))
+    image = Picture()
+    image.type, image.mime = 3, 'image/jpeg'
+    with open(os.path.join(os.path.dirname(__file__), '1_album_art.jpg'), 'rb') as f:
+        image.data = f.read()
+    tags.add_picture(image)
+    tags.save()
+
+    encoder.write_tags(flac, encoded)
+    comments = encoder.tags_class(encoded)
+    assert ['Artist2'] == comments['artist']
+    assert ['L'] == comments['unsyncedlyrics']
+    assert 1 == len(comments['metadata_block_picture'])
+    metadata = encoder.read_sync_metadata(encoded)
+    assert os.path.getsize(encoded) == metadata['mp3_size']
+    assert ({}, [], [], []) == find_files(str(tmpdir.join('flac')), str(tmpdir.join('out')), encoder)
+
+    # Corrupt files are deleted.
+    with open(encoded, 'wb') as f:
+        f.write(b'garbage')
+    assert encoder.read_sync_metadata(encoded) is None
+    assert [encoded] == find_files(str(tmpdir.join('flac')), str(tmpdir.join('out')), encoder)[1]
+
+
+@pytest.mark.parametrize('encoder', [OpusEncoder, VorbisEncoder])
+def test_ogg_sync_metadata_resave(tmpdir, monkeypatch, encoder):
+    """Test that sync metadata is saved again until it describes the file it's stored in, when saving it changes the
+    file size (no padding here)."""
+    flac, encoded = tmpdir.join('song.flac'), tmpdir.join('song' + encoder.extension)
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine.flac'), str(flac))
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine' + encoder.extension), str(encoded))
+    flac, encoded = str(flac), str(encoded)
+    stored = list()
+    sync_metadata = convert_music.sync_metadata
+
+    def spy(*args):
+        stored.append(sync_metadata(*args))
+        return stored[-1]
+    monkeypatch.setattr(convert_music, 'PAD_COMMENT', 0)
+    monkeypatch.setattr(convert_music, 'sync_metadata', spy)
+
+    encoder.write_tags(flac, encoded)
+    assert 3 <= len(stored)
+    assert stored[0] != stored[1]  # The first save made the metadata stale, the second pass fixed it.
+    assert stored[-2] == stored[-1]
+    metadata = encoder.read_sync_metadata(encoded)
+    assert sync_metadata_current(metadata, [int(os.stat(flac).st_mtime), os.path.getsize(flac)], encoded)
+
+
+@pytest.mark.parametrize('encoder', [OpusEncoder, VorbisEncoder])
+def test_ogg_sync_metadata_never_current(tmpdir, monkeypatch, encoder):
+    """Test that sync metadata which never settles is an error, not silently left stale."""
+    flac, encoded = tmpdir.join('song.flac'), tmpdir.join('song' + encoder.extension)
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine.flac'), str(flac))
+    shutil.copy(os.path.join(os.path.dirname(__file__), '1khz_sine' + encoder.extension), str(encoded))
+    calls = list()
+
+    def changing(*_):
+        calls.append(None)
+        return '{{"saves": {}}}'.format(len(calls))
+    monkeypatch.setattr(convert_music, 'sync_metadata', changing)
+
+    with pytest.raises(RuntimeError):
+        encoder.write_tags(str(flac), str(encoded))
+    assert 5 == len(calls)
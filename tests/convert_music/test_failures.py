@@ -0,0 +1,66 @@
+import Queue
+import os
+import time
+
+import pytest
+
+import convert_music
+from convert_music import ConvertFiles, Quarantine, build_outputs
+from .conftest import make_flac
+
+
+@pytest.fixture
+def fake_bins(fake_bins, request, monkeypatch):
+    monkeypatch.setattr(convert_music, 'RETRY_BACKOFF', 0.01)
+
+    def fin():
+        ConvertFiles.retries, ConvertFiles.timeout_factor, ConvertFiles.quarantine = 0, 0, None
+        ConvertFiles.failures.clear()
+    request.addfinalizer(fin)
+    return fake_bins
+
+
+def make_queue(tmpdir, names):
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    queue = Queue.Queue()
+    for name in names:
+        flac = make_flac(flac_dir, name)
+        queue.put((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')]), []))
+    return str(flac_dir), str(mp3_dir), queue
+
+
+def test_retry_quarantine(tmpdir, fake_bins):
+    """Test that a failing file doesn't stop the thread, is retried, then quarantined until it changes."""
+    flac_dir, mp3_dir, queue = make_queue(tmpdir, ['bad.flac', 'good.flac'])
+    bad = os.path.join(flac_dir, 'bad.flac')
+    ConvertFiles.retries = 1
+    ConvertFiles.quarantine = Quarantine(str(tmpdir.join('quarantine.json')))
+    ConvertFiles(queue).run()
+
+    assert ['good.mp3'] == os.listdir(mp3_dir)
+    assert [bad] == list(ConvertFiles.failures)
+    assert 2 == len(ConvertFiles.failures[bad])
+    assert ConvertFiles.failures[bad][0].startswith('RuntimeError: Process {} returned 1;'.format(
+        ConvertFiles.flac_bin))
+    assert 0 == ConvertFiles.retrying
+
+    quarantine = Quarantine(str(tmpdir.join('quarantine.json')))
+    assert quarantine.contains(bad)
+    with open(bad, 'ab') as f:
+        f.write(b'\x00')
+    assert not quarantine.contains(bad)
+
+
+def test_timeout(tmpdir, fake_bins, monkeypatch):
+    """Test that a hung child process is killed."""
+    monkeypatch.setattr(convert_music, 'TIMEOUT_BASE', 0.5)
+    _, mp3_dir, queue = make_queue(tmpdir, ['slow.flac'])
+    ConvertFiles.timeout_factor = 0.01
+    start = time.time()
+    thread = ConvertFiles(queue)
+    thread.start()
+    thread.join(20)
+    assert time.time() - start < 10
+    assert [] == os.listdir(mp3_dir)
+    assert ['Timed out after 1 seconds.'] == list(ConvertFiles.failures.values())[0]
+    assert not ConvertFiles.children
@@ -1,6 +1,7 @@
 import os
 from mutagen.flac import FLAC, Picture
 from convert_music import find_inconsistent_tags
+from .conftest import make_flac
 
 
 def test_invalid_filename(tmpdir):
@@ -213,3 +214,20 @@ def test_two_invalid(tmpdir):
         flac_files[1]: ["Artist mismatch: Artist != Artist2"],
     }
     assert e_messages == a_messages
+
+
+def test_albums(tmpdir):
+    """Test that album checks are opt-in and flag every track of a conflict."""
+    album = tmpdir.mkdir('flac').mkdir('Artist - 2012 - Album')
+    flac_files = []
+    for artist, date in (('Artist', '2012'), ('Artist', '2014')):
+        name = '{} - {} - Album - 01 - Title.flac'.format(artist, date)
+        flac_files.append(make_flac(album, name, artist=artist, date=date, album='Album', tracknumber='01',
+                                    title='Title'))
+    assert {} == find_inconsistent_tags(flac_files, True, True)
+    a_messages = find_inconsistent_tags(flac_files, True, True, albums=True)
+    e_messages = {
+        flac_files[0]: ["Duplicate track number in album: 01"],
+        flac_files[1]: ["Album date mismatch: 2014 != 2012", "Duplicate track number in album: 01"],
+    }
+    assert e_messages == a_messages
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+import pytest
+
+from convert_music import ConvertFiles, Journal, remove_stale_parts
+
+TARGETS = [('/mp3', 'v0'), ('/phone', 'phone')]
+
+
+def make_jobs(tmpdir):
+    jobs = list()
+    for name in ('a', 'b', 'c'):
+        outputs = [[str(tmpdir.join(name + '.wav')), str(tmpdir.join(name + '.mp3.part')), '/mp3/' + name + '.mp3',
+                    'v0']]
+        jobs.append((str(tmpdir.join(name + '.flac')), outputs, []))
+    return jobs
+
+
+def test_resume(tmpdir):
+    """Test that completed queue items aren't resumed and that a torn last line is ignored."""
+    jobs = make_jobs(tmpdir)
+    path = str(tmpdir.join(Journal.name('/flac', TARGETS)))
+    journal = Journal(path)
+    assert journal.resume('/flac', TARGETS) is None
+    journal.write_plan('/flac', TARGETS, jobs)
+    journal.done(jobs[1][0])
+    with open(path, 'a') as f:
+        f.write('{"event": "done", "fl')
+
+    journal = Journal(path)
+    assert [jobs[0], jobs[2]] == journal.resume('/flac', TARGETS)
+    assert all(isinstance(j[0], str) for j in journal.resume('/flac', TARGETS))
+    assert Journal(path).resume('/other', TARGETS) is None
+    assert Journal(path).resume('/flac', TARGETS[:1]) is None
+    journal.finish()
+    assert not os.path.exists(path)
+
+
+def test_name():
+    """Test that different directories get different journals."""
+    assert Journal.name('/flac', TARGETS) == Journal.name('/flac', TARGETS)
+    assert Journal.name('/flac', TARGETS) != Journal.name('/flac', TARGETS[:1])
+
+
+def test_remove_stale_parts(tmpdir):
+    """Test deleting temporary files of an interrupted run."""
+    jobs = make_jobs(tmpdir)
+    tmpdir.join('a.wav').ensure(file=True)
+    tmpdir.join('c.mp3.part').ensure(file=True)
+    tmpdir.join('c.flac').ensure(file=True)
+    assert 2 == remove_stale_parts(jobs)
+    assert ['c.flac'] == os.listdir(str(tmpdir))
+
+
+def test_kill_children(request):
+    """Test that child processes are killed and no new ones are started once stopping."""
+    def fin():
+        ConvertFiles.stopping.clear()
+        ConvertFiles.children.clear()
+    request.addfinalizer(fin)
+
+    process = ConvertFiles.popen(['sleep', '30'])
+    threading.Timer(0.2, ConvertFiles.kill_children).start()
+    start = time.time()
+    process.wait()
+    assert time.time() - start < 10
+    ConvertFiles.reap(process)
+    assert not ConvertFiles.children
+    with pytest.raises(RuntimeError) as e:
+        ConvertFiles.popen(['sleep', '30'])
+    assert 'Stopping, not starting sleep' == e.value.args[0]
+
+
+def test_resume_added(tmpdir):
+    """Test that queue items added to the plan later are resumed too."""
+    jobs = make_jobs(tmpdir)
+    path = str(tmpdir.join(Journal.name('/flac', TARGETS)))
+    journal = Journal(path)
+    journal.write_plan('/flac', TARGETS, jobs[:1])
+    journal.add(jobs[1:])
+    journal.done(jobs[0][0])
+    assert jobs[1:] == Journal(path).resume('/flac', TARGETS)
@@ -0,0 +1,57 @@
+
+import pytest
+
+from convert_music import ConvertFiles, find_target_files
+
+
+@pytest.fixture
+def fake_bins(install_bins):
+    """flac "decodes" by copying the FLAC to stdout, lame copies stdin to its last argument prefixed with its encoder
+    arguments."""
+    return install_bins(flac="""\
+        #!/bin/sh
+        exec cat "$4"
+    """, lame="""\
+        #!/bin/bash
+        args=("$@")
+        echo "${{args[@]:1:$#-3}}" > "${{args[-1]}}"
+        cat >> "${{args[-1]}}"
+    """)
+
+
+def test_find_target_files(tmpdir):
+    """Test that every target keeps its own sync state."""
+    flac_dir = tmpdir.mkdir('flac')
+    mp3_dir1, mp3_dir2 = tmpdir.mkdir('mp3_1'), tmpdir.mkdir('mp3_2')
+    flac = str(flac_dir.mkdir('Artist').join('Artist - 2012 - Album - 01 - Title.flac').ensure(file=True).realpath())
+    orphan = str(mp3_dir2.join('Artist - 2014 - Album - 01 - Title.mp3').ensure(file=True).realpath())
+    mp3_dir1.join('Artist').mkdir()
+    targets = [(str(mp3_dir1.realpath()), 'v0'), (str(mp3_dir2.realpath()), 'phone')]
+
+    flac_files, flac_targets, delete_mp3s, create_dirs, foreign_files = find_target_files(str(flac_dir.realpath()),
+                                                                                          targets)
+    assert [flac] == list(flac_files)
+    assert {flac: targets} == flac_targets
+    assert [orphan] == delete_mp3s
+    assert [str(mp3_dir2.join('Artist'))] == create_dirs
+    assert [] == foreign_files
+
+
+def test_convert_multi(tmpdir, fake_bins):
+    """Test that one decode is streamed to every encoder."""
+    flac = tmpdir.join('song.flac')
+    flac.write(b'\x00\x01' * 300000, 'wb')
+    outputs = [(str(tmpdir.join('v0.mp3.part')), 'v0'), (str(tmpdir.join('phone.mp3.part')), 'phone')]
+    ConvertFiles(None).convert_multi(str(flac), outputs)
+    with open(outputs[0][0], 'rb') as f:
+        assert b'-h -V0\n' + b'\x00\x01' * 300000 == f.read()
+    with open(outputs[1][0], 'rb') as f:
+        assert b'--abr 64 --resample 32\n' + b'\x00\x01' * 300000 == f.read()
+
+
+def test_convert_multi_bad_flac(tmpdir, fake_bins):
+    """Test with a FLAC the decoder fails on."""
+    outputs = [(str(tmpdir.join('v0.mp3.part')), 'v0'), (str(tmpdir.join('phone.mp3.part')), 'phone')]
+    with pytest.raises(RuntimeError) as e:
+        ConvertFiles(None).convert_multi(str(tmpdir.join('missing.flac')), outputs)
+    assert e.value.args[0].startswith('Process {} returned 1;'.format(fake_bins[0]))
@@ -0,0 +1,29 @@
+import errno
+import os
+
+from convert_music import Mutations
+
+
+def test_run(tmpdir):
+    """Test creating nested directories, renaming into them and deleting, each operation reporting its result."""
+    album = tmpdir.mkdir('album')
+    for i in range(20):
+        album.join('{:02d}.mp3'.format(i)).ensure(file=True)
+    mutations = Mutations(threads=4)
+    new, existing = str(tmpdir.join('new', 'dir')), str(album)
+    mutations.mkdir(new)
+    mutations.mkdir(existing)
+    mutations.rename(str(album.join('00.mp3')), os.path.join(new, '00.mp3'))
+    for i in range(1, 20):
+        mutations.unlink(str(album.join('{:02d}.mp3'.format(i))))
+    missing = ('unlink', str(tmpdir.join('missing.mp3')), None)
+    mutations.unlink(missing[1])
+
+    results = mutations.run()
+    assert 23 == len(results)
+    assert errno.ENOENT == results.pop(missing).errno
+    assert not any(results.values())
+    assert [] == os.listdir(existing)
+    assert ['00.mp3'] == os.listdir(new)
+    assert [] == mutations.operations
+    assert {} == mutations.run()
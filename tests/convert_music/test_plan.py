@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import convert_music
+from convert_music import Throughput, build_outputs, estimate_plan, load_plan, read_streaminfo_length, save_plan
+
+HERE = os.path.dirname(__file__)
+
+
+@pytest.fixture
+def plan(tmpdir, monkeypatch):
+    """Plan converting one FLAC file and deleting an orphaned mp3, whose directory would be left empty."""
+    flac_dir, mp3_dir = str(tmpdir.mkdir('flac').realpath()), str(tmpdir.mkdir('mp3').realpath())
+    flac = os.path.join(flac_dir, 'Album', 'song.flac')
+    os.mkdir(os.path.dirname(flac))
+    shutil.copy(os.path.join(HERE, '1khz_sine.flac'), flac)
+    orphan = tmpdir.join('mp3', 'Old', 'Sub', 'gone.mp3').ensure(file=True)
+    orphan.write(b'\x00' * 1000, 'wb')
+    orphan = str(orphan.realpath())
+    targets = [(mp3_dir, 'v0')]
+    monkeypatch.setitem(convert_music.OPTIONS, 'flac_dir', flac_dir)
+    monkeypatch.setitem(convert_music.OPTIONS, 'threads', 2)
+    return dict(flac_dir=flac_dir, targets=targets, jobs=[(flac, build_outputs(flac, flac_dir, targets), [])],
+                mkdir=[os.path.join(mp3_dir, 'Album')], delete=[orphan], foreign=[],
+                tag_warnings={flac: ['No lyrics.']})
+
+
+def test_read_streaminfo_length(tmpdir):
+    """Test reading the duration from STREAMINFO."""
+    assert 1.0 == read_streaminfo_length(os.path.join(HERE, '1khz_sine.flac'))
+    assert read_streaminfo_length(os.path.join(HERE, '1khz_sine.mp3')) is None
+    assert read_streaminfo_length(str(tmpdir.join('missing.flac'))) is None
+
+
+def test_estimate(plan):
+    """Test the estimates of encoding time and output size, and that no file is changed."""
+    mp3_dir = plan['targets'][0][0]
+    estimate = estimate_plan(plan, 0.5, 2)
+    assert 1.0 == estimate['audio_seconds']
+    assert 1.0 == estimate['encode_seconds']
+    assert [os.path.join(mp3_dir, 'Album', 'song.mp3'), 'v0', 30625] == estimate['convert'][0]['outputs'][0]
+    assert [os.path.join(mp3_dir, 'Old', 'Sub'), os.path.join(mp3_dir, 'Old')] == estimate['rmdir']
+    assert 30625 == estimate['space'][mp3_dir]['output_bytes']
+    assert 1000 == estimate['space'][mp3_dir]['freed_bytes']
+    assert estimate['space'][mp3_dir]['free_bytes'] > 0
+    assert ['Old'] == os.listdir(mp3_dir)
+
+
+def test_save_load(tmpdir, plan):
+    """Test that a saved plan is the input of --run-plan, unless it was made for other directories."""
+    path = str(tmpdir.join('plan.json'))
+    save_plan(path, plan, 20.0, False)
+    with open(path) as f:
+        assert 1.0 == json.load(f)['audio_seconds']
+    loaded = load_plan(path, plan['targets'])
+    assert plan['jobs'] == [(j[0], [tuple(o) for o in j[1]], j[2]) for j in loaded['jobs']]
+    assert all(isinstance(p, str) for p in loaded['delete'] + list(loaded['tag_warnings']))
+    keys = sorted(k for k in plan if k != 'jobs')
+    assert [plan[k] for k in keys] == [loaded[k] for k in keys]
+
+    os.remove(plan['jobs'][0][0])
+    assert [] == load_plan(path, plan['targets'])['jobs']
+    with pytest.raises(SystemExit):
+        load_plan(path, [(plan['targets'][0][0], 'v2')])
+
+
+def test_throughput(tmpdir):
+    """Test that the measured speed survives between runs and that short runs don't change it."""
+    path = str(tmpdir.join('throughput.json'))
+    assert Throughput(path).speed is None
+    Throughput(path).record(60, 10)
+    assert Throughput(path).speed is None
+    Throughput(path).record(3600, 120)
+    assert 30.0 == Throughput(path).speed
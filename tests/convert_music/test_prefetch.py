@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+from convert_music import Prefetcher
+
+
+def make_flacs(tmpdir, count, size=1000):
+    flac_dir = tmpdir.mkdir('flac')
+    paths = list()
+    for i in range(count):
+        path = flac_dir.join('{:02d}.flac'.format(i))
+        path.write(os.urandom(size), 'wb')
+        paths.append(str(path))
+    return paths
+
+
+def wait_for(condition):
+    for _ in range(50):
+        if condition():
+            return
+        time.sleep(0.05)
+
+
+def test_copy(tmpdir):
+    """Test that files are copied into the local directory ahead of the workers and deleted once converted."""
+    paths = make_flacs(tmpdir, 3)
+    cache_dir = str(tmpdir.mkdir('cache'))
+    prefetcher = Prefetcher(paths, 2, 1024 ** 2, cache_dir)
+    prefetcher.start()
+    for path in paths:
+        wait_for(lambda: path in prefetcher.ready)
+        local_path = prefetcher.acquire(path)
+        assert os.path.dirname(local_path) == cache_dir
+        with open(path, 'rb') as f, open(local_path, 'rb') as local:
+            assert f.read() == local.read()
+        prefetcher.release(path)
+        assert not os.path.exists(local_path)
+    prefetcher.join(5)
+    assert [] == os.listdir(cache_dir)
+    assert 3 == prefetcher.stats['prefetched']
+    assert 0 == prefetcher.used
+
+
+def test_page_cache(tmpdir):
+    """Test that without a local directory files are decoded from where they are."""
+    paths = make_flacs(tmpdir, 2)
+    prefetcher = Prefetcher(paths, 1, 1024 ** 2)
+    prefetcher.start()
+    assert paths[0] == prefetcher.acquire(paths[0])
+    prefetcher.release(paths[0])
+    assert paths[1] == prefetcher.acquire(paths[1])
+    prefetcher.release(paths[1])
+    prefetcher.join(5)
+    assert not prefetcher.is_alive()
+
+
+def test_bounds(tmpdir):
+    """Test that prefetching stops at the depth and byte budget, and skips files workers already took."""
+    paths = make_flacs(tmpdir, 5)
+    prefetcher = Prefetcher(paths, 2, 1024 ** 2, str(tmpdir.mkdir('cache')))
+    prefetcher.start()
+    wait_for(lambda: len(prefetcher.ready) == 2)
+    time.sleep(0.1)
+    assert sorted(paths[:2]) == sorted(prefetcher.ready)
+
+    stopping = threading.Event()
+    prefetcher = Prefetcher(paths, 5, 2500, str(tmpdir.mkdir('cache2')), stopping)
+    prefetcher.start()
+    wait_for(lambda: len(prefetcher.ready) == 2)
+    time.sleep(0.1)
+    assert 2 == len(prefetcher.ready)
+    assert paths[4] == prefetcher.acquire(paths[4])  # Not prefetched yet, decoded from where it is.
+    assert 1 == prefetcher.stats['misses']
+    stopping.set()
+    prefetcher.join(5)
+    assert not prefetcher.is_alive()
+
+
+def test_fetch_failed(tmpdir):
+    """Test that a file that couldn't be copied is decoded from where it is and never deleted."""
+    paths = make_flacs(tmpdir, 1)
+    prefetcher = Prefetcher(paths, 1, 1024 ** 2, str(tmpdir.join('missing')))
+    prefetcher.start()
+    wait_for(lambda: paths[0] in prefetcher.ready)
+    assert paths[0] == prefetcher.acquire(paths[0])
+    prefetcher.release(paths[0])
+    prefetcher.join(5)
+    assert os.path.exists(paths[0])
+    assert 0 == prefetcher.used
@@ -0,0 +1,20 @@
+import os
+
+from convert_music import prune_empty_dirs
+
+
+def test_prune(tmpdir):
+    """Test pruning upward from changed directories only, stopping at non-empty ones and the parent directory."""
+    mp3_dir = tmpdir.mkdir('mp3')
+    album = mp3_dir.join('Artist', 'Album').ensure(dir=True)
+    other = mp3_dir.join('Artist', 'Other').ensure(dir=True)
+    mp3_dir.join('Untouched').ensure(dir=True)
+    single = mp3_dir.join('Single').ensure(dir=True)
+    single.join('song.mp3').ensure(file=True)
+    changed = [str(album.realpath()), str(single.realpath()), str(mp3_dir.realpath()), '/elsewhere/dir']
+    expected = [str(album.realpath())]
+    assert expected == prune_empty_dirs(changed, str(mp3_dir.realpath()))
+    assert sorted(['Artist', 'Single', 'Untouched']) == sorted(os.listdir(str(mp3_dir)))
+
+    expected = [str(other.realpath()), str(mp3_dir.join('Artist').realpath())]
+    assert expected == prune_empty_dirs(changed + [str(other.realpath())], str(mp3_dir.realpath()))
@@ -0,0 +1,88 @@
+import Queue
+import errno
+import os
+import threading
+import time
+
+import pytest
+
+from convert_music import ConvertFiles, Publisher, ScratchSpace, build_outputs, find_files
+from .conftest import make_flac
+
+
+def make_file(directory, name, size):
+    path = directory.join(name)
+    path.write(b'x' * size, 'wb')
+    return str(path)
+
+
+def test_publish(tmpdir):
+    """Test that files are moved in place before the callback runs."""
+    scratch, mp3 = tmpdir.mkdir('scratch'), tmpdir.mkdir('mp3')
+    moves = [(make_file(scratch, 'a.part', 10), str(mp3.join('a.mp3'))),
+             (make_file(scratch, 'b.part', 20), str(mp3.join('b.mp3')))]
+    seen = list()
+    publisher = Publisher(2, 1024)
+    publisher.submit(moves, lambda: seen.append(sorted(mp3.listdir())))
+    publisher.close()
+    assert [[mp3.join('a.mp3'), mp3.join('b.mp3')]] == seen
+    assert [] == scratch.listdir()
+    assert dict(published=2, bytes=30, waits=0) == publisher.stats
+
+
+def test_buffer_budget(tmpdir):
+    """Test that submitting blocks only while the buffer budget is used up."""
+    scratch, mp3 = tmpdir.mkdir('scratch'), tmpdir.mkdir('mp3')
+    release = threading.Event()
+    publisher = Publisher(1, 100)
+    publisher.submit([(make_file(scratch, 'a.part', 60), str(mp3.join('a.mp3')))], release.wait)
+    submitted = list()
+    thread = threading.Thread(target=lambda: submitted.append(publisher.submit(
+        [(make_file(scratch, 'b.part', 60), str(mp3.join('b.mp3')))])))
+    thread.start()
+    time.sleep(0.2)
+    assert [] == submitted
+    release.set()
+    thread.join(5)
+    assert [None] == submitted
+    publisher.close()
+    assert 1 == publisher.stats['waits']
+    assert ['a.mp3', 'b.mp3'] == sorted(p.basename for p in mp3.listdir())
+
+
+def test_error(tmpdir):
+    """Test that a failed write is raised by close()."""
+    publisher = Publisher(1, 100)
+    publisher.queue.put(([(str(tmpdir.join('missing.part')), str(tmpdir.join('missing.mp3')))], None, 0))
+    with pytest.raises(OSError):
+        publisher.close()
+
+
+def test_round_trip(tmpdir, fake_bins, monkeypatch, request):
+    """Test that files published across filesystems aren't converted again by the next run."""
+    flac_dir, mp3_dir, scratch_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3'), tmpdir.mkdir('scratch')
+    flac = make_flac(flac_dir.mkdir('Album'), 'song.flac', artist='Artist', title='Title')
+    mp3_dir.mkdir('Album')
+    rename = os.rename
+
+    def fake_rename(src, dst):
+        if src.startswith(str(scratch_dir)):
+            time.sleep(1.1)  # The copy's mtime would be a second later than the one in the sync metadata.
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', fake_rename)
+
+    def fin():
+        ConvertFiles.scratch = ConvertFiles.publisher = None
+    request.addfinalizer(fin)
+    ConvertFiles.scratch, ConvertFiles.publisher = ScratchSpace(1024 ** 2), Publisher(2, 1024 ** 2)
+    queue = Queue.Queue()
+    queue.put((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')], str(scratch_dir)), []))
+    ConvertFiles(queue).run()
+    ConvertFiles.publisher.close()
+
+    assert 1 == ConvertFiles.publisher.stats['published']
+    assert [] == scratch_dir.listdir()
+    assert ['song.mp3'] == os.listdir(str(mp3_dir.join('Album')))
+    flac_files, delete_mp3s = find_files(str(flac_dir), str(mp3_dir))[:2]
+    assert ({}, []) == (flac_files, delete_mp3s)
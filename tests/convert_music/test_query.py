@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from convert_music import Index, find_inconsistent_tags
+from .conftest import make_flac
+
+
+@pytest.fixture
+def library(tmpdir):
+    """Two albums of one-second FLAC files, one track with an invalid file name."""
+    flac_dir = tmpdir.mkdir('flac')
+    paths = list()
+    for artist, date, album, title in (('Artist', '2012', 'Album', 'One'), ('Artist', '2012', 'Album', 'Two'),
+                                       ('Other', '1999', 'Live', 'Three')):
+        name = '{} - {} - {} - {:02d} - {}.flac'.format(artist, date, album, len(paths) + 1, title)
+        paths.append(make_flac(flac_dir, name, artist=artist, date=date, album=album,
+                               tracknumber='{:02d}'.format(len(paths) + 1), title=title))
+    os.rename(paths[2], paths[2].replace(' - 03 - ', ' - 3 - '))
+    paths[2] = paths[2].replace(' - 03 - ', ' - 3 - ')
+    return paths
+
+
+def test_index(tmpdir, library):
+    """Test that validating files indexes them, including files with invalid names, and that the index persists."""
+    path = str(tmpdir.join('test.index.json'))
+    index = Index(path)
+    messages = find_inconsistent_tags(library, ignore_art=True, ignore_lyrics=True, index=index)
+    assert sorted(library) == sorted(index.entries)
+    assert messages[library[2]] == index.entries[library[2]]['warnings']
+    assert 'Two' == index.entries[library[1]]['title']
+    assert 1.0 == index.entries[library[1]]['seconds']
+    assert os.path.getsize(library[1]) == index.entries[library[1]]['size']
+    index.save()
+    assert index.entries == Index(path).entries
+    Index(path).drop(library[0])
+    index.drop(library[0])
+    assert 2 == len(index.entries)
+
+
+@pytest.mark.parametrize('filters,group_by,expected', [
+    ([], 'album', ['Artist - 2012 - Album', 'Other - 1999 - Live']),
+    ([], 'artist', ['Artist', 'Other']),
+    ([('artist', '=', 'artist')], 'album', ['Artist - 2012 - Album']),
+    ([('artist', '!=', 'artist')], 'artist', ['Other']),
+    ([('title', '~', 'o')], 'track', [0, 1]),
+    ([('warnings', '!=', '')], 'track', [2]),
+    ([('has_lyrics', '=', 'false'), ('date', '=', '1999')], 'artist', ['Other']),
+    ([('seconds', '=', '2')], 'album', []),
+])
+def test_query(tmpdir, library, filters, group_by, expected):
+    """Test filtering and grouping the index."""
+    index = Index(str(tmpdir.join('test.index.json')))
+    find_inconsistent_tags(library, ignore_art=True, ignore_lyrics=True, index=index)
+    groups = index.query(filters, group_by)
+    if group_by == 'track':
+        expected = [library[i] for i in expected]
+    assert expected == [g[0] for g in groups]
+    if not filters and group_by == 'album':
+        size = sum(os.path.getsize(p) for p in library[:2])
+        assert ('Artist - 2012 - Album', 2, 2.0, size) == groups[0]
+
+
+def test_parse_filter():
+    """Test parsing --where filters."""
+    assert ('artist', '!=', 'the band') == Index.parse_filter('artist!=The Band')
+    assert ('title', '~', 'a=b') == Index.parse_filter('title~a=b')
+    for text in ('artist', 'bitrate=320', '=x'):
+        with pytest.raises(ValueError):
+            Index.parse_filter(text)
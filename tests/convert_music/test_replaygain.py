@@ -0,0 +1,134 @@
+import os
+import struct
+
+from mutagen.id3 import ID3
+import pytest
+
+from convert_music import ConvertFiles, LoudnessMeter, ReplayGain, build_outputs, find_files, replaygain_tags
+from .conftest import make_flac
+
+numpy = pytest.importorskip('numpy')
+HERE = os.path.dirname(__file__)
+
+
+def make_wav(sample_rate, bits, dbfs, seconds=10, channels=2):
+    """Returns a wav file of a 1 kHz sine at dbfs in every channel."""
+    times = numpy.arange(int(sample_rate * seconds)) / float(sample_rate)
+    samples = numpy.repeat(10 ** (dbfs / 20.0) * numpy.sin(2 * numpy.pi * 1000 * times), channels)
+    values = numpy.round(samples * (2 ** (bits - 1) - 1)).astype('<i4')
+    if bits == 24:
+        data = values.view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    else:
+        data = values.astype('<i{}'.format(bits // 8)).tobytes()
+    frame = channels * bits // 8
+    fmt = struct.pack('<HHIIHH', 1, channels, sample_rate, sample_rate * frame, frame, bits)
+    chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+
+@pytest.fixture
+def fake_bins(install_bins, request):
+    """flac writes the wav named like the FLAC (.wav instead of .flac) to stdout."""
+    def fin():
+        ConvertFiles.replaygain = None
+    request.addfinalizer(fin)
+    return install_bins(flac="""\
+        #!/bin/bash
+        flac="${{@: -1}}"
+        cat "${{flac%.flac}}.wav"
+    """)
+
+
+@pytest.mark.parametrize('sample_rate,bits', [(48000, 16), (44100, 24), (96000, 16)])
+def test_meter(sample_rate, bits):
+    """Test the EBU Tech 3341 reference: a 1 kHz sine at -23 dBFS in both channels is -23 LUFS (+/- 0.1)."""
+    wav = make_wav(sample_rate, bits, -23)
+    meter = LoudnessMeter()
+    for start in range(0, len(wav), 65537):  # Chunks split the header and sample frames.
+        meter.feed(wav[start:start + 65537])
+    blocks, peak = meter.measurement()
+    assert abs(-23 - LoudnessMeter.integrated(blocks)) < 0.1
+    assert abs(10 ** (-23 / 20.0) - peak) < 0.001
+
+
+def test_meter_gating():
+    """Test that silence doesn't lower the loudness and that nothing but silence has none."""
+    loud = numpy.array([10 ** ((-20 + 0.691) / 10)] * 10)
+    assert abs(-20 - LoudnessMeter.integrated(numpy.concatenate((loud, numpy.zeros(30))))) < 0.001
+    assert LoudnessMeter.integrated(numpy.zeros(30)) is None
+
+
+def test_meter_not_wav():
+    """Test that a stream which isn't wav isn't analysed."""
+    meter = LoudnessMeter()
+    meter.feed(b'fLaC' + b'\x00' * 100)
+    assert meter.measurement() is None
+    assert 'Not a wav stream.' == meter.error
+
+
+def test_replaygain_tags():
+    """Test tag values, including Opus R128 gain relative to -23 LUFS."""
+    gains = dict(track_gain=-3.215, track_peak=0.5, album_gain=1.0, album_peak=0.75)
+    expected = dict(REPLAYGAIN_TRACK_GAIN='-3.21 dB', REPLAYGAIN_TRACK_PEAK='0.500000',
+                    REPLAYGAIN_ALBUM_GAIN='1.00 dB', REPLAYGAIN_ALBUM_PEAK='0.750000')
+    assert expected == replaygain_tags(gains)
+    assert dict(R128_TRACK_GAIN='-2103', R128_ALBUM_GAIN='-1024') == replaygain_tags(gains, r128=True)
+
+
+def test_album(tmpdir):
+    """Test that tracks are held back until their album is measured, unless the album isn't converted completely."""
+    album, partial = tmpdir.mkdir('album'), tmpdir.mkdir('partial')
+    flacs = [str(album.join('{}.flac'.format(i)).ensure(file=True)) for i in range(2)]
+    partial.join('other.flac').ensure(file=True)
+    flacs.append(str(partial.join('song.flac').ensure(file=True)))
+    replaygain = ReplayGain(flacs)
+    quiet, loud = numpy.array([10 ** ((-30 + 0.691) / 10)] * 10), numpy.array([10 ** ((-20 + 0.691) / 10)] * 10)
+
+    assert [] == replaygain.add((flacs[0],), (quiet, 0.1), 'a')
+    ready = replaygain.add((flacs[1],), (loud, 0.5), 'b')
+    assert ['a', 'b'] == [r[1] for r in ready]
+    assert abs(12 - ready[0][2]['track_gain']) < 0.001
+    assert abs(2 - ready[1][2]['track_gain']) < 0.001
+    assert abs(ready[0][2]['album_gain'] - ready[1][2]['album_gain']) < 0.001
+    assert 0.5 == ready[0][2]['album_peak']
+
+    ready = replaygain.add((flacs[2],), (loud, 0.5), 'c')
+    assert [((flacs[2],), 'c', dict(track_gain=ready[0][2]['track_gain'], track_peak=0.5))] == ready
+
+
+def test_album_drop(tmpdir):
+    """Test that a track failing for good releases its album's held back tracks with track gain only."""
+    album = tmpdir.mkdir('album')
+    flacs = [str(album.join('{}.flac'.format(i)).ensure(file=True)) for i in range(3)]
+    replaygain = ReplayGain(flacs)
+    loud = numpy.array([10 ** ((-20 + 0.691) / 10)] * 10)
+    assert [] == replaygain.add((flacs[0],), (loud, 0.5), 'a')
+    ready = replaygain.drop(flacs[1])
+    assert [((flacs[0],), 'a')] == [r[:2] for r in ready]
+    assert 'album_gain' not in ready[0][2]
+    assert 'album_gain' not in replaygain.add((flacs[2],), (loud, 0.5), 'c')[0][2]
+
+
+def test_process(tmpdir, fake_bins):
+    """Test measuring loudness while encoding and tagging the album once its last track is done."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    album = flac_dir.mkdir('Album')
+    mp3_dir.mkdir('Album')
+    flacs = list()
+    for i, dbfs in enumerate((-23, -33)):
+        flacs.append(make_flac(album, '{}.flac'.format(i)))
+        album.join('{}.wav'.format(i)).write(make_wav(44100, 16, dbfs), 'wb')
+    ConvertFiles.replaygain = ReplayGain(flacs)
+    thread = ConvertFiles(None)
+    items = [(f, build_outputs(f, str(flac_dir), [(str(mp3_dir), 'v0')]), []) for f in flacs]
+
+    thread.process(*items[0])
+    assert not os.path.exists(items[0][1][0][2])  # Held back, album gain unknown.
+    assert os.path.exists(items[0][1][0][1])
+    thread.process(*items[1])
+    id3 = [ID3(item[1][0][2]) for item in items]
+    assert abs(5 - float(id3[0]['TXXX:REPLAYGAIN_TRACK_GAIN'].text[0][:-3])) < 0.1
+    assert abs(15 - float(id3[1]['TXXX:REPLAYGAIN_TRACK_GAIN'].text[0][:-3])) < 0.1
+    assert id3[0]['TXXX:REPLAYGAIN_ALBUM_GAIN'] == id3[1]['TXXX:REPLAYGAIN_ALBUM_GAIN']
+    assert '0.070' == id3[0]['TXXX:REPLAYGAIN_ALBUM_PEAK'].text[0][:5]
+    assert {} == find_files(str(flac_dir), str(mp3_dir))[0]  # Sync metadata still describes the files.
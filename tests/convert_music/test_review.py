@@ -0,0 +1,52 @@
+import convert_music
+from convert_music import Review
+
+JOBS = [('/flac/a.flac', [], []), ('/flac/b.flac', [], []), ('/flac/c.flac', [], [])]
+
+
+def test_held():
+    """Test that queue items wait for every decision holding them back and are dropped if one is rejected."""
+    review = Review(JOBS)
+    review.add('Delete', ['/mp3/a.mp3', '/mp3/b.mp3'], 'delete', ['/flac/a.flac', '/flac/b.flac'])
+    review.add('Tags', ['b.flac: No lyrics.'], 'convert', ['/flac/b.flac'])
+    assert [JOBS[2]] == review.ready()
+    assert [JOBS[0]] == review.answer(review.decisions[0], True)
+    assert [JOBS[1]] == review.answer(review.decisions[1], True)
+
+    review = Review(JOBS)
+    review.add('Delete', [], 'delete', ['/flac/a.flac', '/flac/b.flac'])
+    review.add('Tags', [], 'convert', ['/flac/b.flac'])
+    assert [] == review.answer(review.decisions[0], False)
+    assert [] == review.answer(review.decisions[1], True)
+
+
+def test_policy():
+    """Test that policy flags answer right away, running the accepted action."""
+    accepted = list()
+    review = Review(JOBS)
+    review.add('Delete', [], 'delete', ['/flac/a.flac'], lambda: accepted.append(True), answer=True)
+    review.add('Tags', [], 'convert', ['/flac/b.flac'], answer=False)
+    assert [] == review.decisions
+    assert [True] == accepted
+    assert [JOBS[0], JOBS[2]] == review.ready()
+
+
+def test_ask(monkeypatch):
+    """Test answering interactively, closing stdin rejects the remaining decisions."""
+    def eof(_):
+        raise EOFError
+    replies = ['', 'n']
+    monkeypatch.setattr(convert_music, 'raw_input', lambda _: replies.pop(0), raising=False)
+    review = Review(JOBS)
+    for path in ('/flac/a.flac', '/flac/b.flac'):
+        review.add('Tags', [path], 'convert', [path])
+    released = list()
+    review.ask(released.extend)
+    assert [JOBS[0]] == released
+    assert [] == review.decisions
+
+    review = Review(JOBS)
+    review.add('Tags', [], 'convert', ['/flac/a.flac'])
+    monkeypatch.setattr(convert_music, 'raw_input', eof, raising=False)
+    review.ask(released.extend)
+    assert [JOBS[0]] == released
@@ -0,0 +1,103 @@
+import Queue
+import errno
+import os
+import threading
+import time
+
+from mutagen.id3 import ID3
+import pytest
+
+from convert_music import ConvertFiles, ScratchSpace, build_outputs, move_file
+from .conftest import make_flac
+
+HERE = os.path.dirname(__file__)
+
+
+@pytest.fixture
+def fake_bins(fake_bins, request):
+    def fin():
+        ConvertFiles.scratch = None
+    request.addfinalizer(fin)
+    return fake_bins
+
+
+def test_build_outputs_scratch():
+    """Test that temporary files go to the scratch directory, with distinct names per output."""
+    outputs = build_outputs('/flac/A/song.flac', '/flac', [('/mp3', 'v0'), ('/opus', 'opus96')], '/dev/shm')
+    assert ['/mp3/A/song.mp3', '/opus/A/song.opus'] == [o[2] for o in outputs]
+    temp_paths = [p for o in outputs for p in o[:2]]
+    assert all(os.path.dirname(p) == '/dev/shm' and p.endswith('.part') for p in temp_paths)
+    assert 4 == len(set(temp_paths))
+
+
+def test_estimate():
+    """Test that the wav is only counted for single output queue items."""
+    flac = os.path.join(HERE, '1khz_sine.flac')
+    size = os.path.getsize(flac)
+    assert size * 2 == ScratchSpace.estimate(flac, [None, None], [])
+    assert size * 2 + 44 + 441000 * 2 * 2 > ScratchSpace.estimate(flac, [None], [(None, [None])]) > size * 2 + 44
+
+
+def test_reserve_waits():
+    """Test that a reservation exceeding the budget waits until another thread releases its bytes."""
+    scratch = ScratchSpace(100)
+    events = list()
+
+    def worker():
+        scratch.reserve(60)
+        events.append('reserved')
+        scratch.release()
+
+    scratch.reserve(60)
+    thread = threading.Thread(target=worker)
+    thread.start()
+    time.sleep(0.2)
+    assert [] == events
+    scratch.release()
+    thread.join(5)
+    assert ['reserved'] == events
+    assert dict(peak=60, waits=1) == scratch.stats
+
+    assert scratch.reserve(500)  # Larger than the budget but nothing else reserved.
+    stopping = threading.Event()
+    stopping.set()
+    result = list()
+    thread = threading.Thread(target=lambda: result.append(scratch.reserve(1, stopping)))
+    thread.start()
+    thread.join(5)
+    assert [False] == result
+
+
+def test_move_file_cross_device(tmpdir, monkeypatch):
+    """Test the copy fallback when the destination is on another filesystem."""
+    source = tmpdir.mkdir('scratch').join('0123.mp3.part')
+    source.write('data')
+    os.utime(str(source), (1000000000, 1000000000))
+    destination = str(tmpdir.mkdir('mp3').join('a.mp3'))
+    rename = os.rename
+
+    def fake_rename(src, dst):
+        if src == str(source):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', fake_rename)
+    move_file(str(source), destination)
+    assert [] == os.listdir(str(tmpdir.join('scratch')))
+    assert ['a.mp3'] == os.listdir(str(tmpdir.join('mp3')))
+    with open(destination) as f:
+        assert 'data' == f.read()
+    assert 1000000000 == int(os.stat(destination).st_mtime)  # Sync metadata still describes the file.
+
+
+def test_run_scratch(tmpdir, fake_bins):
+    """Test converting through the scratch directory, leaving nothing behind in it."""
+    flac_dir, mp3_dir, scratch_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3'), tmpdir.mkdir('scratch')
+    flac = make_flac(flac_dir, 'song.flac')
+    ConvertFiles.scratch = ScratchSpace(1024 ** 2)
+    queue = Queue.Queue()
+    queue.put((flac, build_outputs(flac, str(flac_dir), [(str(mp3_dir), 'v0')], str(scratch_dir)), []))
+    ConvertFiles(queue).run()
+    assert ['song.mp3'] == os.listdir(str(mp3_dir))
+    assert [] == os.listdir(str(scratch_dir))
+    assert 'TPE1' not in ID3(str(mp3_dir.join('song.mp3')))
+    assert {} == ConvertFiles.scratch.reserved
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from convert_music import find_files, shard_filter, shard_of
+
+
+@pytest.fixture
+def library(tmpdir):
+    """FLAC directory with 8 albums of 3 files, mp3 directory with an orphaned mp3 next to every album."""
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    flacs, orphans = list(), list()
+    for album in range(8):
+        name = os.path.join('Artist{}'.format(album % 3), 'Album{}'.format(album))
+        for track in range(3):
+            flacs.append(str(flac_dir.join(name, '{:02d}.flac'.format(track)).ensure(file=True).realpath()))
+        orphans.append(str(mp3_dir.join(name, 'gone.mp3').ensure(file=True).realpath()))
+    return str(flac_dir.realpath()), str(mp3_dir.realpath()), flacs, orphans
+
+
+def test_shard_of():
+    """Test that shards don't depend on the machine or Python version, and that bytes hash like text."""
+    assert [0, 0, 1] == [shard_of(k, 3) for k in ('Artist/Album', 'Other', '')]
+    assert shard_of(b'Artist/Album', 7) == shard_of(u'Artist/Album', 7)
+
+
+@pytest.mark.parametrize('by', ['album', 'path'])
+def test_find_files(library, by):
+    """Test that every file and orphan belongs to exactly one shard, albums staying together if sharded by album."""
+    flac_dir, mp3_dir, flacs, orphans = library
+    found, deleted = list(), list()
+    for index in range(3):
+        flac_files, delete_mp3s, _, _ = find_files(flac_dir, mp3_dir, shard=(index, 3, by))
+        found.append(sorted(flac_files))
+        deleted.extend(delete_mp3s)
+    assert sorted(flacs) == sorted(f for shard in found for f in shard)
+    assert sorted(orphans) == sorted(deleted)
+    assert all(found)
+    if by == 'album':
+        albums = [{os.path.dirname(f) for f in shard} for shard in found]
+        assert sum(len(a) for a in albums) == 8
+        for index, shard in enumerate(found):
+            assert all(shard_of(os.path.dirname(f)[len(flac_dir) + 1:], 3) == index for f in shard)
+
+
+def test_prune(library):
+    """Test that files of other shards aren't stat()ed, a dangling symlink there would raise."""
+    flac_dir, mp3_dir = library[:2]
+    other = [d for d in ('Artist0/Album0', 'Artist1/Album1', 'Artist2/Album2') if shard_of(d, 3) != 0][0]
+    os.symlink(os.path.join(flac_dir, 'missing'), os.path.join(flac_dir, other, 'dangling.flac'))
+    flac_files = find_files(flac_dir, mp3_dir, shard=(0, 3, 'album'))[0]
+    assert not any(os.path.dirname(f).endswith(other) for f in flac_files)
+    with pytest.raises(OSError):
+        find_files(flac_dir, mp3_dir)
+
+
+def test_shard_filter_outputs():
+    """Test that an output belongs to the shard of its FLAC file."""
+    for index in range(4):
+        flacs = shard_filter('/flac', '/flac/A', ['{}.flac'.format(i) for i in range(20)], (index, 4, 'path'))
+        mp3s = shard_filter('/mp3', '/mp3/A', ['{}.mp3'.format(i) for i in range(20)], (index, 4, 'path'))
+        assert [os.path.splitext(f)[0] for f in flacs] == [os.path.splitext(f)[0] for f in mp3s]
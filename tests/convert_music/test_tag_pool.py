@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+
+from mutagen.id3 import ID3
+import pytest
+
+from convert_music import find_inconsistent_tags, init_tag_process, read_flac_tags, write_tags_in_process
+from .conftest import make_flac
+
+
+@pytest.fixture
+def tag_pool(request):
+    pool = multiprocessing.Pool(2, init_tag_process)
+
+    def fin():
+        pool.close()
+        pool.join()
+    request.addfinalizer(fin)
+    return pool
+
+
+def test_read_flac_tags(tmpdir):
+    """Test reading compact tag data from a FLAC file."""
+    flac_dir = tmpdir.mkdir('flac')
+    flac = make_flac(flac_dir, 'song.flac', picture=True, artist='Artist', date='2012', album='Album', tracknumber='01',
+                     title='T')
+    expected = dict(artist='Artist', date='2012', album='Album', discnumber='', tracknumber='01', title='T',
+                    has_picture=True, has_lyrics=False, seconds=1.0)
+    assert expected == read_flac_tags(flac)
+    assert read_flac_tags(str(flac_dir.join('bad.flac').ensure(file=True))) is None
+
+
+def test_find_inconsistent_tags_pool(tmpdir, tag_pool):
+    """Test that the tag pool gives the same results as the main process."""
+    flac_dir = tmpdir.mkdir('flac')
+    paths = [str(flac_dir.join('Artist - 2012 - Album - 01.flac').ensure(file=True).realpath())]
+    paths.append(str(flac_dir.join('Artist - 2012 - Album - 01 - Title.flac').ensure(file=True).realpath()))
+    for i in range(2, 40):
+        name = 'Artist - 2012 - Album - {:02d} - Title.flac'.format(i)
+        paths.append(make_flac(flac_dir, name, picture=True, artist='Artist', date='2012', album='Album',
+                               title='Title', tracknumber='{:02d}'.format(i if i % 3 else i + 1)))
+    expected = find_inconsistent_tags(paths)
+    actual = find_inconsistent_tags(paths, pool=tag_pool)
+    assert expected == actual
+    assert ["Filename doesn't have five items."] == actual[paths[0]]
+    assert ['Invalid file.'] == actual[paths[1]]
+    assert ['Track number mismatch: 03 != 04', 'No lyrics.'] == actual[paths[3]]
+
+
+def test_write_tags_pool(tmpdir, tag_pool):
+    """Test writing tags from a tag pool process."""
+    flac = make_flac(tmpdir.mkdir('flac'), 'song.flac', picture=True, artist='Artist2', title='Title')
+    mp3 = tmpdir.mkdir('mp3').join('song.mp3').ensure(file=True)
+    with open(os.path.join(os.path.dirname(__file__), '1khz_sine.mp3'), 'rb') as f:
+        mp3.write(f.read(), 'wb')
+    mp3 = str(mp3.realpath())
+    tag_pool.apply(write_tags_in_process, (flac, mp3))
+    id3 = ID3(mp3)
+    assert 'Artist2' == id3['TPE1']
+    assert 'Title' == id3['TIT2']
+    with open(os.path.join(os.path.dirname(__file__), '1_album_art.jpg'), 'rb') as f:
+        assert f.read() == id3['APIC:'].data
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+import convert_music
+from convert_music import ALBUM_RULES, TAG_RULES, TagTable
+
+GOOD = dict(artist=u'Artist', date=u'2012', album=u'Album', discnumber=u'', tracknumber=u'01', title=u'Title',
+            has_picture=True, has_lyrics=True)
+
+
+@pytest.fixture(params=['numpy', 'lists'])
+def columns(request, monkeypatch):
+    """Runs a test with NumPy columns (if installed) and with list columns."""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(convert_music, 'numpy', None)
+    return request.param
+
+
+def test_rules(columns):
+    """Test that each rule flags only its rows, in rule order, and that skipped rules aren't evaluated."""
+    rows = [
+        ('/flac/Artist - 2012 - Album - 01 - Title.flac', GOOD),
+        ('/flac/Artist - 12 - Album - 1 - Title.flac', GOOD),
+        ('/flac/Other - 2012 - Album - 02 - Title.flac', dict(GOOD, has_picture=False, has_lyrics=False)),
+        ('/flac/Artist - year - Album - 01 - Titel.flac', dict(GOOD, tracknumber=u'1')),
+    ]
+    table = TagTable(rows)
+    assert {
+        rows[1][0]: ['Filename date not four digits.', 'Filename track number not two digits.'],
+        rows[2][0]: ['Artist mismatch: Other != Artist', 'Track number mismatch: 02 != 01', 'No album art.',
+                     'No lyrics.'],
+        rows[3][0]: ['Title mismatch: Titel != Title', 'Filename date not a number.', 'Track number mismatch: 01 != 1'],
+    } == table.check(TAG_RULES)
+    assert [rows[3][0]] == list(table.check(TAG_RULES, skip={'artist', 'date', 'tracknumber', 'art', 'lyrics'}))
+
+
+def test_unicode(columns):
+    """Test that non-ASCII file names compare to their tags."""
+    path = u'/flac/Sigur Rós - 2002 - () - 01 - Untitled.flac'
+    tags = dict(GOOD, artist=u'Sigur Rós', date=u'2002', album=u'()', title=u'Untitled')
+    assert {} == TagTable([(path.encode('utf-8'), tags)]).check(TAG_RULES)
+    assert {} == TagTable([]).check(TAG_RULES)
+    message = TagTable([(path.encode('utf-8'), dict(tags, artist=u'Sigur Ros'))]).check(TAG_RULES)
+    assert [u'Artist mismatch: Sigur Rós != Sigur Ros'.encode('utf-8')] == list(message.values())[0]
+
+
+def album(directory, tracks):
+    """Returns TagTable() rows of empty FLAC files in a directory, tracks being (track number, tag changes). Only
+    album rules are evaluated, file names don't match the tags."""
+    rows = list()
+    for number, changes in tracks:
+        name = 'Artist - 2012 - Album - {} - Title {}.flac'.format(number, len(rows))
+        rows.append((str(directory.join(name).ensure(file=True)), dict(GOOD, tracknumber=number, **changes)))
+    return rows
+
+
+def test_albums(tmpdir, columns):
+    """Test that date, artist spelling, and track number conflicts and gaps are reported by the tracks concerned."""
+    rows = album(tmpdir.mkdir('a'), [('01', {}), ('02', {}), ('03', dict(date=u'2013')), ('03', {}),
+                                     ('06', dict(artist=u'ARTIST')), ('07', dict(artist=u'Guest'))])
+    rows += album(tmpdir.mkdir('b'), [('01', dict(album=u'Other', date=u'1999')), ('02', {})])
+    assert {
+        rows[2][0]: ['Album date mismatch: 2013 != 2012', 'Duplicate track number in album: 03'],
+        rows[3][0]: ['Duplicate track number in album: 03'],
+        rows[4][0]: ['Album artist spelling: ARTIST != Artist', 'Album is missing track numbers: 04, 05'],
+        rows[7][0]: ['Album is missing track numbers: 01'],
+    } == TagTable(rows).check_albums(ALBUM_RULES)
+
+
+def test_albums_known(tmpdir, columns):
+    """Test that tracks validated by earlier runs count, and that gaps need every file of the directory."""
+    directory = tmpdir.mkdir('a')
+    rows = album(directory, [('01', {}), ('02', {}), ('04', dict(discnumber=u'1/2')), ('01', dict(discnumber=u'2'))])
+    known = dict((p, dict(t)) for p, t in rows[:2])
+    known[rows[1][0]]['date'] = u'2011'
+    directory.join('unknown.flac').ensure(file=True)
+    assert {} == TagTable(rows[2:]).check_albums(ALBUM_RULES, dict(known))
+    directory.join('unknown.flac').remove()
+    messages = TagTable(rows[2:]).check_albums(ALBUM_RULES, known)
+    assert {rows[2][0]: ['Album is missing track numbers: 03']} == messages
+
+
+def test_speed():
+    """Test that a large library is validated in seconds."""
+    pytest.importorskip('numpy')
+    rows = [('/flac/Artist - 2012 - Album {} - 01 - Title.flac'.format(i), dict(GOOD, album=u'Album {}'.format(i)))
+            for i in range(100000)]
+    start = time.time()
+    messages = TagTable(rows).check(TAG_RULES)
+    assert {} == messages
+    assert time.time() - start < 5
@@ -0,0 +1,92 @@
+import os
+import textwrap
+import time
+
+import pytest
+
+import convert_music
+from convert_music import Quarantine, Verified, run_verify, verify_flacs
+
+
+@pytest.fixture
+def fake_flac(tmpdir):
+    """Fake flac binary, "testing" fails for files containing the word corrupt and counts its runs."""
+    flac_bin = tmpdir.mkdir('bin').join('flac')
+    flac_bin.write(textwrap.dedent("""\
+        #!/bin/bash
+        echo "${{@: -1}}" >> '{}'
+        if grep -q corrupt "${{@: -1}}"; then
+            echo "${{@: -1}}: ERROR while decoding data" >&2
+            echo "state = FLAC__STREAM_DECODER_READ_FRAME" >&2
+            exit 1
+        fi
+    """).format(str(tmpdir.join('runs'))))
+    flac_bin.chmod(0o755)
+    return str(flac_bin)
+
+
+@pytest.fixture
+def library(tmpdir, fake_flac, monkeypatch):
+    """FLAC directory with 4 good files and a corrupt one, OPTIONS of a --verify run."""
+    flac_dir = tmpdir.mkdir('flac')
+    paths = [str(flac_dir.join('Album', '{}.flac'.format(i)).ensure(file=True).realpath()) for i in range(5)]
+    with open(paths[2], 'w') as f:
+        f.write('corrupt')
+    state_dir = tmpdir.mkdir('state')
+    for key, value in dict(flac_dir=str(flac_dir.realpath()), state_dir=str(state_dir.realpath()), shard=None,
+                           verify_age=30, flac_bin=fake_flac, threads=3).items():
+        monkeypatch.setitem(convert_music.OPTIONS, key, value)
+    return paths
+
+
+def runs(tmpdir):
+    """Returns the files the fake flac binary tested, clearing the list."""
+    path = str(tmpdir.join('runs'))
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        tested = sorted(f.read().splitlines())
+    os.remove(path)
+    return tested
+
+
+def test_verify_flacs(tmpdir, library, fake_flac):
+    """Test that every file is tested once and flac's last error line is returned for corrupt ones."""
+    failures = verify_flacs(fake_flac, library, 3)
+    assert {library[2]: 'state = FLAC__STREAM_DECODER_READ_FRAME'} == failures
+    assert sorted(library) == runs(tmpdir)
+    assert {} == verify_flacs(fake_flac, [], 3)
+
+
+def test_verified(tmpdir):
+    """Test that files are due again once changed or too old, and that gone files are dropped."""
+    path = str(tmpdir.join('verified.json'))
+    flac = tmpdir.join('song.flac').ensure(file=True)
+    verified = Verified(path)
+    assert verified.due(str(flac), 60)
+    verified.add(str(flac))
+    verified.save()
+    assert not Verified(path).due(str(flac), 60)
+    verified.entries[str(flac)][2] = int(time.time()) - 120
+    assert verified.due(str(flac), 60)
+    flac.write('changed')
+    assert Verified(path).due(str(flac), 60)
+    flac.remove()
+    Verified(path).save()
+    assert {} == Verified(path).entries
+
+
+def test_run_verify(tmpdir, library):
+    """Test that corrupt files are quarantined and that unchanged files aren't tested again."""
+    quarantine = Quarantine(str(tmpdir.join('state', 'quarantine.json')))
+    run_verify(quarantine)
+    assert sorted(library) == runs(tmpdir)
+    assert [library[2]] == list(quarantine.entries)
+    assert quarantine.contains(library[2])
+    assert quarantine.entries[library[2]][2].startswith('Corrupt: ')
+
+    with open(library[0], 'w') as f:
+        f.write('changed')
+    os.utime(library[0], (1, 1))
+    run_verify(Quarantine(str(tmpdir.join('state', 'quarantine.json'))))
+    assert [library[0]] == runs(tmpdir)
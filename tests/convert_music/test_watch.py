@@ -0,0 +1,109 @@
+import json
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+from convert_music import ControlSocket, Watcher
+from .conftest import make_flac
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+
+
+@pytest.fixture
+def watcher(tmpdir, request):
+    flac_dir, mp3_dir = tmpdir.mkdir('flac'), tmpdir.mkdir('mp3')
+    watcher = Watcher(str(flac_dir), [(str(mp3_dir), 'v0')], 0)
+    request.addfinalizer(watcher.inotify.close)
+    return watcher
+
+
+def handle_events(watcher):
+    """Reads events until there are none, returns the FLAC files ready."""
+    while True:
+        events = watcher.inotify.read(0.2)
+        if not events:
+            return watcher.ready(time.time())
+        watcher.handle(events, time.time())
+
+
+def test_new_album(tmpdir, fake_bins, watcher):
+    """Test that FLAC files in a new directory are converted once, without rescanning."""
+    album = tmpdir.join('flac').mkdir('Artist - 2012 - Album')
+    flac = make_flac(album, 'Artist - 2012 - Album - 01 - Title.flac')
+    assert [flac] == handle_events(watcher)
+    watcher.sync([flac])
+    mp3 = str(tmpdir.join('mp3', 'Artist - 2012 - Album', 'Artist - 2012 - Album - 01 - Title.mp3'))
+    assert os.path.isfile(mp3)
+    assert dict(events=watcher.stats['events'], converted=1, deleted=0, failed=0) == watcher.stats
+
+    # Opening for writing without changing the file: up to date, not converted again.
+    with open(flac, 'ab'):
+        pass
+    assert [flac] == handle_events(watcher)
+    watcher.sync([flac])
+    assert 1 == watcher.stats['converted']
+    # Unknown to a new watcher, up to date according to the mp3's sync metadata.
+    assert [] == Watcher(str(tmpdir.join('flac')), watcher.targets, 0, inotify=watcher.inotify).outdated(flac)
+
+
+def test_debounce(tmpdir, watcher):
+    """Test that a FLAC file isn't ready while it's still being written."""
+    watcher.delay = 60
+    flac = str(tmpdir.join('flac', 'song.flac'))
+    with open(flac, 'wb') as f:
+        f.write(b'fLaC')
+    assert [] == handle_events(watcher)
+    assert [flac] == list(watcher.pending)
+    assert [flac] == watcher.ready(time.time() + 60)
+
+
+def test_deleted(tmpdir, fake_bins, watcher):
+    """Test that outputs of deleted FLAC files are deleted with their directory."""
+    album = tmpdir.join('flac').mkdir('Album')
+    flac = make_flac(album, 'song.flac')
+    watcher.sync(handle_events(watcher))
+    assert os.path.isfile(str(tmpdir.join('mp3', 'Album', 'song.mp3')))
+    os.remove(flac)
+    watcher.sync(handle_events(watcher))
+    assert not tmpdir.join('mp3', 'Album').check()
+    assert 1 == watcher.stats['deleted']
+
+
+def test_deleted_keep_empty_dirs(tmpdir, fake_bins, watcher):
+    """Test that --keep-empty-dirs keeps the emptied output directory."""
+    watcher.keep_empty_dirs = True
+    flac = make_flac(tmpdir.join('flac').mkdir('Album'), 'song.flac')
+    watcher.sync(handle_events(watcher))
+    os.remove(flac)
+    watcher.sync(handle_events(watcher))
+    assert [] == tmpdir.join('mp3', 'Album').listdir()
+
+
+def test_control_socket(tmpdir, watcher, request):
+    """Test status and manual enqueue through the control socket."""
+    flac = tmpdir.join('flac').mkdir('Album').join('song.flac').ensure(file=True)
+    handle_events(watcher)
+    path = str(tmpdir.join('control.sock'))
+    control = ControlSocket(path, watcher)
+    control.start()
+    request.addfinalizer(control.close)
+
+    def send(line):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(line.encode('utf-8') + b'\n')
+        reply = client.makefile('rb').readline()
+        client.close()
+        return json.loads(reply.decode('utf-8'))
+
+    assert dict(queued=[str(flac)]) == send('enqueue Album')
+    status = send('status')
+    assert [str(flac)] == status['pending']
+    assert 2 == status['watches']
+    assert send('enqueue /etc/passwd')['error'].startswith('Not in the FLAC directory')
+    assert 'Unknown command: stop' == send('stop')['error']
+    assert [str(flac)] == watcher.ready(time.time())
+    assert {str(flac)} == watcher.forced